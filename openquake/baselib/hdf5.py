@@ -20,7 +20,9 @@ import os
 import re
 import csv
 import sys
+import queue
 import inspect
+import threading
 import tempfile
 import warnings
 import importlib
@@ -37,7 +39,11 @@ with warnings.catch_warnings():
     import pandas
 import numpy
 import h5py
-from openquake.baselib import InvalidFile, general, sap
+try:
+    import hdf5plugin  # registers the blosc filters
+except ImportError:
+    hdf5plugin = None
+from openquake.baselib import InvalidFile, config, general, sap
 from openquake.baselib.general import encode, decode
 
 vbytes = h5py.special_dtype(vlen=bytes)
@@ -51,6 +57,17 @@ FLOAT = (float, numpy.float32, numpy.float64)
 INT = (int, numpy.int32, numpy.uint32, numpy.int64, numpy.uint64)
 MAX_ROWS = 10_000_000
 
+# rows per chunk and compression of the extendable datasets inside
+# groups with a well known access pattern; chunks are read entirely,
+# so they must be small for sliced reads and large for full scans;
+# the blosc compression is used only if enabled, see blosc_enabled
+PROFILES = {
+    'gmf_data': (2**14, 'lz4'),  # read by event slices
+    '_rates': (2**16, 'lz4'),  # read by site chunks
+    'risk_by_event': (2**18, 'lz4'),  # read by column, filtered by agg_id
+}
+MAX_CHUNK_BYTES = 2**20  # the size of the default HDF5 chunk cache
+
 if sys.platform == 'win32':
     # go back to the behavior before hdf5==1.12 i.e. h5py==3.4
     os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
@@ -89,6 +106,56 @@ def sanitize(value):
     return value
 
 
+def blosc_enabled():
+    """
+    :returns: True if blosc_compression is set in the section [performance]
+              of openquake.cfg and hdf5plugin is installed
+    """
+    flag = config.performance.get('blosc_compression', 0)
+    return bool(flag and hdf5plugin)
+
+
+def get_filter(compression):
+    """
+    :param compression: None, 'gzip', 'lzf', 'lz4' or 'zstd'
+    :returns: the compression keyword arguments for h5py
+
+    'lz4' and 'zstd' are blosc filters with byte shuffling, available
+    only if hdf5plugin is installed, otherwise no compression is used
+    """
+    if compression in ('lz4', 'zstd'):
+        if hdf5plugin is None:
+            return {}
+        return dict(hdf5plugin.Blosc(
+            cname=compression, clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    elif compression:
+        return dict(compression=compression)
+    return {}
+
+
+def get_profile(name, dtype, shape=(None,)):
+    """
+    :param name: name of an extendable dataset
+    :param dtype: dtype of the dataset
+    :param shape: shape of the dataset
+    :returns: a pair (chunks, compression) from the PROFILES
+
+    >>> get_profile('gmf_data/PGA', numpy.float32)
+    ((16384,), 'lz4')
+    >>> get_profile('_rates/rate', numpy.float32, (None, 4096))
+    ((64, 4096), 'lz4')
+    >>> get_profile('events', numpy.float32)
+    (True, None)
+    """
+    rows, compression = PROFILES.get(name.split('/')[0], (0, None))
+    dt = numpy.dtype(dtype)
+    if not rows or dt.hasobject or h5py.check_vlen_dtype(dt):
+        return True, None  # let h5py guess the chunks
+    rowbytes = dt.itemsize * int(numpy.prod(shape[1:]))
+    rows = min(rows, max(MAX_CHUNK_BYTES // rowbytes, 1))
+    return (rows,) + tuple(shape[1:]), compression
+
+
 def create(hdf5, name, dtype, shape=(None,), compression=None,
            fillvalue=None, attrs=None):
     """
@@ -96,17 +163,23 @@ def create(hdf5, name, dtype, shape=(None,), compression=None,
     :param name: an hdf5 key string
     :param dtype: dtype of the dataset (usually composite)
     :param shape: shape of the dataset (can be extendable)
-    :param compression: None or 'gzip' are recommended
+    :param compression: None, 'gzip' or 'lz4' are recommended
     :param attrs: dictionary of attributes of the dataset
     :returns: a HDF5 dataset
+
+    Extendable datasets get the chunks and the compression (if not
+    passed explicitly and if blosc is enabled) from the PROFILES.
     """
     if shape[0] is None:  # extendable dataset
+        chunks, comp = get_profile(name, dtype, shape)
+        if not blosc_enabled():
+            comp = None
         dset = hdf5.create_dataset(
-            name, (0,) + shape[1:], dtype, chunks=True, maxshape=shape,
-            compression=compression)
+            name, (0,) + shape[1:], dtype, chunks=chunks, maxshape=shape,
+            **get_filter(compression or comp))
     else:  # fixed-shape dataset
         dset = hdf5.create_dataset(name, shape, dtype, fillvalue=fillvalue,
-                                   compression=compression)
+                                   **get_filter(compression))
     if attrs:
         for k, v in attrs.items():
             dset.attrs[k] = sanitize(v)
@@ -130,6 +203,28 @@ class FakeDataset:
         pass
 
 
+def memmap(dset):
+    """
+    :param dset: a HDF5 dataset
+    :returns: a read-only numpy.memmap if the dataset is contiguous and
+              uncompressed, otherwise the dataset itself
+
+    The memmap is a zero-copy view over the underlying file: slicing it
+    reads only the required pages, like slicing the dataset, but without
+    the intermediate copies performed by h5py. Notice that chunked
+    datasets (i.e. the extendable ones) are returned unchanged.
+    """
+    if (dset.chunks or dset.file.driver != 'sec2' or dset.shape is None
+            or dset.dtype.hasobject or h5py.check_vlen_dtype(dset.dtype)):
+        return dset
+    offset = dset.id.get_offset()
+    if offset is None:  # no data has been written yet
+        return dset
+    dset.file.flush()  # make sure the data is on disk
+    return numpy.memmap(dset.file.filename, dset.dtype, 'r', offset,
+                        dset.shape)
+
+
 def extend(dset, array, **attrs):
     """
     Extend an extensible dataset with an array of a compatible dtype.
@@ -155,6 +250,105 @@ def extend(dset, array, **attrs):
     return newlength
 
 
+class Writer(object):
+    """
+    Extend the datasets of a HDF5 file in a background thread, by
+    coalescing small appends into large writes, so that the process
+    calling `.extend` can keep aggregating results while the previous
+    ones are compressed and written. Use it as a context manager:
+
+    >> with Writer(h5) as writer:
+    ..     writer.extend('gmf_data/sid', sids)
+    ..     writer.extend('gmf_data/eid', eids)
+
+    The appends to the same dataset are written in order; the data is
+    guaranteed to be on the file only after `.flush()` or when
+    exiting the context manager. Errors in the writer thread are
+    re-raised in the calling thread at the next `.extend` or `.flush`.
+
+    :param hdf5: a HDF5 file (or any object returning datasets by key)
+    :param bufsize: number of bytes to buffer before writing
+    :param maxqueue: maximum number of pending appends
+    """
+    def __init__(self, hdf5, bufsize=2**25, maxqueue=64):
+        self.hdf5 = hdf5
+        self.bufsize = bufsize
+        self.queue = queue.Queue(maxqueue)
+        self.arrays = collections.defaultdict(list)  # key -> arrays
+        self.nbytes = 0
+        self.exc = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def extend(self, key, array):
+        """
+        Queue an array to be appended to the dataset `key`. Blocks if
+        there are too many pending appends.
+        """
+        self._check()
+        self.queue.put((key, numpy.asarray(array)))
+
+    def flush(self):
+        """
+        Wait for all the pending appends to be written on the file
+        """
+        self.queue.put(('', None))
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        """
+        Flush and stop the writer thread
+        """
+        if self.thread.is_alive():
+            self.queue.put((None, None))
+            self.thread.join()
+        self._check()
+
+    def _check(self):
+        if self.exc is not None:
+            exc, self.exc = self.exc, None
+            raise exc
+
+    def _write(self):
+        for key, arrays in self.arrays.items():
+            extend(self.hdf5[key], numpy.concatenate(arrays)
+                   if len(arrays) > 1 else arrays[0])
+        self.arrays.clear()
+        self.nbytes = 0
+
+    def _run(self):
+        while True:
+            key, array = self.queue.get()
+            try:
+                if self.exc is not None:  # discard the data
+                    self.arrays.clear()
+                elif array is not None:
+                    self.arrays[key].append(array)
+                    self.nbytes += array.nbytes
+                    if self.nbytes >= self.bufsize:
+                        self._write()
+                else:  # flush or close
+                    self._write()
+            except Exception as exc:
+                self.exc = exc
+            finally:
+                self.queue.task_done()
+            if key is None:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, exc, tb):
+        if etype is None:
+            self.close()
+        else:  # stop the thread without masking the original error
+            self.exc = exc
+            self.queue.put((None, None))
+            self.thread.join()
+
+
 def cls2dotname(cls):
     """
     The full Python name (i.e. `pkg.subpkg.mod.cls`) of a class
@@ -235,10 +429,11 @@ class Group(collections.abc.Mapping):
         return len(self.dic)
 
 
-def sel(dset, filterdict):
+def sel(dset, filterdict, lazy=False):
     """
     Select a dataset with shape_descr. For instance
-    dstore.sel('hcurves', imt='PGA', sid=2)
+    dstore.sel('hcurves', imt='PGA', sid=2). If lazy is True, return
+    a slice of the memmap of the dataset, if possible (see `memmap`).
     """
     dic = get_shape_descr(dset.attrs['json'])
     lst = []
@@ -254,7 +449,7 @@ def sel(dset, filterdict):
             lst.append(slice(idx, idx + 1))
         else:
             lst.append(slice(None))
-    return dset[tuple(lst)]
+    return (memmap(dset) if lazy else dset)[tuple(lst)]
 
 
 def dset2df(dset, indexfield, filterdict):
@@ -716,7 +911,7 @@ class ArrayWrapper(object):
         elif hasattr(obj, '__toh5__'):
             return obj
         elif hasattr(obj, 'attrs'):  # is a dataset
-            array, attrs = obj[()], dict(obj.attrs)
+            array, attrs = memmap(obj)[()], dict(obj.attrs)
             if 'json' in attrs:
                 attrs.update(get_shape_descr(attrs.pop('json')))
         else:  # assume obj is an array
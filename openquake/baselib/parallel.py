@@ -179,21 +179,50 @@ the single core processing the slow task). The OpenQuake engine does
 a great deal of work trying to split slow sources in more manageable
 fast sources.
 
+The Starmap helps with that too. The tasks not yet submitted are kept
+in a queue and a new task is submitted only when a running task ends,
+so that idle cores pull work from the queue. If the flag
+`Starmap.heaviest_first` is set, the queue is ordered by decreasing
+weight of the first argument of the tasks, so that the slow tasks do not
+end up in the tail of the computation. Moreover, every time a task ends,
+the Starmap updates the estimated number of seconds per unit of weight and
+sends it to the next tasks as `monitor.sec_per_weight`, together with the
+flag `monitor.tail` which is True when the queue is empty. A task can use
+such information to predict its own duration and to yield subtasks that
+will be picked up by the idle cores.
+
+The number of tasks in flight is bounded by `Starmap.max_inflight`
+(by default `Starmap.CT`) and the tasks submitted beyond that limit are
+kept in the queue. The window is further reduced when the results expected
+from the running tasks (estimated from the size of the results received
+so far) would exceed `max_inflight_mb` in the section `[memory]` of
+openquake.cfg. In this way the master does not run out of memory
+when the workers produce data faster than it can be aggregated. For
+associative reducers it is also possible to aggregate the results in
+parallel with `smap.reduce(agg, acc, threads=N)`.
+
 """
 import os
 import re
 import ast
+import copy
 import sys
 import time
+import heapq
+import numbers
+import itertools
 import socket
 import signal
+import zlib
 import pickle
+import queue
 import sqlite3
 import getpass
 import inspect
 import logging
 import operator
 import tempfile
+import threading
 import traceback
 import collections
 from unittest import mock
@@ -203,14 +232,15 @@ from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
 import psutil
 import numpy
 
-from openquake.baselib import config, hdf5
+from openquake.baselib import config, hdf5, zeromq
 from openquake.baselib.general import decode
 from openquake.baselib.zeromq import zmq, Socket
 from openquake.baselib.performance import (
     Monitor, memory_gb, init_performance)
 from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize, CallableDict,
-    gettemp, engine_version, shortlist, compress, decompress, mp as mp_context)
+    gettemp, engine_version, shortlist, compress, decompress, socket_ready,
+    mp as mp_context)
 
 sys.setrecursionlimit(2000)  # raised to make pickle happier
 # see https://github.com/gem/oq-engine/issues/5230
@@ -253,14 +283,24 @@ def processpool_submit(self, func, args, monitor):
 
 @submit.add('zmq', 'slurm')
 def zmq_submit(self, func, args, monitor):
-    idx = self.task_no % len(host_cores)
-    host = host_cores[idx].split()[0]
     port = int(config.zworkers.ctrl_port)
-    dest = 'tcp://%s:%d' % (host, port)
-    logging.debug('Sending to %s', dest)
-    with Socket(dest, zmq.REQ, 'connect', timeout=300) as sock:
-        sub = sock.send((func, args, self.task_no, monitor))
-        assert sub == 'submitted', sub
+    while True:
+        alive = [hc.split()[0] for hc in host_cores
+                 if hc.split()[0] not in self.dead_hosts]
+        if not alive:
+            raise RuntimeError('All the worker nodes are dead')
+        host = alive[self.task_no % len(alive)]
+        dest = 'tcp://%s:%d' % (host, port)
+        logging.debug('Sending to %s', dest)
+        try:
+            with Socket(dest, zmq.REQ, 'connect', timeout=300) as sock:
+                sub = sock.send((func, args, self.task_no, monitor))
+        except zeromq.TimeoutError:
+            logging.error('Worker node %s is not responding', host)
+            self.dead_hosts.add(host)
+        else:
+            assert sub == 'submitted', sub
+            return host  # used to resubmit the task if the host dies
 
 
 def oq_distribute(task=None):
@@ -273,6 +313,17 @@ def oq_distribute(task=None):
     return dist
 
 
+def get_weight(obj, default=1.):
+    """
+    :param obj: an object which may have a numeric attribute `.weight`
+    :returns: the weight of the object or the default
+    """
+    weight = getattr(obj, 'weight', default)
+    if isinstance(weight, numbers.Real):
+        return weight
+    return default  # for instance a DataFrame with a weight column
+
+
 def init_worker():
     """
     Used to initialize the process pool. Calls setproctitle (if available)
@@ -303,6 +354,7 @@ class Pickled(object):
     :param obj: the object to pickle
     """
     compressed = False
+    checksum = 0  # nonzero only for cacheable objects
 
     def __init__(self, obj):
         self.clsname = obj.__class__.__name__
@@ -311,6 +363,8 @@ class Pickled(object):
             self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
         except TypeError as exc:  # can't pickle, show the obj in the message
             raise TypeError('%s: %s' % (exc, obj))
+        if getattr(obj, 'cacheable', False):
+            self.checksum = zlib.crc32(self.pik) or 1
         self.compressed = len(self.pik) > MB and config.distribution.compress
         if self.compressed:
             self.pik = compress(self.pik)
@@ -374,6 +428,69 @@ def pickle_sequence(objects):
     return out
 
 
+class WorkerCache(object):
+    """
+    LRU cache living in each worker process, used to avoid unpickling the
+    same objects (for instance ContextMakers with their GSIMs) in each
+    task. The objects are cached only if they have an attribute
+    `cacheable` set to True and are keyed by calc_id and checksum of
+    the pickled bytes, so objects of different jobs are never shared.
+    NB: the tasks can modify the cached objects, as long as they
+    reinitialize the modified attributes at each call; caches depending
+    on the task arguments must be cleared in a method `reset_cache`,
+    which is called every time an object is reused.
+
+    :param maxsize: maximum number of cached objects
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.dic = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func, *args):
+        """
+        :returns: the object associated to the key, computing it if missing
+        """
+        with self.lock:
+            try:
+                self.dic.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                obj = self.dic[key]
+                if hasattr(obj, 'reset_cache'):
+                    obj.reset_cache()
+                return obj
+            obj = self.dic[key] = func(*args)
+            if len(self.dic) > self.maxsize:
+                self.dic.popitem(last=False)  # remove the least recent
+            return obj
+
+    def unpickle(self, pickled, calc_id=None):
+        """
+        :returns: the unpickled object, possibly from the cache
+        """
+        if not pickled.checksum or not self.maxsize:
+            return pickled.unpickle()
+        key = (calc_id, pickled.clsname, pickled.checksum, len(pickled))
+        return self.get(key, pickled.unpickle)
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters
+        """
+        with self.lock:
+            self.dic.clear()
+            self.hits = self.misses = 0
+
+
+worker_cache = WorkerCache(
+    int(config.distribution.get('worker_cache_size', 0)))
+
+
 class FakePickle:
     def __init__(self, sentbytes):
         self.sentbytes = sentbytes
@@ -400,6 +517,7 @@ class Result(object):
             self.nbytes = {k: len(Pickled(v)) for k, v in val.items()}
         elif isinstance(val, tuple) and callable(val[0]):
             self.func = val[0]
+            self.weight = get_weight(val[1])  # used by the task scheduler
             self.pik = pickle_sequence(val[1:])
             self.nbytes = {'args': sum(len(p) for p in self.pik)}
         elif msg == 'TASK_ENDED':
@@ -528,7 +646,7 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
     isgenfunc = inspect.isgeneratorfunction(func)
     if hasattr(args[0], 'unpickle'):
         # args is a list of Pickled objects
-        args = [a.unpickle() for a in args]
+        args = [worker_cache.unpickle(a, mon.calc_id) for a in args]
     if mon is dummy_mon:  # in the DbServer
         assert not isgenfunc, func
         return Result.new(func, args, mon)
@@ -538,7 +656,7 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
     else:
         name = func.__name__
     mon = mon.new(operation='total ' + name, measuremem=True)
-    mon.weight = getattr(args[0], 'weight', 1.)  # used in task_info
+    mon.weight = get_weight(args[0])  # used in task_info
     mon.task_no = task_no
     if mon.inject:
         args += (mon,)
@@ -618,13 +736,67 @@ class IterResult(object):
                          self.counts, humansize(mean),
                          time.time() - t0, pu, self.name, nb)
 
-    def reduce(self, agg=operator.add, acc=None):
+    def reduce(self, agg=operator.add, acc=None, threads=0,
+               acc_factory=None):
+        """
+        :param agg: aggregation function
+        :param acc: initial value of the accumulator
+        :param threads: if positive, number of aggregator threads
+        :param acc_factory: builds the empty accumulators of the threads
+            (by default they are copies of acc, which then must be empty)
+        :returns: the aggregated result
+        """
         if acc is None:
             acc = AccumDict()
+        if threads > 0:
+            return self._reduce_threads(agg, acc, threads, acc_factory)
         for result in self:
             acc = agg(acc, result)
         return acc
 
+    def _reduce_threads(self, agg, acc, threads, acc_factory):
+        # agg must be associative and able to merge two accumulators, like
+        # RateMap.__iadd__; each thread has its own accumulator and the
+        # accumulators are merged at the end; since the queue is bounded,
+        # the receiving loop waits when the threads are slower
+        results = queue.Queue(maxsize=2 * threads)
+        accs = [acc] + [acc_factory() if acc_factory else copy.deepcopy(acc)
+                        for _ in range(threads - 1)]
+        errors = []
+
+        def aggregate(i):
+            while True:
+                res = results.get()
+                if res is None:  # no more results
+                    break
+                elif errors:  # drain the queue
+                    continue
+                try:
+                    accs[i] = agg(accs[i], res)
+                except Exception as exc:
+                    errors.append(exc)
+
+        workers = [threading.Thread(target=aggregate, args=(i,), daemon=True)
+                   for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            for result in self:
+                results.put(result)
+                if errors:
+                    break
+        finally:
+            for _ in workers:
+                results.put(None)
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+        acc = accs[0]
+        for other in accs[1:]:
+            acc = agg(acc, other)
+        return acc
+
     @classmethod
     def sum(cls, iresults):
         """
@@ -695,6 +867,38 @@ class SharedArray(object):
         self.sm.unlink()
 
 
+class MmapArray(object):
+    """
+    Array saved in .npy format and memory-mapped by the workers in
+    copy-on-write mode. Since the page cache is shared by all the processes
+    of a node, the array is loaded in memory only once per node and it is
+    never pickled; changes made by a worker are private to that worker.
+    Works also with zmq, assuming the calc_dir is on a shared filesystem.
+    """
+    def __init__(self, fname, array):
+        numpy.save(fname, array, allow_pickle=False)
+        self.fname = fname
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def __enter__(self):
+        # this is called in the workers
+        return numpy.load(self.fname, mmap_mode='c')
+
+    def __exit__(self, etype, exc, tb):
+        # the memory map is closed when the array is garbage collected
+        pass
+
+    def __repr__(self):
+        return '<%s %s%s>' % (self.__class__.__name__, self.dtype, self.shape)
+
+    def unlink(self):
+        try:
+            os.remove(self.fname)
+        except OSError:  # on Windows a mapped file cannot be removed
+            pass
+
+
 # determine the number of cores to use; for instance on a system with
 # 12 threads and 8 GB of RAM, tot_cores = min(12, 8) = 8
 cpu_count = psutil.cpu_count()
@@ -718,6 +922,8 @@ class Starmap(object):
     on = False
     CT = num_cores * 2
     expected_outputs = 0  # unknown
+    heaviest_first = False  # if True, submit first the heaviest tasks
+    max_inflight = None  # maximum number of running tasks, CT if None
 
     @classmethod
     def init(cls, distribute=None):
@@ -819,6 +1025,15 @@ class Starmap(object):
         self.task_no = 0
         self._shared = {}
         self.n_out = 0
+        self._seqno = itertools.count()
+        self.weight_time = numpy.zeros(2)  # total weight, total time
+        self.monitor.sec_per_weight = 0.  # unknown until a task ends
+        self.monitor.tail = False
+        self.received = numpy.zeros(2)  # bytes received, tasks ended
+        self.sent_args = {}  # task_no -> (func, args), used to resubmit
+        self.outs = AccumDict(accum=0)  # task_no -> number of outputs
+        self.lost = set()  # task numbers of the tasks resubmitted
+        self.dead_hosts = set()
 
     def log_percent(self):
         """
@@ -850,14 +1065,22 @@ class Starmap(object):
 
     def submit(self, args, func=None):
         """
-        Submit the given arguments to the underlying task
+        Submit the given arguments to the underlying task, or put them in
+        the queue if there are already too many tasks in flight
         """
+        maxtasks = self.max_inflight or self.CT
+        if self.task_queue or len(self.tasks) >= maxtasks:
+            self.push(func or self.task_func, args)
+        else:
+            self._submit(args, func)
+
+    def _submit(self, args, func=None):
         func = func or self.task_func
         if not hasattr(self, 'socket'):  # setup the PULL socket the first time
             self.socket = Socket(
                 self.receiver, zmq.PULL, 'bind',
-                starmap=self if self.distribute == 'processpool' else None
-            ).__enter__()
+                starmap=None if self.distribute in ('no', 'threadpool')
+                else self).__enter__()
             self.monitor.shared = self._shared
             self.monitor.backurl = 'tcp://%s:%s' % (
                 self.return_ip, self.socket.port)
@@ -876,9 +1099,35 @@ class Starmap(object):
                 fname = func.__name__
                 argnames = getargnames(func)[:-1]
             self.sent[fname] += {a: len(p) for a, p in zip(argnames, args)}
+        # if there is nothing left in the queue we are in the tail of the
+        # computation and the tasks should split themselves if they are slow
+        self.monitor.tail = not self.task_queue
         self.tasks[self.task_no] = submit[dist](self, func, args, self.monitor)
+        if dist in ('zmq', 'slurm'):
+            self.sent_args[self.task_no] = (func or self.task_func, args)
         self.task_no += 1
 
+    def push(self, func, args, weight=None):
+        """
+        Add a task to the queue. The queue is a heap ordered by decreasing
+        weight if .heaviest_first is set, otherwise in FIFO order.
+
+        :param func: the task function
+        :param args: the task arguments (possibly Pickled)
+        :param weight: if None, extracted from the first argument
+        """
+        if weight is None:
+            weight = get_weight(args[0])
+        prio = -weight if self.heaviest_first else 0
+        heapq.heappush(self.task_queue, (prio, next(self._seqno), func, args))
+
+    def pop(self):
+        """
+        :returns: the pair (func, args) of the next task to submit
+        """
+        _prio, _seqno, func, args = heapq.heappop(self.task_queue)
+        return func, args
+
     def submit_all(self):
         """
         :returns: an IterResult object
@@ -887,14 +1136,14 @@ class Starmap(object):
             for args in self.task_args:
                 self.submit(args)
         else:  # build a task queue in advance
-            self.task_queue = [(self.task_func, args)
-                               for args in self.task_args]
+            for args in self.task_args:
+                self.push(self.task_func, args)
         dist = 'no' if self.num_tasks == 1 else self.distribute
         if dist == 'slurm':
             # submit the tasks via zmq
-            for func, args in self.task_queue:
-                self.submit(args, func=func)
-            self.task_queue.clear()
+            while self.task_queue:
+                func, args = self.pop()
+                self._submit(args, func=func)
         return self.get_results()
 
     def get_results(self):
@@ -904,11 +1153,13 @@ class Starmap(object):
         return IterResult(self._loop(), self.name, self.argnames,
                           self.sent, self.h5)
 
-    def reduce(self, agg=operator.add, acc=None):
+    def reduce(self, agg=operator.add, acc=None, threads=0,
+               acc_factory=None):
         """
-        Submit all tasks and reduce the results
+        Submit all tasks and reduce the results, possibly by using
+        aggregator threads (see IterResult.reduce)
         """
-        return self.submit_all().reduce(agg, acc)
+        return self.submit_all().reduce(agg, acc, threads, acc_factory)
 
     def __iter__(self):
         return iter(self.submit_all())
@@ -916,10 +1167,23 @@ class Starmap(object):
     def _submit_many(self, howmany):
         for _ in range(howmany):
             if self.task_queue:
-                # remove in LIFO order
-                func, args = self.task_queue[0]
-                del self.task_queue[0]
-                self.submit(args, func=func)
+                func, args = self.pop()
+                self._submit(args, func=func)
+
+    def free_slots(self):
+        """
+        :returns:
+            the number of tasks that can be submitted without exceeding the
+            in-flight window and the memory budget (at least 1 if there are
+            no running tasks, to avoid stalling the computation)
+        """
+        window = self.max_inflight or self.CT
+        nbytes, ntasks = self.received
+        budget = int(config.memory.get('max_inflight_mb', 0)) * MB
+        if budget and nbytes:
+            # expected size of the results of a task
+            window = min(window, int(budget * ntasks / nbytes))
+        return max(window - len(self.tasks), int(not self.tasks))
 
     # NB: the shared dictionary will be attached to the monitor
     # and used in the workers; to see an example of usage, look at
@@ -928,7 +1192,20 @@ class Starmap(object):
         """
         Apply SharedArray.new to a dictionary of arrays
         """
-        self._shared = {k: SharedArray.new(a) for k, a in dictarray.items()}
+        self._shared.update(
+            {k: SharedArray.new(a) for k, a in dictarray.items()})
+
+    def mmap(self, **dictarray):
+        """
+        Apply MmapArray to a dictionary of arrays, storing them in the
+        calc_dir. Unlike .share, works with all distribution mechanisms,
+        but the changes are not seen by the master. Must be called before
+        submitting.
+        """
+        cdir = calc_dir(self.monitor.filename)
+        for key, array in dictarray.items():
+            fname = gettemp(dir=cdir, prefix=key + '_', suffix='.npy')
+            self._shared[key] = MmapArray(fname, array)
 
     def unlink(self):
         """
@@ -941,12 +1218,42 @@ class Starmap(object):
     # called by the zmq Socket
     def check_tasks_alive(self):
         """
-        Raise BrokenProcessPool if any task died abruptly
+        Raise BrokenProcessPool if any task died abruptly; with zmq
+        resubmit the tasks sent to dead worker nodes
         """
+        if self.distribute in ('zmq', 'slurm'):
+            self.resubmit_lost()
+            return
         for task in self.tasks.values():
             if task.done():
                 task.result(timeout=0)
 
+    def resubmit_lost(self):
+        """
+        Resubmit to the other worker nodes the tasks sent to nodes which
+        are not responding anymore. Raise an error if a lost task already
+        sent back some outputs, since they cannot be discarded.
+        """
+        port = int(config.zworkers.ctrl_port)
+        for host in set(self.tasks.values()) - self.dead_hosts - {None}:
+            if not socket_ready((host, port)):
+                logging.error('Worker node %s is not responding', host)
+                self.dead_hosts.add(host)
+        for task_no, host in list(self.tasks.items()):
+            if host not in self.dead_hosts:
+                continue
+            elif self.outs[task_no]:
+                raise RuntimeError(
+                    'Task #%d died on %s after sending %d outputs' %
+                    (task_no, host, self.outs[task_no]))
+            logging.warning('Resubmitting task #%d lost on %s',
+                            task_no, host)
+            func, args = self.sent_args.pop(task_no)
+            del self.tasks[task_no]
+            self.lost.add(task_no)
+            self.push(func, args)
+        self._submit_many(self.free_slots())
+
     def _loop(self):
         self.busytime = AccumDict(accum=[])  # pid -> time
         dist = 'no' if self.num_tasks == 1 else self.distribute
@@ -954,10 +1261,7 @@ class Starmap(object):
             self.monitor.task_no = self.task_no  # total number of tasks
 
         elif self.task_queue:
-            first_args = self.task_queue[:self.CT]
-            self.task_queue[:] = self.task_queue[self.CT:]
-            for func, args in first_args:
-                self.submit(args, func=func)
+            self._submit_many(self.free_slots())
 
         if not hasattr(self, 'socket'):  # no submit was ever made
             return ()
@@ -974,13 +1278,19 @@ class Starmap(object):
             if self.calc_id != res.mon.calc_id:
                 logging.warning('Discarding a result from job %s, since this '
                                 'is job %s', res.mon.calc_id, self.calc_id)
+            elif res.mon.task_no in self.lost:
+                logging.warning('Discarding a result from task #%d, since it'
+                                ' was resubmitted', res.mon.task_no)
             elif res.msg == 'TASK_ENDED':
                 self._task_ended(res, finished)
             elif res.func:  # add subtask
-                self.task_queue.append((res.func, res.pik))
-                self._submit_many(1)
+                self.outs[res.mon.task_no] += 1
+                self.push(res.func, res.pik, res.weight)
+                self._submit_many(self.free_slots())
             else:
+                self.outs[res.mon.task_no] += 1
                 self.n_out += 1
+                self.received[0] += sum(res.nbytes.values())
                 yield res
         self.log_percent()
         self.socket.__exit__(None, None, None)
@@ -994,11 +1304,28 @@ class Starmap(object):
             if self.h5.mode != 'r':
                 self.monitor.save_starmap_info(self.h5, self.name, times)
 
+    def update_sec_per_weight(self, mon):
+        """
+        Update the estimated number of seconds per unit of weight by using
+        the duration of a completed task. The estimate is sent to the tasks
+        submitted later, so that they can split themselves if needed.
+        """
+        if mon.operation == 'total ' + self.name and mon.weight > 0:
+            # subtasks are not considered, since their weight is not
+            # homogeneous with the weight of the main tasks
+            self.weight_time += [mon.weight, mon.duration]
+            self.monitor.sec_per_weight = (
+                self.weight_time[1] / self.weight_time[0])
+
     def _task_ended(self, res, finished):
         finished.add(res.mon.task_no)
         self.busytime += {res.workerid: res.mon.duration}
+        self.update_sec_per_weight(res.mon)
         del self.tasks[res.mon.task_no]
-        self._submit_many(1)
+        self.sent_args.pop(res.mon.task_no, None)
+        self.outs.pop(res.mon.task_no, None)
+        self.received[1] += 1
+        self._submit_many(self.free_slots())
         todo = set(range(self.task_no)) - finished
         logging.debug('%d tasks todo %s', len(todo),
                       shortlist(sorted(todo)))
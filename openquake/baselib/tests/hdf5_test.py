@@ -17,8 +17,13 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest import mock
 import numpy
-from openquake.baselib.hdf5 import dumps, obj_to_json, json_to_obj
+from openquake.baselib import config
+from openquake.baselib.general import gettemp
+from openquake.baselib.hdf5 import (
+    File, dumps, obj_to_json, json_to_obj, create, extend, memmap, sel,
+    Writer, hdf5plugin)
 
 
 class DumpsTestCase(unittest.TestCase):
@@ -49,3 +54,85 @@ class ObjToJsonTestCase(unittest.TestCase):
         obj = Obj(1, Obj(1, 2))
         js = obj_to_json(obj)
         print(js)
+
+
+class MemmapTestCase(unittest.TestCase):
+    def test(self):
+        fname = gettemp(suffix='.hdf5')
+        arr = numpy.arange(24, dtype='>f4').reshape(2, 3, 4)
+        with File(fname, 'w') as h5:
+            h5['arr'] = arr
+            h5['arr'].attrs['json'] = dumps(
+                dict(shape_descr=['site_id', 'stat', 'lvl'],
+                     site_id=2, stat=['mean', 'max', 'std'], lvl=4))
+            create(h5, 'ext', float)  # extendable, i.e. chunked
+            extend(h5['ext'], numpy.ones(3))
+        with File(fname, 'r') as h5:
+            mm = memmap(h5['arr'])
+            self.assertIsInstance(mm, numpy.memmap)
+            numpy.testing.assert_equal(mm, arr)
+            got = sel(h5['arr'], dict(stat='max'), lazy=True)
+            self.assertIsInstance(got, numpy.memmap)
+            numpy.testing.assert_equal(got, arr[:, 1:2])
+            self.assertNotIsInstance(memmap(h5['ext']), numpy.memmap)
+
+
+class ProfileTestCase(unittest.TestCase):
+    def check(self, blosc):
+        fname = gettemp(suffix='.hdf5')
+        with File(fname, 'w') as h5:
+            create(h5, 'gmf_data/PGA', numpy.float32)
+            create(h5, 'risk_by_event/loss', numpy.float32)
+            create(h5, '_rates/rate', numpy.float32, (None, 4096))
+            create(h5, 'events', numpy.uint32)
+            create(h5, 'gmf_data/eid', numpy.uint32, compression='gzip')
+            extend(h5['gmf_data/PGA'], numpy.arange(100_000, dtype='f4'))
+        with File(fname, 'r') as h5:
+            self.assertEqual(h5['gmf_data/PGA'].chunks, (2**14,))
+            self.assertEqual(h5['risk_by_event/loss'].chunks, (2**18,))
+            self.assertEqual(h5['_rates/rate'].chunks, (64, 4096))
+            self.assertEqual(h5['gmf_data/eid'].compression, 'gzip')
+            self.assertIsNone(h5['events'].compression)
+            filters = h5['gmf_data/PGA']._filters
+            if blosc and hdf5plugin:
+                self.assertIn(str(hdf5plugin.BLOSC_ID), filters)
+            else:  # no compression
+                self.assertEqual(filters, {})
+            numpy.testing.assert_equal(h5['gmf_data/PGA'][99_990:],
+                                       numpy.arange(99_990, 100_000))
+
+    def test(self):
+        # the blosc compression is used only if enabled in openquake.cfg
+        for blosc in (0, 1):
+            with mock.patch.dict(config.performance,
+                                 blosc_compression=blosc):
+                self.check(blosc)
+
+
+class WriterTestCase(unittest.TestCase):
+    def test(self):
+        fname = gettemp(suffix='.hdf5')
+        with File(fname, 'w') as h5:
+            create(h5, 'eid', numpy.uint32)
+            create(h5, 'gmv', numpy.float32, (None, 2))
+            # a small bufsize forces several coalesced writes
+            with Writer(h5, bufsize=100) as writer:
+                for i in range(10):
+                    writer.extend('eid', numpy.full(i, i, numpy.uint32))
+                    writer.extend('gmv', numpy.ones((i, 2)) * i)
+                writer.flush()
+                self.assertEqual(len(h5['eid']), 45)
+                writer.extend('eid', [10])
+            eid = h5['eid'][:]
+            numpy.testing.assert_equal(eid[:-1], numpy.repeat(range(10),
+                                                              range(10)))
+            self.assertEqual(eid[-1], 10)
+            numpy.testing.assert_equal(h5['gmv'][:, 1], eid[:-1])
+
+    def test_error(self):
+        fname = gettemp(suffix='.hdf5')
+        with File(fname, 'w') as h5:
+            writer = Writer(h5)
+            writer.extend('missing', numpy.ones(3))
+            with self.assertRaises(KeyError):
+                writer.close()
@@ -162,6 +162,88 @@ class StarmapTestCase(unittest.TestCase):
         parallel.Starmap.shutdown()
 
 
+def get_len_dict(data, monitor):
+    return {len(data) % 3: len(data)}
+
+
+def get_weight_spw(lst, monitor):
+    return [(monitor.task_no, lst.weight, monitor.sec_per_weight)]
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def test_heaviest_first(self):
+        allargs = []
+        for weight in [1, 3, 2]:
+            lst = parallel.List([weight])
+            lst.weight = weight
+            allargs.append((lst,))
+        smap = parallel.Starmap(get_weight_spw, allargs, distribute='no')
+        smap.heaviest_first = True
+        res = sorted(smap.reduce(acc=[]))  # sorted by task number
+        # the tasks are run in order of decreasing weight
+        self.assertEqual([w for no, w, spw in res], [3, 2, 1])
+        # the first task has no estimate of the seconds per weight
+        self.assertEqual(res[0][2], 0)
+        self.assertGreater(smap.monitor.sec_per_weight, 0)
+
+    def test_fifo(self):
+        allargs = []
+        for weight in [1, 3, 2]:
+            lst = parallel.List([weight])
+            lst.weight = weight
+            allargs.append((lst,))
+        res = sorted(parallel.Starmap(
+            get_weight_spw, allargs, distribute='no').reduce(acc=[]))
+        self.assertEqual([w for no, w, spw in res], [1, 3, 2])
+
+    def test_max_inflight(self):
+        smap = parallel.Starmap(get_weight_spw, distribute='no')
+        smap.max_inflight = 1
+        for weight in [1, 3, 2]:
+            lst = parallel.List([weight])
+            lst.weight = weight
+            smap.submit((lst,))
+        # only one task is in flight, the others are in the queue
+        self.assertEqual(len(smap.tasks), 1)
+        self.assertEqual(len(smap.task_queue), 2)
+        res = sorted(smap.reduce(acc=[]))
+        self.assertEqual([w for no, w, spw in res], [1, 3, 2])
+        self.assertEqual(smap.free_slots(), 1)
+
+    def test_resubmit_lost(self):
+        smap = parallel.Starmap(get_length, distribute='no')
+        smap.tasks = {0: 'host1', 1: 'host2', 2: 'host2'}
+        smap.sent_args = {n: (get_length, ('abc',)) for n in smap.tasks}
+        def alive(hostport):
+            return hostport[0] == 'host1'
+        with mock.patch.object(parallel, 'socket_ready', alive), \
+                mock.patch.object(smap, '_submit_many'):
+            smap.resubmit_lost()
+            # the tasks sent to the dead host are back in the queue
+            self.assertEqual(smap.dead_hosts, {'host2'})
+            self.assertEqual(list(smap.tasks), [0])
+            self.assertEqual(smap.lost, {1, 2})
+            self.assertEqual(len(smap.task_queue), 2)
+
+            # a lost task which already sent outputs cannot be resubmitted
+            smap.tasks[3] = 'host2'
+            smap.outs[3] = 1
+            with self.assertRaises(RuntimeError):
+                smap.resubmit_lost()
+
+
+    def test_aggregator_threads(self):
+        # the results are dicts and the accumulators AccumDicts
+        allargs = [(numpy.arange(n),) for n in range(1, 11)]
+        res = parallel.Starmap(get_len_dict, allargs, distribute='no').reduce(
+            threads=3)
+        self.assertEqual(dict(res), {0: 18, 1: 22, 2: 15})
+        # the errors in the aggregation are raised
+        with self.assertRaises(ZeroDivisionError):
+            parallel.Starmap(get_len_dict, allargs, distribute='no').reduce(
+                lambda acc, res: 1 / 0, threads=2)
+
+
 class ThreadPoolTestCase(unittest.TestCase):
     def test(self):
         with mock.patch.dict(os.environ, {'OQ_DISTRIBUTE': 'threadpool'}):
@@ -245,3 +327,62 @@ class SharedArrayTestCase(unittest.TestCase):
         ).reduce()
         with self.s_array as arr:
             numpy.testing.assert_allclose(arr, [[.1, .1], [.2, .2]])
+
+
+def sum_row(row, monitor):
+    """
+    Sum a row of a memory-mapped array
+    """
+    with monitor.shared['arr'] as arr:
+        return arr[row].sum()
+
+
+class MmapArrayTestCase(unittest.TestCase):
+    def test(self):
+        smap = parallel.Starmap(sum_row, [(0,), (1,), (2,)])
+        smap.mmap(arr=numpy.arange(12.).reshape(3, 4))
+        res = smap.reduce(acc=[], agg=lambda acc, x: acc + [x])
+        self.assertEqual(sorted(res), [6., 22., 38.])
+        fname = smap._shared['arr'].fname
+        self.assertFalse(os.path.exists(fname))  # unlinked by reduce
+
+    @classmethod
+    def tearDownClass(cls):
+        parallel.Starmap.shutdown()
+
+
+class Cacheable(object):
+    cacheable = True
+    resets = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def reset_cache(self):
+        self.resets += 1
+
+
+class WorkerCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = parallel.WorkerCache(maxsize=2)
+        for key in 'abac':
+            cache.get(key, str.upper, key)
+        # 'b' is the least recently used and has been evicted
+        self.assertEqual(list(cache.dic), ['a', 'c'])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_unpickle(self):
+        cache = parallel.WorkerCache(maxsize=2)
+        obj1 = cache.unpickle(parallel.Pickled(Cacheable(1)), calc_id=1)
+        obj2 = cache.unpickle(parallel.Pickled(Cacheable(1)), calc_id=1)
+        self.assertIs(obj1, obj2)
+        self.assertEqual(obj2.resets, 1)
+        # objects with a different calc_id or content are not shared
+        obj3 = cache.unpickle(parallel.Pickled(Cacheable(1)), calc_id=2)
+        obj4 = cache.unpickle(parallel.Pickled(Cacheable(2)), calc_id=2)
+        self.assertIsNot(obj1, obj3)
+        self.assertEqual(obj4.value, 2)
+        # non-cacheable objects are always unpickled
+        lst1 = cache.unpickle(parallel.Pickled([1]), calc_id=1)
+        lst2 = cache.unpickle(parallel.Pickled([1]), calc_id=1)
+        self.assertIsNot(lst1, lst2)
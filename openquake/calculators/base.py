@@ -428,6 +428,8 @@ class BaseCalculator(metaclass=abc.ABCMeta):
         keys = set(self.datastore) | {'fullreport'}
         has_hcurves = ('hcurves-stats' in self.datastore or
                        'hcurves-rlzs' in self.datastore)
+        has_hmaps = ('hmaps-stats' in self.datastore or
+                     'hmaps-rlzs' in self.datastore)
         if has_hcurves:
             keys.add('hcurves')
         if 'ruptures' in self.datastore and len(self.datastore['ruptures']):
@@ -444,9 +446,9 @@ class BaseCalculator(metaclass=abc.ABCMeta):
                     if (key[:-4] + 'stats') in self.datastore:
                         continue  # skip individual curves
                 self._export((key, fmt))
-            if has_hcurves and self.oqparam.hazard_maps:
+            if has_hmaps and self.oqparam.hazard_maps:
                 self._export(('hmaps', fmt))
-            if has_hcurves and self.oqparam.uniform_hazard_spectra:
+            if has_hmaps and self.oqparam.uniform_hazard_spectra:
                 self._export(('uhs', fmt))
 
     def _export(self, ekey):
@@ -618,6 +620,8 @@ class HazardCalculator(BaseCalculator):
 
         if (oq.calculation_mode == 'event_based' and
                 oq.within_event_correlation_model and
+                not oq.correlation_block_size and
+                not oq.correlation_neighbors and
                 len(self.sitecol) > oq.max_sites_correl):
             raise ValueError('You cannot use a correlation model with '
                              f'{self.N} sites [{oq.max_sites_correl=}]')
@@ -1958,6 +1962,7 @@ def expose_outputs(dstore, owner=USER, status='complete', calc_id=None):
     if 'hcurves-stats' in hdf5 or 'hcurves-rlzs' in hdf5:
         if oq.hazard_stats() or oq.individual_rlzs or R == 1:
             dskeys.add('hcurves')
+    if 'hmaps-stats' in hdf5 or 'hmaps-rlzs' in hdf5:
         if oq.uniform_hazard_spectra:
             dskeys.add('uhs')  # export them
         if oq.hazard_maps:
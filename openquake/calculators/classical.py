@@ -18,7 +18,10 @@
 
 import io
 import os
+import json
 import time
+import zlib
+import pickle
 import psutil
 import logging
 import operator
@@ -29,14 +32,17 @@ from openquake.baselib import parallel, hdf5, config, general
 from openquake.baselib.general import (
     AccumDict, DictArray, groupby, humansize, delta)
 from openquake.hazardlib import valid, InvalidFile
+from openquake.hazardlib.stats import QuantileSketch
 from openquake.hazardlib.source_group import (
     read_csm, read_src_group, get_allargs)
-from openquake.hazardlib.contexts import get_cmakers, read_full_lt_by_label
+from openquake.hazardlib.contexts import (
+    get_cmakers, read_cmakers, read_full_lt_by_label)
 from openquake.hazardlib.calc import hazard_curve
 from openquake.hazardlib.calc import disagg
 from openquake.hazardlib.map_array import (
-    RateMap, MapArray, rates_dt, check_hmaps, gen_chunks)
-from openquake.commonlib import calc
+    RateMap, MapArray, rates_dt, check_hmaps, gen_chunks,
+    compute_hazard_maps)
+from openquake.commonlib import calc, datastore, readinput
 from openquake.calculators import base, getters, preclassical, views
 
 get_weight = operator.attrgetter('weight')
@@ -49,6 +55,26 @@ TWO24 = 2 ** 24
 TWO30 = 2 ** 30
 TWO32 = 2 ** 32
 GZIP = 'gzip'
+# parameters not affecting the rates, ignored when comparing the
+# parameters of an incremental calculation with the previous one
+INCREMENTAL_IGNORE = {
+    'description', 'base_path', 'inputs', 'export_dir', 'exports',
+    'all_cost_types', 'req_site_params', 'mags_by_trt', 'split_time',
+    'concurrent_tasks', 'hazard_calculation_id', 'incremental_calculation_id',
+    'number_of_logic_tree_samples', 'random_seed', 'individual_rlzs',
+    'individual_curves', 'mean', 'std', 'max', 'quantiles',
+    'quantile_accuracy', 'poes', 'hazard_maps', 'uniform_hazard_spectra'}
+# inputs which are compared via the signatures or the site collection
+INCREMENTAL_INPUTS = {'job_ini', 'source_model_logic_tree', 'source_model',
+                      'gsim_logic_tree', 'site_model', 'sites'}
+# source attributes depending on the position of the source in the
+# composite source model or on the calculation, not affecting the rates
+VOLATILE = {'id', 'grp_id', 'trt_smr', 'trt_smrs', 'branch', 'sampling',
+            'checksum', 'dt', 'nsites', 'esites', 'weight', 'offset'}
+# info about the tasks with stored rates, used to resume a calculation
+task_done_dt = numpy.dtype([
+    ('task', U32), ('grp_id', U16), ('nrupts', I64), ('cfactor', (F64, 2)),
+    ('nrates', I64), ('nslices', I64)])
 BUFFER = 1.5  # enlarge the pointsource_distance sphere to fix the weight;
 # with BUFFER = 1 we would have lots of apparently light sources
 # collected together in an extra-slow task, as it happens in SHARE
@@ -125,6 +151,78 @@ def store_ctxs(dstore, rupdata, grp_id):
             hdf5.extend(dstore['rup/' + par], numpy.full(nr, numpy.nan))
 
 
+def get_signatures(csm, cmakers):
+    """
+    :param csm: a CompositeSourceModel
+    :param cmakers: a ContextMakerSequence
+    :returns: a list of signatures, one per ContextMaker, and a dictionary
+              (source_id, checksum) -> (grp_id, src.id)
+
+    The signature of a ContextMaker is determined by its tectonic region
+    type, magnitudes and gsims and by the checksums of its sources:
+    the rates associated to ContextMakers with the same signature are equal.
+    """
+    keys = [[] for _ in cmakers]
+    srcdic = {}
+    for sg in csm.src_groups:
+        for src in sg:
+            dic = {k: v for k, v in vars(src).items() if k not in VOLATILE}
+            key = src.source_id, zlib.adler32(pickle.dumps(dic, protocol=4))
+            keys[cmakers.inverse[src.grp_id]].append(key)
+            srcdic[key] = src.grp_id, src.id
+    sigs = []
+    for cm, ks in zip(cmakers, keys):
+        gsims = tuple(str(gsim) for gsim in cm.gsims)
+        sigs.append((cm.trt, tuple(cm.mags), gsims, tuple(sorted(ks))))
+    return sigs, srcdic
+
+
+def _input_files(oq):
+    # input files not entering in the signatures nor in the site collection
+    fnames = []
+    for key, val in sorted(oq.inputs.items()):
+        if key in INCREMENTAL_INPUTS:
+            continue
+        elif isinstance(val, str):
+            fnames.append(val)
+        elif isinstance(val, dict):
+            fnames.extend(val.values())
+        else:
+            fnames.extend(val)
+    return fnames
+
+
+def check_incremental(prev, dstore):
+    """
+    :param prev: the DataStore of the previous calculation
+    :param dstore: the DataStore of the current calculation
+    :returns: the reason why the previous calculation cannot be reused or ''
+    """
+    if 'source_data' not in prev:
+        return 'it did not complete'
+    dics = []
+    for ds in (prev, dstore):
+        oq = ds['oqparam']
+        dic = json.loads(hdf5.dumps({k: v for k, v in vars(oq).items()
+                                     if k not in INCREMENTAL_IGNORE}))
+        try:
+            dic['input_files'] = readinput._checksum(_input_files(oq))
+        except OSError as exc:  # the input files were moved or removed
+            return str(exc)
+        dics.append(dic)
+    pdic, dic = dics
+    for par in sorted(set(pdic) | set(dic)):
+        if pdic.get(par) != dic.get(par):
+            return 'the parameter %s changed' % par
+    parray, array = prev['sitecol'].array, dstore['sitecol'].array
+    if len(parray) != len(array):
+        return 'the number of sites changed'
+    for name in set(parray.dtype.names) & set(array.dtype.names):
+        if not numpy.array_equal(parray[name], array[name]):
+            return 'the site parameter %s changed' % name
+    return ''
+
+
 #  ########################### task functions ############################ #
 
 def save_rates(rmap, num_chunks, h5, mon=None):
@@ -190,6 +288,18 @@ def classical_disagg(grp_keys, tilegetter, cmaker, dstore, monitor):
                 yield result
 
 
+def _task_key(grp_keys, tilegetter, ilabel):
+    # identify a task, used when resuming a calculation
+    return '%s@%d:%s' % (' '.join(grp_keys), tilegetter.tileno, ilabel)
+
+
+def _weighted(items, weight):
+    # items with a weight, used by the task scheduler in the Starmap
+    lst = parallel.List(items)
+    lst.weight = weight
+    return lst
+
+
 def _split_src(srcs, n):
     for i in range(n):
         blk = srcs[i::n]
@@ -197,6 +307,20 @@ def _split_src(srcs, n):
             yield blk
 
 
+def _num_splits(grp_keys, nsrcs, split_time, monitor):
+    # predict the task duration from the time per unit of weight measured
+    # by the Starmap on the completed tasks; returns 0 if unknown
+    sec_per_weight = getattr(monitor, 'sec_per_weight', 0)
+    weight = getattr(grp_keys, 'weight', 0)
+    if not sec_per_weight or not weight:
+        return 0
+    if getattr(monitor, 'tail', False):
+        # there are idle cores waiting, split more aggressively
+        split_time /= 2
+    pred = weight * sec_per_weight
+    return min(int(numpy.ceil(pred / split_time)), nsrcs)
+
+
 def classical(grp_keys, tilegetter, cmaker, dstore, monitor):
     """
     Call the classical calculator in hazardlib with many sites.
@@ -208,13 +332,25 @@ def classical(grp_keys, tilegetter, cmaker, dstore, monitor):
     grps, sitecol = read_groups_sitecol(dstore, grp_keys)
     fulltask = all('-' not in grp_key for grp_key in grp_keys)
     sites = tilegetter(sitecol, cmaker.ilabel)
+    splittable = (len(grps) == 1 and len(grps[0]) >= 2 and
+                  not grps[0].multifault)
+    # NB: multifaults are not split to avoid transferring the dparam cache
+    n = _num_splits(grp_keys, len(grps[0]), cmaker.oq.split_time, monitor)
     if fulltask:
         # return raw array that will be stored immediately
         result = baseclassical(grps, sites, cmaker, remove_zeros=True)
         result['rmap'] = result['rmap'].to_array(cmaker.gid)
+        result['task_key'] = _task_key(grp_keys, tilegetter, cmaker.ilabel)
         yield result
-    elif len(grps) == 1 and len(grps[0]) >= 2 and not grps[0].multifault:
-        # NB: multifaults are not split to avoid transferring the dparam cache
+    elif splittable and n > 1:
+        # the task is predicted to be slow, send the blocks to idle cores
+        srcs = list(grps[0])
+        b0, *blks = _split_src(srcs, n)
+        for blk in blks:
+            blk = _weighted(blk, grp_keys.weight * len(blk) / len(srcs))
+            yield baseclassical, blk, tilegetter, cmaker, True, dstore
+        yield baseclassical(b0, sites, cmaker, True)
+    elif splittable:
         b0, *blks = _split_src(list(grps[0]), 5)
         t0 = time.time()
         res = baseclassical(b0, sites, cmaker, True)
@@ -252,9 +388,133 @@ def fast_mean(pgetter, monitor=parallel.Monitor()):
         # computing the hmaps is very fast too
         pmap_by_kind['hmaps-stats'] = calc.make_hmaps(
             pmap_by_kind['hcurves-stats'], pgetter.imtls, pgetter.poes)
+    if pgetter.hazard_maps_only:
+        del pmap_by_kind['hcurves-stats']
     return pmap_by_kind
 
 
+def _hmaps(pcs, imtls, poes):
+    # vectorized hazard maps from curves of shape (n, L, R),
+    # returns an array of shape (n, M, P, R)
+    n, _L, R = pcs.shape
+    hmaps = numpy.zeros((n, len(imtls), len(poes), R))
+    for m, imt in enumerate(imtls):
+        curves = pcs[:, imtls(imt)].transpose(0, 2, 1).reshape(n * R, -1)
+        hmaps[:, m] = compute_hazard_maps(curves, imtls[imt], poes).reshape(
+            n, R, -1).transpose(0, 2, 1)
+    return hmaps
+
+
+def _fill(pgetter, pmaps, idxs, pcs, imtls):
+    # store the curves of shape (n, L, R) in R MapArrays, or directly
+    # the hazard maps if hazard_maps_only is set
+    if pgetter.hazard_maps_only:
+        arr = _hmaps(pcs, imtls, pgetter.poes)  # shape (n, M, P, R)
+    else:
+        arr = pcs.reshape(len(pcs), len(imtls), -1, pcs.shape[-1])
+    for r, pmap in enumerate(pmaps):
+        pmap.array[idxs] = arr[..., r]
+
+
+def _get_hcurves(pgetter, sids, amplifier, rlzs=slice(None)):
+    pcs = pgetter.get_hcurves(sids, rlzs)  # shape (n, L, R)
+    if amplifier:
+        # NB: the hcurves have soil levels != IMT levels
+        with hdf5.File(pgetter.filenames[0], 'r') as f:
+            ampcode = f['sitecol'].ampcode
+        pcs = numpy.array([amplifier.amplify(ampcode[sid], pc)
+                           for sid, pc in zip(sids, pcs)])
+    return pcs
+
+
+def _postclassical_sketch(pgetter, sids, sidx, hstats, individual_rlzs,
+                          amplifier, imtls, wget, pmap_by_kind):
+    # same as _postclassical, but streaming over blocks of realizations;
+    # the quantiles are computed with mergeable sketches
+    L = imtls.size
+    R = pgetter.R
+    n = len(sids)
+    idxs = sidx[sids]
+    kind = 'hmaps' if pgetter.hazard_maps_only else 'hcurves'
+    wL = numpy.zeros((R, L))  # realization weights for each level
+    for imt in imtls:
+        if wget.weights.shape[1] > 1:  # IMT-dependent weights
+            wL[:, imtls(imt)] = wget(None, imt)[:, None]
+        else:
+            wL[:, imtls(imt)] = wget.weights[:, -1:]
+    maxval = 100. if pgetter.use_rates else 1.  # the rates are clipped
+    sketch = QuantileSketch((n, L), pgetter.quantile_accuracy, maxval=maxval)
+    momenta = numpy.zeros((3, n, L))
+    maxs = numpy.zeros((n, L))
+    rblock = max(1, 2**21 // (n * L))
+    for start in range(0, R, rblock):
+        rlzs = slice(start, start + rblock)
+        pcs = _get_hcurves(pgetter, sids, amplifier, rlzs)
+        if R == 1 or individual_rlzs:
+            _fill(pgetter, pmap_by_kind[kind + '-rlzs'][rlzs],
+                  idxs, pcs, imtls)
+        vals = numpy.moveaxis(pcs, -1, 0)  # shape (r, n, L)
+        if pgetter.use_rates:
+            vals = disagg.to_rates(vals)
+        ws = numpy.broadcast_to(wL[rlzs, None], vals.shape)
+        momenta[0] += ws.sum(axis=0)
+        momenta[1] += (ws * vals).sum(axis=0)
+        momenta[2] += (ws * vals**2).sum(axis=0)
+        maxs = numpy.maximum(maxs, vals.max(axis=0))
+        sketch.add(vals, ws)
+    nodata = momenta[0] == 0  # IMTs with zero weight
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = momenta[1] / momenta[0]
+        var = momenta[2] - 2 * mean * momenta[1] + mean**2 * momenta[0]
+    for s, statname in enumerate(hstats):
+        if statname == 'mean':
+            sc = mean
+        elif statname == 'std':
+            sc = numpy.sqrt(numpy.maximum(var, 0.))
+        elif statname == 'max':
+            sc = maxs
+        else:  # quantile-XXX
+            sc = sketch.quantile(float(statname[9:]))
+        if pgetter.use_rates:
+            sc = disagg.to_probs(sc)
+        sc[nodata] = 0.
+        _fill(pgetter, pmap_by_kind[kind + '-stats'][s:s + 1],
+              idxs, sc[:, :, None], imtls)
+
+
+def _postclassical(pgetter, sids, sidx, hstats, individual_rlzs, amplifier,
+                   imtls, wget, pmap_by_kind):
+    # populate pmap_by_kind with the curves (or the hazard maps)
+    # for a block of sites
+    R = pgetter.R
+    kind = 'hmaps' if pgetter.hazard_maps_only else 'hcurves'
+    pcs = _get_hcurves(pgetter, sids, amplifier)  # shape (n, L, R)
+    ok = pcs.sum(axis=(1, 2)) > 0  # discard the sites with no data
+    pcs = pcs[ok]
+    idxs = sidx[sids[ok]]
+    if len(idxs) == 0:
+        return
+    if R == 1 or individual_rlzs:
+        _fill(pgetter, pmap_by_kind[kind + '-rlzs'], idxs, pcs, imtls)
+    if hstats:
+        scs = numpy.concatenate([
+            getters.build_stat_curve(pcs, imtls, stat, wget, pgetter.use_rates)
+            for stat in hstats.values()], axis=2)  # shape (n, L, S)
+        _fill(pgetter, pmap_by_kind[kind + '-stats'], idxs, scs, imtls)
+
+
+def _postclassical_reduced(pgetter, sids, sidx, hstats, reducer, imtls,
+                           pmap_by_kind):
+    # populate pmap_by_kind with the statistics for a block of sites,
+    # computed as sums over the gids without building the realizations
+    kind = 'hmaps' if pgetter.hazard_maps_only else 'hcurves'
+    scs = pgetter.get_stats(sids, reducer, imtls, list(hstats))
+    ok = scs.sum(axis=(1, 2)) > 0  # discard the sites with no data
+    if ok.any():
+        _fill(pgetter, pmap_by_kind[kind + '-stats'], sidx[sids[ok]],
+              scs[ok], imtls)
+
+
 def postclassical(pgetter, hstats, individual_rlzs, amplifier, monitor):
     """
     :param pgetter: a :class:`openquake.commonlib.getters.MapGetter`
@@ -272,8 +532,6 @@ def postclassical(pgetter, hstats, individual_rlzs, amplifier, monitor):
 
     if amplifier:
         # amplification is meant for few sites, i.e. no tiling
-        with hdf5.File(pgetter.filenames[0], 'r') as f:
-            ampcode = f['sitecol'].ampcode
         imtls = DictArray({imt: amplifier.amplevels
                            for imt in pgetter.imtls})
     else:
@@ -284,38 +542,54 @@ def postclassical(pgetter, hstats, individual_rlzs, amplifier, monitor):
     L1 = L // M
     R = pgetter.R
     S = len(hstats)
+    # with hazard_maps_only the hmaps are computed block by block
+    # and the hcurves are not returned
+    kind, K = ('hmaps', len(poes)) if pgetter.hazard_maps_only else (
+        'hcurves', L1)
     pmap_by_kind = {}
     if R == 1 or individual_rlzs:
-        pmap_by_kind['hcurves-rlzs'] = [
-            MapArray(sids, M, L1).fill(0) for r in range(R)]
+        pmap_by_kind[kind + '-rlzs'] = [
+            MapArray(sids, M, K).fill(0) for r in range(R)]
     if hstats:
-        pmap_by_kind['hcurves-stats'] = [
-            MapArray(sids, M, L1).fill(0) for r in range(S)]
+        pmap_by_kind[kind + '-stats'] = [
+            MapArray(sids, M, K).fill(0) for r in range(S)]
     with monitor('compute stats', measuremem=False):
         sidx = MapArray(sids, 1, 1).fill(0).sidx
-        for sid in sids:
-            idx = sidx[sid]
-            pc = pgetter.get_hcurve(sid)  # shape (L, R)
-            if amplifier:
-                pc = amplifier.amplify(ampcode[sid], pc)
-                # NB: the hcurve have soil levels != IMT levels
-            if pc.sum() == 0:  # no data
+        if len(pgetter.ilabels):
+            ilabels = pgetter.ilabels[sids]
+        else:
+            ilabels = numpy.zeros(len(sids), int)
+        # process the sites in blocks, to keep the (n, L, R) arrays small
+        if pgetter.quantile_accuracy:
+            process = _postclassical_sketch
+            nbuckets = QuantileSketch((), pgetter.quantile_accuracy).B
+            blocksize = max(1, 2**22 // (L * nbuckets))
+        else:
+            process = _postclassical
+            blocksize = max(1, 2**21 // (pgetter.L * R))
+        # in case of full enumeration mean, std and max can be computed
+        # with a cost proportional to Gt and not to R
+        reduced = (pgetter.reducers and not amplifier and hstats and
+                   set(hstats) <= {'mean', 'std', 'max'} and
+                   not (R == 1 or individual_rlzs))
+        for ilabel in numpy.unique(ilabels):
+            wget = pgetter.wgets[ilabel]
+            isids = sids[ilabels == ilabel]
+            reducer = pgetter.reducers[ilabel] if reduced else None
+            if reducer:
+                bsize = max(1, 2**21 // (pgetter.L * (pgetter.Gt + 1)))
+                for start in range(0, len(isids), bsize):
+                    block = isids[start:start + bsize]
+                    _postclassical_reduced(pgetter, block, sidx, hstats,
+                                           reducer, imtls, pmap_by_kind)
                 continue
-            if R == 1 or individual_rlzs:
-                for r in range(R):
-                    pmap_by_kind['hcurves-rlzs'][r].array[idx] = (
-                        pc[:, r].reshape(M, L1))
-            if hstats:
-                if len(pgetter.ilabels):
-                    wget = pgetter.wgets[pgetter.ilabels[sid]]
-                else:
-                    wget = pgetter.wgets[0]
-                for s, (statname, stat) in enumerate(hstats.items()):
-                    sc = getters.build_stat_curve(
-                        pc, imtls, stat, wget, pgetter.use_rates)
-                    arr = sc.reshape(M, L1)
-                    pmap_by_kind['hcurves-stats'][s].array[idx] = arr
+            for start in range(0, len(isids), blocksize):
+                block = isids[start:start + blocksize]
+                process(pgetter, block, sidx, hstats, individual_rlzs,
+                        amplifier, imtls, wget, pmap_by_kind)
 
+    if pgetter.hazard_maps_only:
+        return pmap_by_kind
     if poes and (R == 1 or individual_rlzs):
         pmap_by_kind['hmaps-rlzs'] = calc.make_hmaps(
             pmap_by_kind['hcurves-rlzs'], imtls, poes)
@@ -400,9 +674,11 @@ class ClassicalCalculator(base.HazardCalculator):
 
         sdata = dic.pop('source_data')
         grp_id = sdata['grp_id'][0]
+        nrupts = sum(sdata['nrupts'])
+        cfactor = dic.pop('cfactor')
         self.source_data += sdata
-        self.rel_ruptures[grp_id] += sum(sdata['nrupts'])
-        self.cfactor += dic.pop('cfactor')
+        self.rel_ruptures[grp_id] += nrupts
+        self.cfactor += cfactor
         self.dparam_mb = max(dic.pop('dparam_mb'), self.dparam_mb)
         self.source_mb = max(dic.pop('source_mb'), self.source_mb)
 
@@ -426,11 +702,165 @@ class ClassicalCalculator(base.HazardCalculator):
             with self.monitor('storing rates', measuremem=True):
                 chunkno = dic.get('chunkno')  # None with the current impl.
                 _store(rmap, self.num_chunks, self.datastore, chunkno)
+                self.checkpoint(dic['task_key'], grp_id, nrupts, cfactor)
         else:
             # aggregating rates is ultra-fast compared to storing
             self.rmap[grp_id] += rmap
         return acc
 
+    def checkpoint(self, task_key, grp_id, nrupts, cfactor):
+        """
+        Record a task with stored rates, so that the calculation can be
+        resumed if killed
+        """
+        dstore = self.datastore
+        row = (self.task_idx[task_key], grp_id, nrupts, cfactor,
+               len(dstore['_rates/sid']), len(dstore['_rates/slice_by_idx']))
+        hdf5.extend(dstore['task_done'], numpy.array([row], task_done_dt))
+        dstore.flush()
+
+    def resume(self, allargs, keys):
+        """
+        Copy the rates stored by the parent calculation (a killed job)
+        and discard the tasks already done.
+
+        :param allargs: the arguments of the tasks
+        :param keys: the grp_keys of the tasks
+        :returns: the arguments of the tasks to run
+        """
+        parent = self.datastore.parent
+        if 'task_done' not in parent:
+            raise InvalidFile('%s: resume=true but calc_%d has no completed '
+                              'tasks' % (self.oqparam.inputs['job_ini'],
+                                         parent.calc_id))
+        if not numpy.array_equal(parent['grp_keys'][:], keys):
+            raise InvalidFile('%s: resume=true but calc_%d has different '
+                              'tasks' % (self.oqparam.inputs['job_ini'],
+                                         parent.calc_id))
+        done = parent['task_done'][:]
+        if len(done) == 0:
+            return allargs
+        for name in rates_dt.names:
+            hdf5.extend(self.datastore['_rates/' + name],
+                        parent['_rates/' + name][:done[-1]['nrates']])
+        hdf5.extend(self.datastore['_rates/slice_by_idx'],
+                    parent['_rates/slice_by_idx'][:done[-1]['nslices']])
+        hdf5.extend(self.datastore['task_done'], done)
+        self.cfactor += done['cfactor'].sum(axis=0)
+        for grp_id, nrupts in zip(done['grp_id'], done['nrupts']):
+            self.rel_ruptures[grp_id] += nrupts
+        logging.warning('Resuming calc_%d: %d of %d tasks already done',
+                        parent.calc_id, len(done), len(allargs))
+        skip = set(done['task'])
+        return [args for i, args in enumerate(allargs) if i not in skip]
+
+    def incremental(self, allargs):
+        """
+        Copy from the previous calculation the rates of the ContextMakers
+        with unchanged sources and gsims and discard the corresponding tasks.
+
+        :param allargs: the arguments of the tasks
+        :returns: the arguments of the tasks to run
+        """
+        calc_id = self.oqparam.incremental_calculation_id
+        with datastore.read(calc_id, read_parent=False) as prev:
+            reason = check_incremental(prev, self.datastore)
+            if reason:
+                logging.warning('Cannot reuse calc_%s since %s, performing '
+                                'a full calculation', calc_id, reason)
+                return allargs
+            cmakers = self.cmdict['Default']
+            sigs, srcdic = get_signatures(self.csm, cmakers)
+            full_lt = prev['full_lt'].init()
+            pcmakers = read_cmakers(prev, full_lt)
+            psigs, psrcdic = get_signatures(read_csm(prev, full_lt), pcmakers)
+            pidx = {sig: i for i, sig in enumerate(psigs)}
+            gidmap = {}  # previous gid -> gid
+            for cm, sig in zip(cmakers, sigs):
+                if sig in pidx:
+                    gidmap.update(zip(pcmakers[pidx[sig]].gid, cm.gid))
+            reused = set(gidmap.values())
+            grpmap = {}  # previous grp_id -> grp_id
+            srcmap = {}  # previous src.id -> src.id
+            for key, (pgrp_id, psrc_id) in psrcdic.items():
+                if key in srcdic:
+                    grp_id, src_id = srcdic[key]
+                    if cmakers[cmakers.inverse[grp_id]].gid[0] in reused:
+                        grpmap[pgrp_id] = grp_id
+                        srcmap[psrc_id] = src_id
+            if gidmap:
+                with self.monitor('copying rates', measuremem=True):
+                    self._copy_rates(prev, gidmap)
+                    self._copy_source_data(prev, grpmap)
+                    if self.few_sites:
+                        self._copy_rup(prev, grpmap, srcmap)
+        for grp_id, rmap in list(self.rmap.items()):
+            if reused.issuperset(rmap.gdic):
+                del self.rmap[grp_id]
+        args = [args for args in allargs if args[2].gid[0] not in reused]
+        logging.warning('Reusing %d of %d gsims from calc_%s: %d of %d tasks '
+                        'to run', len(reused), cmakers.Gt, calc_id, len(args),
+                        len(allargs))
+        self.reused = bool(reused)
+        return args
+
+    def _copy_rates(self, prev, gidmap):
+        # copy the rates of the given gids, one chunk at the time
+        pgids = U16(list(gidmap))
+        newgid = numpy.zeros(pgids.max() + 1, U16)
+        newgid[pgids] = list(gidmap.values())
+        for fname in getters.get_rates_fnames(prev):
+            with hdf5.File(fname, 'r') as h5:
+                slices = h5['_rates/slice_by_idx'][:]
+                for idx in numpy.unique(slices['idx']):
+                    slcs = getters.merge_slices(slices[slices['idx'] == idx])
+                    df = h5.read_df('_rates', slices=slcs)
+                    ok = numpy.isin(df.gid.to_numpy(), pgids)
+                    if not ok.any():
+                        continue
+                    rates = numpy.zeros(ok.sum(), rates_dt)
+                    for name in rates_dt.names:
+                        rates[name] = df[name].to_numpy()[ok]
+                    rates['gid'] = newgid[rates['gid']]
+                    _store(rates, self.num_chunks, self.datastore)
+
+    def _copy_source_data(self, prev, grpmap):
+        # copy the source_data of the given groups and their rel_ruptures
+        df = prev.read_df('source_data')
+        df = df[df.grp_id.isin(list(grpmap))]
+        df['grp_id'] = [grpmap[grp_id] for grp_id in df.grp_id]
+        for col in df.columns:
+            if col != 'impact':  # recomputed in store_info
+                self.source_data[col].extend(df[col].to_numpy())
+        for grp_id, nrupts in df.groupby('grp_id').nrupts.sum().items():
+            self.rel_ruptures[grp_id] += nrupts
+
+    def _copy_rup(self, prev, grpmap, srcmap):
+        # copy the contexts of the given groups, used in disaggregation
+        pgrp_ids = prev['rup/grp_id'][:]
+        ok = numpy.isin(pgrp_ids, list(grpmap))
+        if not ok.any():
+            return
+        psrc_ids = U32(list(srcmap))
+        newsrc = numpy.zeros(psrc_ids.max() + 1, U32)
+        newsrc[psrc_ids] = list(srcmap.values())
+        nr = ok.sum()
+        for par in self.datastore['rup']:
+            if par == 'grp_id':
+                vals = U16([grpmap[grp_id] for grp_id in pgrp_ids[ok]])
+            elif par in prev['rup']:
+                vals = prev['rup/' + par][:][ok]
+            else:
+                vals = numpy.full(nr, numpy.nan)
+            if par == 'src_id':
+                vals = newsrc[vals]
+            elif par == 'rup_id':
+                vals = I64(newsrc[vals // TWO30]) * TWO30 + vals % TWO30
+            if par == 'probs_occur':
+                self.datastore.hdf5.save_vlen('rup/probs_occur', list(vals))
+            else:
+                hdf5.extend(self.datastore['rup/' + par], vals)
+
     def create_rup(self):
         """
         Create the rup datasets *before* starting the calculation
@@ -481,6 +911,7 @@ class ClassicalCalculator(base.HazardCalculator):
                 self.cmdict['Default'])
 
         self.cfactor = numpy.zeros(2)
+        self.reused = False  # set by .incremental
         self.dparam_mb = 0
         self.source_mb = 0
         self.rel_ruptures = AccumDict(accum=0)  # grp_id -> rel_ruptures
@@ -502,6 +933,7 @@ class ClassicalCalculator(base.HazardCalculator):
         self.datastore.create_df(
             '_rates', [(n, rates_dt[n]) for n in rates_dt.names], GZIP)
         self.datastore.create_dset('_rates/slice_by_idx', getters.slice_dt)
+        self.datastore.create_dset('task_done', task_done_dt)
 
     def check_memory(self, N, L, maxw):
         """
@@ -548,7 +980,7 @@ class ClassicalCalculator(base.HazardCalculator):
         self.source_data = AccumDict(accum=[])
         sgs, ds = self._pre_execute()
         self._execute(sgs, ds)
-        if self.cfactor[0] == 0:
+        if self.cfactor[0] == 0 and not self.reused:
             if self.N == 1:
                 logging.error('The site is far from all seismic sources'
                               ' included in the hazard model')
@@ -602,13 +1034,14 @@ class ClassicalCalculator(base.HazardCalculator):
         if oq.split_time is None:
             oq.split_time = max(max_gb * 100, 10)
         num_blocks = 0
-        for cmaker, tilegetters, grp_keys, atomic in data:
+        for cmaker, tilegetters, grp_keys, weights, atomic in data:
             num_blocks += sum('-' in key for key in grp_keys)
             if self.few_sites or oq.disagg_by_src or len(grp_keys) > 1:
                 grp_id = int(grp_keys[0].split('-')[0])
                 self.rmap[grp_id] = RateMap(self.sitecol.sids, L, cmaker.gid)
             if self.few_sites or oq.disagg_by_src and cmaker.ilabel is None:
                 assert len(tilegetters) == 1, "disagg_by_src has no tiles"
+            T = len(tilegetters)
             for tgetter in tilegetters:
                 if len(tgetter(self.sitecol, cmaker.ilabel)) == 0:
                     # can happen for some ilabel
@@ -616,11 +1049,13 @@ class ClassicalCalculator(base.HazardCalculator):
                 elif atomic:
                     # JPN, send the grp_keys together, they will all send
                     # rates to the RateMap associated to the first grp_id
-                    allargs.append((grp_keys, tgetter, cmaker, ds))
+                    keys = _weighted(grp_keys, sum(weights) / T)
+                    allargs.append((keys, tgetter, cmaker, ds))
                 else:
                     # send a grp_key at the time
-                    for grp_key in grp_keys:
-                        allargs.append(([grp_key], tgetter, cmaker, ds))
+                    for grp_key, weight in zip(grp_keys, weights):
+                        keys = _weighted([grp_key], weight / T)
+                        allargs.append((keys, tgetter, cmaker, ds))
             maxtiles = max(maxtiles, len(tilegetters))
         if num_blocks and not self.few_sites:
             logging.info(f'{oq.split_time=:.0f} seconds')
@@ -631,6 +1066,13 @@ class ClassicalCalculator(base.HazardCalculator):
         keys = numpy.array([' '.join(args[0]).encode('ascii')
                             for args in allargs])
         self.datastore.create_dset('grp_keys', keys)
+        self.task_idx = {_task_key(grp_keys, tgetter, cmaker.ilabel): i
+                         for i, (grp_keys, tgetter, cmaker, _ds)
+                         in enumerate(allargs)}
+        if oq.resume:
+            allargs = self.resume(allargs, keys)
+        elif oq.incremental_calculation_id is not None:
+            allargs = self.incremental(allargs)
 
         # log info about the heavy sources
         srcs = [src for src in self.csm.get_sources() if src.weight]
@@ -646,6 +1088,8 @@ class ClassicalCalculator(base.HazardCalculator):
                 classical_disagg, allargs, h5=self.datastore.hdf5)
         else:
             smap = parallel.Starmap(classical, allargs, h5=self.datastore.hdf5)
+            # submit the heaviest tasks first, to reduce the tail
+            smap.heaviest_first = True
         acc = smap.reduce(self.agg_dicts, AccumDict(accum=0.))
         self._post_execute(acc)
 
@@ -681,6 +1125,8 @@ class ClassicalCalculator(base.HazardCalculator):
         """
         The sum of the mean_rates_by_src must correspond to the mean_rates
         """
+        if self.oqparam.hazard_maps_only:  # no hcurves-stats
+            return
         try:
             exp = disagg.to_rates(self.datastore['hcurves-stats'][0, 0])
         except KeyError:  # if there are no ruptures close to the site
@@ -777,25 +1223,27 @@ class ClassicalCalculator(base.HazardCalculator):
             L = oq.imtls.size
         L1 = self.L1 = L // M
         S = len(hstats)
-        if R == 1 or oq.individual_rlzs:
+        rlzs = R == 1 or oq.individual_rlzs
+        curves = not oq.hazard_maps_only
+        if rlzs and curves:
             self.datastore.create_dset('hcurves-rlzs', F32, (N, R, M, L1))
             self.datastore.set_shape_descr(
                 'hcurves-rlzs', site_id=N, rlz_id=R, imt=imts, lvl=L1)
-            if oq.poes:
-                self.datastore.create_dset('hmaps-rlzs', F32, (N, R, M, P))
-                self.datastore.set_shape_descr(
-                    'hmaps-rlzs', site_id=N, rlz_id=R,
-                    imt=list(oq.imtls), poe=oq.poes)
-        if hstats:
+        if rlzs and oq.poes:
+            self.datastore.create_dset('hmaps-rlzs', F32, (N, R, M, P))
+            self.datastore.set_shape_descr(
+                'hmaps-rlzs', site_id=N, rlz_id=R,
+                imt=list(oq.imtls), poe=oq.poes)
+        if hstats and curves:
             self.datastore.create_dset('hcurves-stats', F32, (N, S, M, L1))
             self.datastore.set_shape_descr(
                 'hcurves-stats', site_id=N, stat=list(hstats),
                 imt=imts, lvl=numpy.arange(L1))
-            if oq.poes:
-                self.datastore.create_dset('hmaps-stats', F32, (N, S, M, P))
-                self.datastore.set_shape_descr(
-                    'hmaps-stats', site_id=N, stat=list(hstats),
-                    imt=list(oq.imtls), poe=oq.poes)
+        if hstats and oq.poes:
+            self.datastore.create_dset('hmaps-stats', F32, (N, S, M, P))
+            self.datastore.set_shape_descr(
+                'hmaps-stats', site_id=N, stat=list(hstats),
+                imt=list(oq.imtls), poe=oq.poes)
         return N, S, M, P, L1
 
     # called by execute before post_execute
@@ -816,7 +1264,7 @@ class ClassicalCalculator(base.HazardCalculator):
             logging.warning('No rates were generated')
             return
         self.hazard = {}  # kind -> array
-        hcbytes = 8 * N * S * M * L1
+        hcbytes = 0 if oq.hazard_maps_only else 8 * N * S * M * L1
         hmbytes = 8 * N * S * M * P if oq.poes else 0
         if hcbytes:
             logging.info('Producing %s of hazard curves', humansize(hcbytes))
@@ -846,7 +1294,8 @@ class ClassicalCalculator(base.HazardCalculator):
             self.plot_hmaps()
 
             # check numerical stability of the hmaps around the poes
-            if self.N <= oq.max_sites_disagg and not self.amplifier:
+            if (self.N <= oq.max_sites_disagg and not self.amplifier
+                    and not oq.hazard_maps_only):
                 mean_hcurves = self.datastore.sel(
                     'hcurves-stats', stat='mean')[:, 0]
                 check_hmaps(mean_hcurves, oq.imtls, oq.poes)
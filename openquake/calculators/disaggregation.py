@@ -150,6 +150,11 @@ class DisaggregationCalculator(base.HazardCalculator):
         """
         if self.N >= 32768:
             raise ValueError('You can disaggregate at max 32,768 sites')
+        parent = self.datastore.parent
+        if parent and parent.hazard_maps_only:
+            raise ValueError('Cannot disaggregate %s: it was run with '
+                             'hazard_maps_only, so there are no curves'
+                             % parent)
         few = self.oqparam.max_sites_disagg
         if self.N > few:
             raise ValueError(
@@ -32,6 +32,7 @@ from openquake.hazardlib import imt, valid, logictree, InvalidFile
 from openquake.hazardlib.countries import ALIASES
 from openquake.hazardlib.geo.packager import fiona
 from openquake.hazardlib.geo.utils import geolocate
+from openquake.hazardlib.site import SiteCollection
 from openquake.hazardlib.map_array import MapArray, get_mean_curve
 from openquake.hazardlib.stats import geom_avg_std, compute_stats
 from openquake.hazardlib.calc.stochastic import sample_ruptures
@@ -39,7 +40,8 @@ from openquake.hazardlib.contexts import (
     ContextMaker, FarAwayRupture, get_cmakers)
 from openquake.hazardlib.calc.filters import (
     close_ruptures, magstr, nofilter, getdefault, get_distances, SourceFilter)
-from openquake.hazardlib.calc.gmf import GmfComputer, TRUNCATION_THRESHOLD
+from openquake.hazardlib.calc.gmf import (
+    GmfComputer, TRUNCATION_THRESHOLD, set_mean_stds)
 from openquake.hazardlib.calc.conditioned_gmfs import (
     ConditionedGmfComputer, build_precomputed, conditioned)
 from openquake.hazardlib.calc.stochastic import get_rup_array, rupture_dt
@@ -68,6 +70,9 @@ F64 = numpy.float64
 TWO16 = 2 ** 16
 TWO24 = 2 ** 24
 TWO32 = numpy.float64(2 ** 32)
+# maximum number of contexts (i.e. rupture-site pairs) for which the mean
+# and stddevs are computed together in _event_based
+MAX_BATCH_CTXS = 50_000
 rup_dt = numpy.dtype(
     [('rup_id', I64), ('rrup', F32), ('time', F32), ('weight', F32),
      ('task_no', U16)])
@@ -204,9 +209,11 @@ def get_computer(cmaker, ebr, sites, sec_perils=(),
         oq._amplifier, sec_perils)
 
 
-def _event_based(proxies, cmaker, sec_perils, srcfilter, cmon, umon):
-    oq = cmaker.oq
-    se_dt = sig_eps_dt(oq.imtls)
+def _gen_batches(proxies, cmaker, sec_perils, srcfilter):
+    # yield lists of triples (proxy, computer, dt) with at most
+    # MAX_BATCH_CTXS contexts in total
+    batch = []
+    nctxs = 0
     for proxy in proxies:
         t0 = time.time()
         if proxy['mag'] < cmaker.min_mag:
@@ -214,23 +221,44 @@ def _event_based(proxies, cmaker, sec_perils, srcfilter, cmon, umon):
         sites = srcfilter.get_close_sites(proxy, cmaker.trt)
         if sites is None:  # filtered away
             continue
-        dic = dict(gmfdata={}, sig_eps=())
         try:
             ebr = proxy.to_ebr(cmaker.trt)
             computer = get_computer(cmaker, ebr, sites, sec_perils)
         except FarAwayRupture:
             continue
-        else:  # regular GMFs
+        batch.append((proxy, computer, time.time() - t0))
+        nctxs += computer.N
+        if nctxs >= MAX_BATCH_CTXS:
+            yield batch
+            batch = []
+            nctxs = 0
+    if batch:
+        yield batch
+
+
+def _event_based(proxies, cmaker, sec_perils, srcfilter, cmon, umon):
+    oq = cmaker.oq
+    se_dt = sig_eps_dt(oq.imtls)
+    for batch in _gen_batches(proxies, cmaker, sec_perils, srcfilter):
+        # compute mean and stddevs for all the ruptures in the batch
+        # with a single call per GSIM and magnitude
+        t0 = time.time()
+        set_mean_stds([computer for _, computer, _ in batch])
+        dt0 = (time.time() - t0) / len(batch)
+        for proxy, computer, dt in batch:
+            t0 = time.time()
+            dic = dict(gmfdata={}, sig_eps=())
             df = computer.compute_all(None, cmon, umon)
             if oq.mea_tau_phi:
                 mtp = numpy.array(computer.mea_tau_phi, GmfComputer.mtp_dt)
                 dic['mea_tau_phi'] = {col: mtp[col] for col in mtp.dtype.names}
-        dic['sig_eps'] = computer.build_sig_eps(se_dt)
-        dic['gmfdata'] = df
-        dt = time.time() - t0
-        dic['times'] = numpy.array([(proxy['id'], computer.ctx.rrup.min(), dt,
-                                     rup_weight(proxy), cmon.task_no)], rup_dt)
-        yield dic
+            dic['sig_eps'] = computer.build_sig_eps(se_dt)
+            dic['gmfdata'] = df
+            dt += dt0 + time.time() - t0
+            dic['times'] = numpy.array([(
+                proxy['id'], computer.ctx.rrup.min(), dt,
+                rup_weight(proxy), cmon.task_no)], rup_dt)
+            yield dic
 
 
 def event_based(allrups, cmakers, sids, secperils, dstore, monitor):
@@ -241,16 +269,23 @@ def event_based(allrups, cmakers, sids, secperils, dstore, monitor):
     smon = monitor('reading sites', measuremem=True)
     cmon = monitor('computing gmfs', measuremem=False)
     umon = monitor('updating gmfs', measuremem=False)
+    shared = getattr(monitor, 'shared', {})
     with smon:
-        with dstore as f:
-            try:
-                complete = f['complete']  # the current dstore
-            except KeyError:
-                complete = f['sitecol']
-        sites = complete.filtered(sids)
+        if 'complete' in shared:  # memory-mapped by the Starmap
+            with shared['complete'] as arr, shared['sids'] as sids:
+                complete = SiteCollection.from_(arr)
+                sites = complete.filtered(sids)
+        else:
+            with dstore as f:
+                try:
+                    complete = f['complete']  # the current dstore
+                except KeyError:
+                    complete = f['sitecol']
+            sites = complete.filtered(sids)
     kdt = KDTree(sites.xyz)  # instantiated once per task
     for rups, cmaker in zip(allrups, cmakers):
-        if not hasattr(cmaker, 'gmf_mon'):  # not already initialized
+        if getattr(cmaker, 'task_no', None) != monitor.task_no:
+            # not already initialized in this task
             cmaker.init_monitoring(monitor)
         # NB: the maximum distance can vary between TRTs/CMakers
         maxdist = cmaker.oq.maximum_distance(cmaker.trt)
@@ -481,7 +516,9 @@ def ntasks_by_model(cmaker_rups, concurrent_tasks):
 
 def get_allargs(oq, acc, filrups, calc):
     """
-    :returns: [(allrups, cmakers, sids, sec_perils, dstore), ...]
+    :returns: [(allrups, cmakers, None, sec_perils, dstore), ...]
+
+    NB: the site IDs are not pickled; they are memory-mapped by the Starmap
     """
     cmaker_rups = read_cmaker_rups(oq, acc, calc.datastore)
     p = sum(len(pairs) for pairs in cmaker_rups.values())
@@ -503,8 +540,7 @@ def get_allargs(oq, acc, filrups, calc):
                     rs.append(chrups)
                     nr += len(chrups)
             if cs:
-                allargs.append((rs, cs, calc.sitecol.sids,
-                                calc.sec_perils, calc.datastore))
+                allargs.append((rs, cs, None, calc.sec_perils, calc.datastore))
     assert len(allargs) < TWO16, len(allargs)
     assert nr == len(filrups), (nr, len(filrups))  # sanity check
     return allargs
@@ -551,6 +587,7 @@ def run(func, oq, rup0, calc):
     allargs = get_allargs(oq, acc, filrups, calc)
     dstore.swmr_on()
     smap = parallel.Starmap(func, h5=dstore.hdf5)
+    smap.mmap(complete=calc.sitecol.complete.array, sids=calc.sitecol.sids)
     if hasattr(calc, 'save_tmp'):
         calc.save_tmp(smap.monitor)
     task_no = os.environ.get('OQ_TASK_NO', '')
@@ -559,7 +596,10 @@ def run(func, oq, rup0, calc):
     else:
         for args in allargs:
             smap.submit(args)
-    smap.reduce(calc.agg_dicts)
+    # the outputs are saved in a background thread while reducing
+    calc.writer = hdf5.Writer(dstore.hdf5)
+    with calc.writer:
+        smap.reduce(calc.agg_dicts)
 
 
 def set_mags(oq, dstore):
@@ -831,34 +871,31 @@ class EventBasedCalculator(base.HazardCalculator):
         sav_mon = self.monitor('saving gmfs')
         primary = self.oqparam.get_primary_imtls()
         sec_imts = self.oqparam.sec_imts
+        writer = self.writer
         with sav_mon:
             gmfdata = result.pop('gmfdata')
             if len(gmfdata):
                 df = pandas.DataFrame(gmfdata)
-                dset = self.datastore['gmf_data/sid']
-                times = result.pop('times')
-                hdf5.extend(self.datastore['ruptimes'], times)
+                writer.extend('ruptimes', result.pop('times'))
                 if self.N >= SLICE_BY_EVENT_NSITES:
                     sbe = build_slice_by_event(
                         df.eid.to_numpy(), self.offset)
-                    hdf5.extend(self.datastore['gmf_data/slice_by_event'], sbe)
-                hdf5.extend(dset, df.sid.to_numpy())
-                hdf5.extend(self.datastore['gmf_data/eid'], df.eid.to_numpy())
+                    writer.extend('gmf_data/slice_by_event', sbe)
+                writer.extend('gmf_data/sid', df.sid.to_numpy())
+                writer.extend('gmf_data/eid', df.eid.to_numpy())
                 for im in primary:
-                    hdf5.extend(self.datastore[f'gmf_data/{im}'],
-                                df[im].to_numpy())
+                    writer.extend(f'gmf_data/{im}', df[im].to_numpy())
                 for sec_imt in sec_imts:
-                    hdf5.extend(self.datastore[f'gmf_data/{sec_imt}'],
-                                df[sec_imt].to_numpy())
-                sig_eps = result.pop('sig_eps')
-                hdf5.extend(self.datastore['gmf_data/sigma_epsilon'], sig_eps)
+                    writer.extend(f'gmf_data/{sec_imt}',
+                                  df[sec_imt].to_numpy())
+                writer.extend('gmf_data/sigma_epsilon', result.pop('sig_eps'))
                 self.offset += len(df)
 
             # optionally save mea_tau_phi
             mtp = result.pop('mea_tau_phi', None)
             if mtp:
                 for col, arr in mtp.items():
-                    hdf5.extend(self.datastore[f'mea_tau_phi/{col}'], arr)
+                    writer.extend(f'mea_tau_phi/{col}', arr)
         return acc
 
     def _read_scenario_ruptures(self):
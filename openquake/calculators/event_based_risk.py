@@ -37,6 +37,7 @@ U8 = numpy.uint8
 U16 = numpy.uint16
 U32 = numpy.uint32
 U64 = numpy.uint64
+I64 = numpy.int64
 F32 = numpy.float32
 F64 = numpy.float64
 TWO16 = 2 ** 16
@@ -44,6 +45,8 @@ TWO24 = 2 ** 24
 TWO32 = U64(2 ** 32)
 # AE_MAX chosen so that China runs with 3 GB per core
 AE_MAX = 1.2E8
+# maximum number of rows in the GMF buffer of an ebrisk task
+GMF_BUFFER_SIZE = 10_000_000
 get_n_occ = operator.itemgetter(1)
 
 
@@ -250,6 +253,109 @@ def set_oqparam(oq, assetcol, dstore):
     oq.A = assetcol['ordinal'].max() + 1
 
 
+class GmfBuffer(object):
+    """
+    Preallocated columnar buffer collecting the GMFs of many ruptures
+    into blocks with at most `size` rows and `ae_max` asset-events. The
+    GMFs on sites without assets are discarded. The arrays are allocated
+    once and reused for all blocks, so the memory does not grow with the
+    number of events; each block must be consumed before the next one is
+    generated.
+
+    :param num_assets: an array with the number of assets per site
+    :param size: maximum number of rows
+    :param ae_max: maximum number of asset-events
+    """
+    def __init__(self, num_assets, size=GMF_BUFFER_SIZE, ae_max=AE_MAX):
+        self.num_assets = num_assets
+        self.size = size
+        self.ae_max = ae_max
+        self.arrays = {}  # column -> array, allocated at the first append
+        self.n = 0  # number of stored rows
+        self.ae = 0  # number of stored asset-events
+
+    def append(self, gmf_df, ae):
+        """
+        Copy the GMFs in the buffer, assuming there is enough space
+        """
+        if not self.arrays:
+            self.arrays = {col: numpy.empty(self.size, gmf_df[col].dtype)
+                           for col in gmf_df.columns}
+        n = self.n + len(gmf_df)
+        for col, arr in self.arrays.items():
+            arr[self.n:n] = gmf_df[col].to_numpy()
+        self.n = n
+        self.ae += ae
+
+    def flush(self):
+        """
+        :returns: (DataFrame of GMFs, asset-events), emptying the buffer
+        """
+        # NB: copy=False, the DataFrame is a view over the buffer
+        gmf_df = pandas.DataFrame(
+            {col: arr[:self.n] for col, arr in self.arrays.items()},
+            copy=False)
+        ae = self.ae
+        self.n = self.ae = 0
+        return gmf_df, ae
+
+    def gen_blocks(self, dfs):
+        """
+        :param dfs: an iterable over DataFrames of GMFs
+        :yields: pairs (DataFrame of GMFs, asset-events)
+        """
+        for gmf_df in dfs:
+            nas = self.num_assets[gmf_df.sid.to_numpy()]
+            if not nas.all():
+                gmf_df = gmf_df[nas > 0]
+                nas = nas[nas > 0]
+            ae = int(nas.sum())
+            if ae == 0:
+                continue
+            if self.n and (self.n + len(gmf_df) > self.size or
+                           self.ae + ae > self.ae_max):
+                yield self.flush()
+            if len(gmf_df) > self.size or ae > self.ae_max:
+                yield gmf_df, ae  # too big for the buffer
+            else:
+                self.append(gmf_df, ae)
+        if self.n:
+            yield self.flush()
+
+
+def sid_index(gmf_sids):
+    """
+    :param gmf_sids: an array of site IDs
+    :returns: (order, offsets) such that the indices of the rows of the
+              site `sid` are order[offsets[sid]:offsets[sid + 1]]
+    """
+    counts = numpy.bincount(gmf_sids)
+    offsets = numpy.zeros(len(counts) + 1, I64)
+    offsets[1:] = numpy.cumsum(counts)
+    return numpy.argsort(gmf_sids, kind='stable'), offsets
+
+
+@performance.compile("int64[:](int64[:], int64[:], uint32[:])")
+def get_rows(order, offsets, sids):
+    """
+    :returns: the sorted indices of the rows on the given (unique) sites
+    """
+    maxsid = len(offsets) - 1
+    n = 0
+    for sid in sids:
+        if sid < maxsid:
+            n += offsets[sid + 1] - offsets[sid]
+    rows = numpy.empty(n, numpy.int64)
+    i = 0
+    for sid in sids:
+        if sid < maxsid:
+            for j in range(offsets[sid], offsets[sid + 1]):
+                rows[i] = order[j]
+                i += 1
+    rows.sort()  # keep the original order of the GMFs
+    return rows
+
+
 class AssetReader:
     """
     Read a slice of assets by measuring type spent and memory allocated
@@ -291,6 +397,8 @@ def event_based_risk(gmf_df, monitor):
                             int(oq.asset_correlation))
     risk_mon = monitor('computing risk', measuremem=False)
     fil_mon = monitor('filtering GMFs', measuremem=False)
+    with fil_mon:
+        order, offsets = sid_index(U32(gmf_df.sid))
     agg_mon = monitor('aggregating losses', measuremem=False)
     try:
         countries = monitor.read('countries')
@@ -302,9 +410,10 @@ def event_based_risk(gmf_df, monitor):
             with fil_mon:
                 # filtering is *crucial* for the performance of the next step
                 adf = adf_[adf_.taxonomy == taxo]
-                gdf = gmf_df[numpy.isin(gmf_df.sid, adf.site_id.unique())]
-                if len(gdf) == 0:
+                rows = get_rows(order, offsets, U32(adf.site_id.unique()))
+                if len(rows) == 0:
                     continue
+                gdf = gmf_df.iloc[rows]
             # passing the contry is crucial for impact_test,
             # where the exposure contains multiple countries
             try:
@@ -325,7 +434,7 @@ def ebrisk(allrups, cmakers, sids, secperils, dstore, monitor):
     """
     :param rups: list of ruptures with the same trt_smr
     :param cmakers: ContextMaker instances associated to each trt_smr
-    :param sids: array of site indices
+    :param sids: array of site indices (None if memory-mapped)
     :param secperils: list of secondary peril instances
     :param dstore: a DataStore instance
     :param monitor: a Monitor instance
@@ -337,18 +446,16 @@ def ebrisk(allrups, cmakers, sids, secperils, dstore, monitor):
     dfs = (dic['gmfdata'] for dic in event_based.event_based(
         allrups, cmakers, sids, secperils, dstore, monitor)
            if len(dic['gmfdata']))
-    num_assets = monitor.read('num_assets')
-    for blk in general.block_splitter(
-            dfs, AE_MAX, lambda gmf_df: num_assets[gmf_df.sid].sum()):
-        # NB: it is essential to concatenate the small dataframes to have
-        # long arrays (around AE_MAX) and hence a good performance
-        na = int(sum(num_assets[df.sid].sum() for df in blk))
-        if na > AE_MAX:  # big task
+    # NB: it is essential to collect the small dataframes to have
+    # long arrays (around AE_MAX) and hence a good performance
+    buffer = GmfBuffer(monitor.read('num_assets'))
+    for gmf_df, na in buffer.gen_blocks(dfs):
+        if na > AE_MAX:  # big task, gmf_df is not a view over the buffer
             calc_id, task_no = monitor.calc_id, monitor.task_no
             print(f'{calc_id=}, {task_no=}, {na=:_d}')
-            yield event_based_risk, pandas.concat(blk)
+            yield event_based_risk, gmf_df
         else:
-            yield event_based_risk(pandas.concat(blk), monitor)
+            yield event_based_risk(gmf_df, monitor)
 
 
 @performance.compile("(f4[:,:,:], i4[:], i4[:], f4[:], i8)")
@@ -513,7 +620,9 @@ class EventBasedRiskCalculator(event_based.EventBasedCalculator):
             self.save_tmp(smap.monitor)
             for gmf_df in gmf_dfs:
                 smap.submit((gmf_df,))
-            smap.reduce(self.agg_dicts)
+            self.writer = hdf5.Writer(self.datastore.hdf5)
+            with self.writer:
+                smap.reduce(self.agg_dicts)
 
         if self.parent_events:
             assert self.parent_events == len(self.datastore['events'])
@@ -540,13 +649,13 @@ class EventBasedRiskCalculator(event_based.EventBasedCalculator):
         self.oqparam.ground_motion_fields = False  # hack
         times = dic.pop('times', None)
         if times is not None:
-            hdf5.extend(self.datastore['ruptimes'], times)
+            self.writer.extend('ruptimes', times)
         alt = dic.pop('alt', None)
         if alt is not None:
             with self.monitor('saving risk_by_event'):
                 for name in alt.columns:
-                    dset = self.datastore['risk_by_event/' + name]
-                    hdf5.extend(dset, alt[name].to_numpy())
+                    self.writer.extend('risk_by_event/' + name,
+                                       alt[name].to_numpy())
         coo = dic.pop('avg', None)
         if coo is not None and self.oqparam.avg_losses:
             # avg_losses are stored as coo matrices
@@ -179,7 +179,7 @@ def extract_(dstore, dspath):
     """
     obj = dstore[dspath]
     if isinstance(obj, Dataset):
-        return ArrayWrapper(obj[()], obj.attrs)
+        return ArrayWrapper(hdf5.memmap(obj)[()], obj.attrs)
     elif isinstance(obj, Group):
         return ArrayWrapper(numpy.array(list(obj)), obj.attrs)
     else:
@@ -407,8 +407,9 @@ def _get_dict(dstore, name, imtls, stats):
     for imt, imls in imtls.items():
         dt = numpy.dtype([(str(iml), F32) for iml in imls])
         dtlist.append((imt, dt))
+    dset = dstore.memmap(name)
     for s, stat in enumerate(stats):
-        dic[stat] = dstore[name][:, s].flatten().view(dtlist)
+        dic[stat] = dset[:, s].flatten().view(dtlist)
     return dic
 
 
@@ -434,15 +435,18 @@ def _items(dstore, name, what, info):
     if 'imt' in params:
         [imt] = params['imt']
         filt['imt'] = imt
+    # the slices of the memmap are read only when serialized
     if params['rlzs']:
+        dset = dstore.getitem(name + '-rlzs')
         for k in params['k']:
             filt['rlz_id'] = k
-            yield 'rlz-%03d' % k, dstore.sel(name + '-rlzs', **filt)[:, 0]
+            yield 'rlz-%03d' % k, hdf5.sel(dset, filt, lazy=True)[:, 0]
     else:
+        dset = dstore.getitem(name + '-stats')
         stats = list(info['stats'])
         for k in params['k']:
             filt['stat'] = stat = stats[k]
-            yield stat, dstore.sel(name + '-stats', **filt)[:, 0]
+            yield stat, hdf5.sel(dset, filt, lazy=True)[:, 0]
     yield from params.items()
 
 
@@ -492,8 +496,9 @@ def extract_uhs(dstore, what):
         sitecol = dstore['sitecol']
         sites = get_sites(sitecol, complete=False)
         dic = {}
+        dset = dstore.memmap('hmaps-stats')
         for stat, s in info['stats'].items():
-            hmap = dstore['hmaps-stats'][:, s]  # shape (N, M, P)
+            hmap = dset[:, s]  # shape (N, M, P)
             dic[stat] = calc.make_uhs(hmap, info)
         yield from hazard_items(
             dic, sites, investigation_time=info['investigation_time'])
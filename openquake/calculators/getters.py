@@ -46,13 +46,15 @@ class NotFound(Exception):
 
 def build_stat_curve(hcurve, imtls, stat, wget, use_rates=False):
     """
-    Build statistics by taking into account IMT-dependent weights
+    Build statistics by taking into account IMT-dependent weights.
+
+    :param hcurve: an array of shape (L, R) or (N, L, R)
+    :returns: an array of shape (L, 1) or (N, L, 1)
     """
     weights = wget.weights
-    poes = hcurve.T  # shape R, L
+    poes = numpy.moveaxis(hcurve, -1, 0)  # shape R, L or R, N, L
     assert len(poes) == len(weights), (len(poes), len(weights))
-    L = imtls.size
-    array = numpy.zeros((L, 1))
+    array = numpy.zeros(hcurve.shape[:-1] + (1,))
 
     if weights.shape[1] > 1:  # IMT-dependent weights
         # this is slower since the arrays are shorter
@@ -62,14 +64,15 @@ def build_stat_curve(hcurve, imtls, stat, wget, use_rates=False):
             if not ws.sum():  # expect no data for this IMT
                 continue
             if use_rates:
-                array[slc, 0] = to_probs(stat(to_rates(poes[:, slc]), ws))
+                array[..., slc, 0] = to_probs(
+                    stat(to_rates(poes[..., slc]), ws))
             else:
-                array[slc, 0] = stat(poes[:, slc], ws)
+                array[..., slc, 0] = stat(poes[..., slc], ws)
     else:
         if use_rates:
-            array[:, 0] = to_probs(stat(to_rates(poes), weights[:, -1]))
+            array[..., 0] = to_probs(stat(to_rates(poes), weights[:, -1]))
         else:
-            array[:, 0] = stat(poes, weights[:, -1])
+            array[..., 0] = stat(poes, weights[:, -1])
     return array
 
 
@@ -180,6 +183,20 @@ def get_num_chunks(dstore, full_lt=None):
     # req_gb=202, N=260,000 => 202
 
 
+def get_rates_fnames(dstore):
+    """
+    :returns: the datastore filename and the files with the rates stored
+              by the workers, if any
+    """
+    fnames = [dstore.filename]
+    calc_dir = dstore.filename[:-5]
+    if os.path.exists(calc_dir):
+        for f in os.listdir(calc_dir):
+            if f.endswith('.hdf5'):
+                fnames.append(os.path.join(calc_dir, f))
+    return fnames
+
+
 def map_getters(dstore, full_lt=None, oq=None, disagg=False):
     """
     :returns: a list of pairs (MapGetter, weights)
@@ -206,12 +223,11 @@ def map_getters(dstore, full_lt=None, oq=None, disagg=False):
             gweights.append(flt.g_weights(trt_smrs))
         else:
             wgets.append(flt.gsim_lt.wget)
-    fnames = [dstore.filename]
-    calc_dir = dstore.filename[:-5]
-    if os.path.exists(calc_dir):
-        for f in os.listdir(calc_dir):
-            if f.endswith('.hdf5'):
-                fnames.append(os.path.join(calc_dir, f))
+    if oq.fastmean or oq.use_rates or full_lt.num_samples:
+        reducers = ()
+    else:  # full enumeration, the stats can be computed with sums over gids
+        reducers = [get_reducer(trt_rlzs, wget, full_lt.Re) for wget in wgets]
+    fnames = get_rates_fnames(dstore)
     out = []
     sids = dstore['sitecol/sids'][:]
     for chunk in range(n):
@@ -221,6 +237,7 @@ def map_getters(dstore, full_lt=None, oq=None, disagg=False):
             getter.gweights = gweights
         else:
             getter.wgets = wgets
+            getter.reducers = reducers
         if oq.site_labels:
             getter.ilabels = dstore['sitecol'].ilabel
         out.append(getter)
@@ -254,7 +271,7 @@ class CurveGetter(object):
         rates = {}
         for mgetter in map_getters(dstore):
             array = mgetter.init()
-            for sid, idx in mgetter.sid2idx.items():
+            for idx, sid in enumerate(mgetter.sids):
                 rates[sid] = array[idx]  # shape (L, G)
         dic = collections.defaultdict(lambda: ZeroGetter(mgetter.L, mgetter.R))
         for sid in rates:
@@ -289,6 +306,174 @@ class DeltaRatesGetter(object):
             return dstore['delta_rates'][src_id]
 
 
+def merge_slices(slices):
+    """
+    :param slices: an array of dtype slice_dt
+    :returns: an array of shape (S, 2) of start, stop with the adjacent
+              slices merged together
+
+    >>> merge_slices(numpy.array([(0, 3, 5), (0, 0, 3), (0, 7, 9)], slice_dt))
+    array([[0, 5],
+           [7, 9]])
+    """
+    slices = numpy.sort(slices, order='start')
+    starts, stops = slices['start'], slices['stop']
+    new = numpy.ones(len(slices), bool)
+    new[1:] = starts[1:] != stops[:-1]
+    ends = numpy.append(numpy.where(new)[0][1:] - 1, len(slices) - 1)
+    return numpy.column_stack([starts[new], stops[ends]])
+
+
+def get_reducer(trt_rlzs, wget, nblocks):
+    """
+    :param trt_rlzs: Gt arrays of realization indices (+ TWO24 * trti)
+    :param wget: an IMTWeigher with realization weights of shape (R, W)
+    :param nblocks: the number of source model realizations
+    :returns: a RlzReducer or None if the realizations do not factorize
+    """
+    weights = wget.weights
+    R, W = weights.shape
+    if R % nblocks:
+        return None
+    trtis = sorted({t_rlzs[0] // TWO24 for t_rlzs in trt_rlzs if len(t_rlzs)})
+    # a realization can receive contributions from several gids with the
+    # same TRT (i.e. from different source groups, see logictree/case_07);
+    # the set of gids is identified by the sum of random 64 bit hashes
+    ghash = numpy.random.default_rng(42).integers(
+        1, 2**63, len(trt_rlzs), dtype=numpy.uint64)
+    codes = numpy.zeros((R, len(trtis)), numpy.uint64)
+    for g, t_rlzs in enumerate(trt_rlzs):
+        if len(t_rlzs):
+            codes[t_rlzs % TWO24, trtis.index(t_rlzs[0] // TWO24)] += ghash[g]
+    size = R // nblocks
+    blocks = []
+    reps = [[] for _ in trtis]  # representative realizations for each TRT
+    for start in range(0, R, size):
+        cs = codes[start:start + size]
+        ws = weights[start:start + size]
+        bweight = ws.sum(axis=0)  # shape W
+        factors = []
+        nprod = 1
+        prod = numpy.ones((size, W))
+        for t in range(len(trtis)):
+            _, idx, inv = numpy.unique(
+                cs[:, t], return_index=True, return_inverse=True)
+            cws = numpy.zeros((len(idx), W))
+            numpy.add.at(cws, inv, ws)
+            cws = numpy.divide(cws, bweight, out=numpy.zeros_like(cws),
+                               where=bweight > 0)
+            factors.append(cws)
+            reps[t].append(start + idx)
+            prod *= cws[inv]
+            nprod *= len(idx)
+        # the realizations must be the cartesian product of the choices
+        # for each TRT and their weights the product of the conditional
+        # weights
+        if nprod != size or len(numpy.unique(cs, axis=0)) != size:
+            return None
+        if not numpy.allclose(prod * bweight, ws, atol=0):
+            return None
+        blocks.append((bweight, factors))
+
+    # build the matrices (gids, options) to sum the rates of the gids
+    # contributing to each option
+    mats = []
+    for t, trti in enumerate(trtis):
+        rlzs = numpy.concatenate(reps[t])
+        gids, cols = [], []
+        for g, t_rlzs in enumerate(trt_rlzs):
+            if len(t_rlzs) and t_rlzs[0] // TWO24 == trti:
+                gids.append(g)
+                cols.append(numpy.isin(rlzs, t_rlzs % TWO24))
+        mat = numpy.array(cols, float).reshape(len(gids), len(rlzs))
+        mats.append((numpy.array(gids, int), mat))
+    for b, (bweight, cwss) in enumerate(blocks):
+        factors = []
+        for t, cws in enumerate(cwss):
+            gids, mat = mats[t]
+            start = sum(len(r) for r in reps[t][:b])
+            factors.append((gids, mat[:, start:start + len(cws)], cws))
+        blocks[b] = (bweight, factors)
+    return RlzReducer(blocks, wget.imti)
+
+
+class RlzReducer(object):
+    """
+    Compute the mean, std and max of the hazard curves over the
+    realizations without building the (n, L, R) realization curves.
+    This is possible in the case of full enumeration, since the
+    realizations of each source model are the cartesian product of
+    independent choices, one for each tectonic region type; then the
+    probability of no exceedance is a product of independent factors and
+    the moments can be computed with sums over the gids, i.e. with a
+    cost scaling with Gt and not with R.
+
+    :param blocks: a list of pairs (block weights, factors) where the
+        factors are triples (gids, matrix gids->choices, choice weights)
+    :param imti: a dictionary imt -> index in the weights
+    """
+    def __init__(self, blocks, imti):
+        self.blocks = blocks
+        self.imti = imti
+
+    def get_stats(self, rates, imtls, statnames):
+        """
+        :param rates: an array of shape (n, L, Gt)
+        :param imtls: a DictArray imt -> levels
+        :param statnames: a sequence of names in mean, std, max
+        :returns: an array of probabilities of shape (n, L, S)
+        """
+        n, L, _ = rates.shape
+        cols = numpy.zeros(L, int)
+        for imt in imtls:
+            cols[imtls(imt)] = self.imti.get(imt, len(self.imti) - 1)
+        tot = numpy.zeros(L)
+        mean = numpy.zeros((n, L))
+        m2 = numpy.zeros((n, L))
+        maxs = numpy.zeros((n, L))
+        with numpy.errstate(divide='ignore'):
+            for bweight, factors in self.blocks:
+                logm = numpy.zeros((n, L))  # log of the mean of the pnes
+                logv = numpy.zeros((n, L))
+                logmax = numpy.zeros((n, L))
+                for gids, mat, cws in factors:
+                    ps = to_probs(rates[:, :, gids] @ mat)  # shape (n, L, k)
+                    cw = cws[:, cols].T  # shape (L, k)
+                    p = (ps * cw).sum(axis=2)
+                    pne2 = (1. - p) ** 2
+                    var = ((ps - p[:, :, None]) ** 2 * cw).sum(axis=2)
+                    logm += numpy.log1p(-p)
+                    logv += numpy.log1p(numpy.divide(
+                        var, pne2, out=numpy.zeros_like(var),
+                        where=pne2 > 0))
+                    logmax += numpy.log1p(-ps.max(axis=2))
+                # mean and variance of the probabilities in the block,
+                # computed in a numerically stable way for small poes
+                pb = -numpy.expm1(logm)
+                vb = numpy.exp(2 * logm) * numpy.expm1(logv)
+                maxs = numpy.maximum(maxs, -numpy.expm1(logmax))
+                # weighted update of the mean and of the sum of squares
+                w = bweight[cols]
+                tot += w
+                delta = pb - mean
+                mean += numpy.divide(w, tot, out=numpy.zeros(L),
+                                     where=tot > 0) * delta
+                m2 += w * vb + w * delta * (pb - mean)
+        nodata = tot == 0  # IMTs with zero weight
+        out = numpy.zeros((n, L, len(statnames)))
+        for s, statname in enumerate(statnames):
+            if statname == 'mean':
+                out[:, :, s] = mean
+            elif statname == 'std':
+                out[:, :, s] = numpy.sqrt(numpy.maximum(m2, 0.))
+            elif statname == 'max':
+                out[:, :, s] = maxs
+            else:
+                raise ValueError('Unsupported statistics %s' % statname)
+        out[:, nodata] = 0.
+        return out
+
+
 class MapGetter(object):
     """
     Read hazard curves from the datastore for all realizations or for a
@@ -302,9 +487,12 @@ class MapGetter(object):
         self.R = R
         self.imtls = oq.imtls
         self.poes = oq.poes
+        self.hazard_maps_only = oq.hazard_maps_only
         self.use_rates = oq.use_rates
+        self.quantile_accuracy = oq.quantile_accuracy
         self.eids = None
         self.ilabels = ()  # overridden in case of ilabels
+        self.reducers = ()  # overridden in case of full enumeration
         self.array = None
 
     @property
@@ -333,36 +521,77 @@ class MapGetter(object):
         """
         if self.array is not None:
             return self.array
-        sid2idx = {sid: idx for idx, sid in enumerate(self.sids)}
+        sids = U32(self.sids)
+        # -1 marks the site IDs not in the getter, see get_idxs
+        self.sid2idx = numpy.full(sids.max() + 1 if len(sids) else 0, -1, I64)
+        self.sid2idx[sids] = numpy.arange(len(sids))
         self.array = numpy.zeros((self.N, self.L, self.Gt))  # move to 32 bit
+        flat = self.array.reshape(-1)  # a view
         for fname in self.filenames:
             with hdf5.File(fname) as dstore:
                 slices = dstore['_rates/slice_by_idx'][:]
                 slices = slices[slices['idx'] == self.chunk]
-                for start, stop in zip(slices['start'], slices['stop']):
-                    df = dstore.read_df('_rates', slc=slice(start, stop))
-                    idxs = U32([sid2idx[sid] for sid in df.sid])
-                    lid = df.lid.to_numpy()
-                    gid = df.gid.to_numpy()
-                    self.array[idxs, lid, gid] += df.rate
-        self.sid2idx = sid2idx
+                if len(slices) == 0:
+                    continue
+                # a single read of all the slices for the chunk
+                df = dstore.read_df('_rates', slices=merge_slices(slices))
+            idxs = self.sid2idx[df.sid.to_numpy()]
+            # add the rates in place; the indices can be repeated
+            numpy.add.at(flat, (idxs * self.L + df.lid.to_numpy()) * self.Gt +
+                         df.gid.to_numpy(), df.rate.to_numpy())
         return self.array
 
-    def get_hcurve(self, sid):  # used in classical
+    def get_idxs(self, sids):
+        """
+        :param sids: a sequence of site IDs
+        :returns: the corresponding indices in the array
+        :raises: KeyError for site IDs not in the getter
+        """
+        sids = U32(sids)
+        ok = sids < len(self.sid2idx)
+        idxs = numpy.full(len(sids), -1, I64)
+        idxs[ok] = self.sid2idx[sids[ok]]
+        if (idxs < 0).any():
+            raise KeyError('Site IDs not in the getter: %s' %
+                           sids[idxs < 0].tolist())
+        return idxs
+
+    def get_hcurve(self, sid):  # used in disaggregation
         """
         :param sid: a site ID
         :returns: an array of shape (L, R) for the given site ID
         """
+        return self.get_hcurves([sid])[0]
+
+    def get_hcurves(self, sids, rlzs=slice(None)):  # used in classical
+        """
+        :param sids: a sequence of n site IDs
+        :param rlzs: a slice of realizations (default all)
+        :returns: an array of shape (n, L, R') for the given site IDs
+        """
         array = self.init()
-        r0 = numpy.zeros((self.L, self.R))
-        idx = self.sid2idx[sid]
+        idxs = self.get_idxs(sids)
+        start, stop, _ = rlzs.indices(self.R)
+        r0 = numpy.zeros((len(idxs), self.L, stop - start))
         for g, t_rlzs in enumerate(self.trt_rlzs):
-            rlzs = t_rlzs % TWO24
-            rates = array[idx, :, g]
-            for rlz in rlzs:
-                r0[:, rlz] += rates
+            rs = t_rlzs % TWO24
+            rs = rs[(rs >= start) & (rs < stop)] - start
+            # the realizations in t_rlzs are distinct, so += is safe
+            r0[:, :, rs] += array[idxs, :, g, None]
         return to_probs(r0)
 
+    def get_stats(self, sids, reducer, imtls, statnames):
+        """
+        :param sids: a sequence of n site IDs
+        :param reducer: a :class:`RlzReducer` instance
+        :param imtls: a DictArray imt -> levels
+        :param statnames: a sequence of names in mean, std, max
+        :returns: an array of shape (n, L, S) for the given site IDs
+        """
+        array = self.init()
+        rates = array[self.get_idxs(sids)]  # shape (n, L, Gt)
+        return reducer.get_stats(rates, imtls, statnames)
+
     def get_fast_mean(self):
         """
         :returns: a MapArray of shape (N, M, L1) with the mean hcurves
@@ -372,10 +601,10 @@ class MapGetter(object):
         means = MapArray(U32(self.sids), M, L1).fill(0)
         gweights = self.gweights[0]
         imt_dep_weights = gweights.shape[1] > 1
-        for sid in self.sids:
+        for sid, idx in zip(self.sids, self.get_idxs(self.sids)):
             if len(self.ilabels):
                 gweights = self.gweights[self.ilabels[sid]]
-            rates = self.array[self.sid2idx[sid]]  # shape (L, G)
+            rates = self.array[idx]  # shape (L, G)
             sidx = means.sidx[sid]
             for m in range(M):
                 means.array[sidx, m] = rates[m*L1: m*L1+L1] @ gweights[
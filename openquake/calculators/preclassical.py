@@ -21,6 +21,8 @@ import logging
 import operator
 import psutil
 import numpy
+import pandas
+from scipy.optimize import nnls
 from openquake.baselib import general, parallel, hdf5
 from openquake.hazardlib import pmf, geo
 from openquake.baselib.general import AccumDict, groupby
@@ -32,7 +34,7 @@ from openquake.hazardlib.source_group import (
 from openquake.hazardlib.calc.filters import (
     getdefault, split_source, SourceFilter)
 from openquake.hazardlib.scalerel.point import PointMSR
-from openquake.commonlib import readinput
+from openquake.commonlib import readinput, datastore
 from openquake.calculators import base
 
 MAX_NUM_RUPTURES = 52_000  # to support HimalayanThrust in CHN
@@ -249,6 +251,91 @@ def store_csm(dstore, csm, sitecol, cmakers):
     return max_weight
 
 
+# ########################## cost model ############################## #
+
+def read_cost_data(dstore):
+    """
+    :param dstore: the datastore of a completed classical calculation
+    :returns: a DataFrame with fields code, gsims, est_ctxs, ctime per source
+    """
+    info = dstore['source_info'][:]
+    sgs = dstore['source_groups'][:]
+    gsims = dict(zip(sgs['grp_id'], sgs['gsims']))
+    sdata = dstore.read_df('source_data')
+    src_ids = general.decode(list(sdata['src_id']))
+    ctime = pandas.Series(sdata['ctimes'].to_numpy()).groupby(src_ids).sum()
+    df = pandas.DataFrame(dict(
+        source_id=general.decode(list(info['source_id'])),
+        code=info['code'],
+        gsims=[gsims.get(grp_id, 0) for grp_id in info['grp_id']],
+        est_ctxs=info['est_ctxs'].astype(float)))
+    df['ctime'] = ctime.reindex(df.source_id).fillna(0).to_numpy()
+    return df
+
+
+def _fit(df):
+    # non-negative least squares fit of ctime = est_ctxs * (a + b * G)
+    X = numpy.column_stack([df.est_ctxs, df.est_ctxs * df.gsims])
+    coeffs, _residual = nnls(X, df.ctime.to_numpy())
+    return coeffs
+
+
+def fit_cost_model(calc_ids):
+    """
+    Fit a cost model from the source_info and source_data of previous
+    classical calculations. The calculation time of a source is modeled
+    as `est_ctxs * (a + b * G)` where `est_ctxs` is the estimated number
+    of contexts (proportional to the number of affected sites), G is the
+    number of GSIMs in the source group and the coefficients (a, b) depend
+    on the source typology.
+
+    :param calc_ids: a list of calculation IDs, as in cost_model_calcs
+    :returns: a dictionary code -> (a, b) with key b'' for all the codes
+    """
+    dfs = []
+    for calc_id in calc_ids:
+        with datastore.read(calc_id) as dstore:
+            dfs.append(read_cost_data(dstore))
+    df = pandas.concat(dfs)
+    df = df[(df.est_ctxs > 0) & (df.ctime > 0)]
+    if len(df) == 0:
+        raise ValueError('No source data in calculations %s' % calc_ids)
+    model = {b'': _fit(df)}
+    for code, grp in df.groupby('code'):
+        coeffs = _fit(grp)
+        if coeffs.any():
+            model[code] = coeffs
+            logging.info('Cost model for code %s: a=%.2e, b=%.2e',
+                         code.decode('ascii'), *coeffs)
+    if not model[b''].any():
+        raise ValueError('Could not fit a cost model from %s' % calc_ids)
+    return model
+
+
+def calibrate_weights(csm, cmakers, model):
+    """
+    Multiply the weight of each source by the cost per context predicted by
+    the cost model, keeping the total weight constant.
+
+    :param csm: a CompositeSourceModel with weighted sources
+    :param cmakers: the ContextMakers associated to the source groups
+    :param model: a dictionary code -> (a, b) as returned by fit_cost_model
+    """
+    cmakers = cmakers.to_array()
+    tot_weight = 0
+    new_weight = 0
+    for sg in csm.src_groups:
+        G = len(cmakers[sg.sources[0].grp_id].gsims)
+        for src in sg:
+            a, b = model.get(src.code, model[b''])
+            tot_weight += src.weight
+            src.weight *= a + b * G
+            new_weight += src.weight
+    if new_weight:
+        for src in csm.get_sources():
+            src.weight *= tot_weight / new_weight
+
+
 def warn_use_rates(oq, num_rlzs):
     """
     Recommend setting use_rates and full enumeration when only the means
@@ -357,6 +444,10 @@ class PreClassicalCalculator(base.HazardCalculator):
         else:
             secparams = ()
         self._process(atomic_sources, normal_sources, sf, secparams)
+        if oq.cost_model_calcs:
+            logging.info('Calibrating the weights with the cost model')
+            model = fit_cost_model(oq.cost_model_calcs)
+            calibrate_weights(csm, self.cmakers, model)
         allsources = csm.get_sources()
         self.store_source_info(source_data(allsources))
 
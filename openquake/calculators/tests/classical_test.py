@@ -21,12 +21,13 @@ import gzip
 import numpy
 from unittest import mock
 
-from openquake.baselib import parallel, general, config
+from openquake.baselib import parallel, general, config, hdf5
 from openquake.baselib.general import decode
 from openquake.hazardlib import InvalidFile, nrml, calc, contexts
 from openquake.hazardlib.source.rupture import get_ruptures_aw
 from openquake.hazardlib.source_group import read_src_group
 from openquake.hazardlib.sourcewriter import write_source_model
+from openquake.calculators import preclassical
 from openquake.calculators.views import view, text_table
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
@@ -95,6 +96,12 @@ class ClassicalTestCase(CalculatorTestCase):
         sitecol = extract(self.calc.datastore, 'sitecol')
         self.assertEqual(len(sitecol.array), 4)
 
+        # check the tolerance of the 32 bit precision
+        hcurves64 = self.calc.datastore['hcurves-rlzs'][:]
+        self.run_calc(case_01.__file__, 'job.ini', precision='32')
+        hcurves32 = self.calc.datastore['hcurves-rlzs'][:]
+        aac(hcurves32, hcurves64, rtol=1E-5, atol=1E-8)
+
         # check minimum_magnitude discards the source
         with self.assertRaises(RuntimeError) as ctx:
             self.run_calc(case_01.__file__, 'job.ini', minimum_magnitude='4.5')
@@ -143,6 +150,22 @@ class ClassicalTestCase(CalculatorTestCase):
         self.assertEqual(trt, 'Volcanic Shallow')
         self.assertEqual(gsim.__class__.__name__, 'FaccioliEtAl2010')
 
+        # calibrating the weights with a cost model does not change the
+        # hazard curves
+        calc_id = self.calc.datastore.calc_id
+        weights = self.calc.datastore['source_info']['weight']
+        model = preclassical.fit_cost_model([calc_id])
+        self.assertIn(b'', model)
+        self.assertTrue((model[b''] >= 0).all())
+        self.run_calc(case_05.__file__, 'job.ini',
+                      cost_model_calcs=str(calc_id))
+        [fname] = export(('uhs/mean', 'csv'), self.calc.datastore)
+        self.assertEqualFiles('expected/uhs.csv', fname)
+        # the weights change but their total is the same
+        calibrated = self.calc.datastore['source_info']['weight']
+        self.assertFalse(numpy.allclose(calibrated, weights))
+        self.assertAlmostEqual(calibrated.sum() / weights.sum(), 1, places=5)
+
     def test_case_06(self):
         # test with site-dependent logic trees
         with mock.patch.dict(config.memory, {'pmap_max_mb': .0006}):
@@ -280,6 +303,22 @@ class ClassicalTestCase(CalculatorTestCase):
         self.assert_curves_ok(
             ['hazard_curve-smltp_b1-gsimltp_b1_b2.csv'],
             case_12.__file__)
+        hc_id = str(self.calc.datastore.calc_id)
+        sdata = self.calc.datastore.read_df('source_data', 'src_id')
+
+        # changing the gsim of the stable continental region only
+        self.run_calc(case_12.__file__, 'job.ini',
+                      gsim_logic_tree_file='gsim_logic_tree_2.xml')
+        expected = self.calc.datastore['hcurves-rlzs'][:]
+        self.run_calc(case_12.__file__, 'job.ini',
+                      gsim_logic_tree_file='gsim_logic_tree_2.xml',
+                      incremental_calculation_id=hc_id)
+        aac(self.calc.datastore['hcurves-rlzs'][:], expected, rtol=1E-6)
+
+        # the rates of the active shallow crust source are copied
+        data = self.calc.datastore.read_df('source_data', 'src_id')
+        self.assertEqual(data.ctimes['1'], sdata.ctimes['1'])
+        self.assertNotEqual(data.ctimes['2'], sdata.ctimes['2'])
 
     def test_case_13(self):
         # Test specification of reference z1pt4
@@ -320,6 +359,30 @@ class ClassicalTestCase(CalculatorTestCase):
         with open(tmp, 'wb') as f:
             nrml.write([gnode], f)
 
+        # computing the hazard maps directly from the rates
+        hmaps = self.calc.datastore['hmaps-stats'][:]
+        hmaps_rlzs = self.calc.datastore['hmaps-rlzs'][:]
+        self.run_calc(case_18.__file__, 'job.ini', hazard_maps_only='true',
+                      hazard_calculation_id=str(self.calc.datastore.calc_id))
+        dstore = self.calc.datastore
+        self.assertNotIn('hcurves-rlzs', dstore.hdf5)
+        self.assertNotIn('hcurves-stats', dstore.hdf5)
+        aac(dstore['hmaps-stats'][:], hmaps, rtol=1E-6)
+        aac(dstore['hmaps-rlzs'][:], hmaps_rlzs, rtol=1E-6)
+        [fname] = export(('uhs/mean', 'csv'), dstore)
+        self.assertEqualFiles('expected/hazard_uhs-mean.csv', fname)
+
+        # without a parent the readers of the curves raise a clear error
+        self.run_calc(case_18.__file__, 'job.ini', hazard_maps_only='true')
+        for name in ('global_hazard', 'mean_rates', 'high_hazard'):
+            with self.assertRaisesRegex(KeyError, 'hazard_maps_only'):
+                view(name, self.calc.datastore)
+        with self.assertRaisesRegex(KeyError, 'hazard_maps_only'):
+            extract(self.calc.datastore, 'high_sites')
+        with self.assertRaisesRegex(InvalidFile, 'disagg_by_src'):
+            self.run_calc(case_18.__file__, 'job.ini', hazard_maps_only='true',
+                          disagg_by_src='true')
+
     def getLG(self):
         return self.calc.datastore['hcurves-stats'][3, 0]
 
@@ -345,6 +408,23 @@ class ClassicalTestCase(CalculatorTestCase):
         self.assertGreater(data['tiles'][0], 1)
         self.assertEqual(data['blocks'], [1])
 
+        # simulate a calculation killed after completing half of the tasks
+        # and resume it, by reusing the rates stored by the parent
+        self.run_calc(case_22.__file__, 'job.ini', tiling='true')
+        calc_id = self.calc.datastore.calc_id
+        self.calc.datastore.close()
+        with hdf5.File(self.calc.datastore.filename, 'r+') as h5:
+            ndone = len(h5['task_done'])
+            self.assertGreater(ndone, 1)
+            h5['task_done'].resize((ndone // 2,))
+            del h5['source_data']
+        self.assert_curves_ok([
+            '/hazard_curve-mean.csv',
+            'hazard_map-mean.csv',
+        ], case_22.__file__, delta=1E-6, tiling=True,
+            hazard_calculation_id=str(calc_id), resume='true')
+        self.assertEqual(len(self.calc.datastore['task_done']), ndone)
+
     def test_case_23(self):  # filtering away on TRT
         self.assert_curves_ok(['hazard_curve.csv'],
                               case_23.__file__, delta=1e-5)
@@ -547,6 +627,13 @@ class ClassicalTestCase(CalculatorTestCase):
                                "quantile_curve-0.84-PGA.csv"],
                               case_37.__file__)
 
+        # approximate quantiles with sketches, same mean
+        expected = self.calc.datastore['hcurves-stats'][:]
+        self.run_calc(case_37.__file__, 'job.ini', quantile_accuracy='.01')
+        got = self.calc.datastore['hcurves-stats'][:]
+        aac(got[:, 0], expected[:, 0], rtol=1E-6)
+        aac(got, expected, rtol=2 * .01 / .99)  # gamma - 1
+
     def test_case_38(self):
         # BC Hydro GMPEs with epistemic adjustments
         self.assert_curves_ok(["hazard_curve-mean-PGA.csv",
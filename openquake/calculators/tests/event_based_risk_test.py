@@ -19,6 +19,7 @@ import os
 import sys
 from unittest import mock, SkipTest
 import numpy
+import pandas
 
 from openquake.baselib.general import gettemp
 from openquake.baselib.hdf5 import read_csv
@@ -31,6 +32,8 @@ from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
 from openquake.calculators.post_risk import PostRiskCalculator
+from openquake.calculators.event_based_risk import (
+    GmfBuffer, sid_index, get_rows)
 from openquake.qa_tests_data.event_based_risk import (
     case_01, case_02, case_03, case_04, case_4a, case_05, case_6c, case_master,
     case_miriam, occupants, case_1f, case_1g, case_7a, case_08, case_09,
@@ -51,6 +54,31 @@ def aae(data, expected):
 
 class EventBasedRiskTestCase(CalculatorTestCase):
 
+    def test_gmf_buffer(self):
+        num_assets = numpy.array([2, 0, 1, 3])
+        dfs = [pandas.DataFrame(dict(sid=numpy.uint32(sids),
+                                     eid=numpy.uint32([e] * len(sids)),
+                                     gmv_0=numpy.float32(sids) / 10))
+               for e, sids in enumerate([[0, 1, 2], [1, 3], [0, 2, 3]])]
+        buffer = GmfBuffer(num_assets, size=4, ae_max=5)
+        blocks = []
+        for gmf_df, ae in buffer.gen_blocks(dfs):
+            # the blocks are views over the buffer, copy them
+            blocks.append((gmf_df.copy(), ae))
+        # the GMFs on site 1 without assets are discarded
+        self.assertEqual([ae for _, ae in blocks], [3, 3, 6])
+        self.assertEqual(list(blocks[0][0].sid), [0, 2])
+        self.assertEqual(list(blocks[1][0].sid), [3])
+        # the last rupture has 6 asset-events > ae_max, it is not buffered
+        self.assertEqual(list(blocks[2][0].sid), [0, 2, 3])
+        self.assertEqual(buffer.n, 0)
+
+        # selecting the rows on given sites, in the original order
+        sids = numpy.uint32([3, 0, 2, 0, 1, 3])
+        order, offsets = sid_index(sids)
+        numpy.testing.assert_equal(
+            get_rows(order, offsets, numpy.uint32([3, 0, 7])), [0, 1, 3, 5])
+
     def assert_stats_ok(self, pkg, job_ini):
         out = self.run_calc(pkg.__file__, job_ini, exports='csv',
                             concurrent_tasks='4')
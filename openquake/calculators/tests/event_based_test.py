@@ -351,6 +351,34 @@ class EventBasedTestCase(CalculatorTestCase):
         self.run_calc(case_9.__file__, 'job.ini', exports='csv')
         # this is a case where there are 2 ruptures and 1 gmv per site
         self.assertEqual(len(self.calc.datastore['gmf_data/eid']), 29)
+        gmvs = self.calc.datastore['gmf_data/PGA'][:]
+
+        # blocks larger than the number of sites (61) give the same GMFs
+        self.run_calc(case_9.__file__, 'job.ini', correlation_block_size='100')
+        aac(self.calc.datastore['gmf_data/PGA'][:], gmvs)
+
+        # blocks of 20 sites neglect the correlation between the blocks;
+        # the GMFs are checked exactly in hazardlib/tests/calc/gmf_test.py
+        self.run_calc(case_9.__file__, 'job.ini', correlation_block_size='20')
+        blocked = self.calc.datastore['gmf_data/PGA'][:]
+        self.assertEqual(len(blocked), len(gmvs))
+        self.assertFalse(numpy.allclose(blocked, gmvs))
+
+        # Vecchia approximation with 20 neighbours, checked exactly in
+        # hazardlib/tests/calc/gmf_test.py and correlation_models/sampling_test
+        self.run_calc(case_9.__file__, 'job.ini', correlation_neighbors='20')
+        vecchia = self.calc.datastore['gmf_data/PGA'][:]
+        self.assertEqual(len(vecchia), len(gmvs))
+        self.assertFalse(numpy.allclose(vecchia, gmvs))
+
+        # counter-based streams do not depend on the task splitting
+        dfs = []
+        for ct in ('1', '4'):
+            self.run_calc(case_9.__file__, 'job.ini', counter_based_rng='true',
+                          concurrent_tasks=ct)
+            df = self.calc.datastore.read_df('gmf_data')
+            dfs.append(df.sort_values(['eid', 'sid'], ignore_index=True))
+        pandas.testing.assert_frame_equal(dfs[0], dfs[1])
 
     def test_case_10(self):
         # this is a case with multiple files in the smlt uncertaintyModel
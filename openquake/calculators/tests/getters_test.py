@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2026 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import numpy
+from openquake.baselib.general import DictArray
+from openquake.hazardlib.contexts import Oq
+from openquake.calculators.getters import MapGetter
+
+
+class MapGetterTestCase(unittest.TestCase):
+    def test_missing_sids(self):
+        oq = Oq(imtls=DictArray({'PGA': [.1, .2]}), poes=[],
+                hazard_maps_only=False, quantile_accuracy=0)
+        getter = MapGetter([], 0, [numpy.uint32([0])], [3, 5], 1, oq)
+        numpy.testing.assert_equal(getter.get_hcurve(5), numpy.zeros((2, 1)))
+        numpy.testing.assert_equal(getter.get_idxs([5, 3]), [1, 0])
+        # site IDs not in the getter are not silently mapped to row 0
+        for sid in (0, 4, 100):
+            with self.assertRaises(KeyError):
+                getter.get_hcurve(sid)
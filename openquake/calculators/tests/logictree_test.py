@@ -357,6 +357,15 @@ hazard_uhs-std.csv
             'mean_rates_by_src'][0]  # (M, L1, Ns)
         aac(mean_rates, rates_by_source.sum(axis=2), atol=5E-7)
 
+        # mean, std and max computed with sums over the gids must be
+        # the same as the ones computed from the individual realizations
+        self.run_calc(case_19.__file__, 'job.ini', use_rates='false',
+                      std='true', max='true')
+        stats = self.calc.datastore['hcurves-stats'][:]
+        self.run_calc(case_19.__file__, 'job.ini', use_rates='false',
+                      std='true', max='true', individual_rlzs='true')
+        aac(stats, self.calc.datastore['hcurves-stats'][:], atol=1E-7)
+
     def test_case_20(self):
         # Source geometry enumeration, apply_to_sources
         self.assert_curves_ok([
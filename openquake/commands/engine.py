@@ -90,6 +90,7 @@ def main(
         run=None,
         delete_calculation: int = None,
         hazard_calculation_id: valid.calculation = None,
+        resume: int = None,
         list_outputs: int = None,
         show_log=None,
         export_output=None,
@@ -157,12 +158,16 @@ def main(
         sys.exit(outdated)
 
     # hazard or hazard+risk
+    if resume is not None:  # continue a killed job
+        hazard_calculation_id = resume
     if isinstance(hazard_calculation_id, int):
         hc_id = get_job_id(hazard_calculation_id, user_name)
     else:
         hc_id = None
     if run:
         pars = dict(p.split('=', 1) for p in param.split(',')) if param else {}
+        if resume is not None:
+            pars['resume'] = 'true'
         log_file = os.path.expanduser(log_file) \
             if log_file is not None else None
         job_inis = [os.path.expanduser(f) for f in run]
@@ -260,6 +265,9 @@ main.delete_calculation = dict(
     metavar='CALCULATION_ID')
 main.hazard_calculation_id = dict(
     abbrev='--hc', help='Use the given job as input for the next job')
+main.resume = dict(
+    help='Continue the given killed job, reusing the completed tasks',
+    metavar='CALCULATION_ID')
 main.list_outputs = dict(
     abbrev='--lo', help='List outputs for the specified calculation',
     metavar='CALCULATION_ID')
@@ -167,11 +167,8 @@ def make_hmaps(pmaps, imtls, poes):
     for pmap in pmaps:
         hmap = map_array.MapArray(pmaps[0].sids, M, P).fill(0)
         for m, imt in enumerate(imtls):
-            data = map_array.compute_hazard_maps(
+            hmap.array[:, m] = map_array.compute_hazard_maps(
                 pmap.array[:, m], imtls[imt], poes)  # (N, P)
-            for idx, imls in enumerate(data):
-                for p, iml in enumerate(imls):
-                    hmap.array[idx, m, p] = iml
         hmaps.append(hmap)
     return hmaps
 
@@ -25,7 +25,7 @@ import collections
 import numpy
 import h5py
 
-from openquake.baselib import hdf5, performance, general
+from openquake.baselib import config, hdf5, performance, general
 from openquake.commonlib import dbapi
 from openquake.commonlib.logs import get_datadir, CALC_REGEX, dbcmd, init
 
@@ -208,6 +208,12 @@ class DataStore(collections.abc.MutableMapping):
         self.open(self.mode)
         if mode != 'r':  # w, a or r+
             performance.init_performance(self.hdf5)
+        if self.mode == 'w' and config.performance.get('blosc_compression'):
+            if hdf5.blosc_enabled():
+                logging.info('Using blosc compression in %s', self.filename)
+            else:
+                logging.warning('blosc_compression is set but hdf5plugin '
+                                'is not installed')
         if 'calc_' in path:
             self.calc_id, datadir = extract_calc_id_datadir(path)
             if not os.path.exists(datadir) and mode != 'r':
@@ -256,9 +262,22 @@ class DataStore(collections.abc.MutableMapping):
                 if not self.parent.hdf5:
                     self.parent.open('r')
                 return self.parent.getitem(name)
+            elif name.startswith('hcurves-') and self.hazard_maps_only:
+                raise KeyError('%s is not stored in %s since hazard_maps_only '
+                               'is set: use the hmaps' % (name, self))
             else:
                 raise
 
+    @property
+    def hazard_maps_only(self):
+        """
+        True if the hazard curves were not stored
+        """
+        try:
+            return self['oqparam'].hazard_maps_only
+        except (KeyError, AttributeError):
+            return False
+
     def swmr_on(self):
         """
         Enable the SWMR mode on the underlying HDF5 file
@@ -521,6 +540,13 @@ class DataStore(collections.abc.MutableMapping):
         """
         return hdf5.sel(self.getitem(key), kw)
 
+    def memmap(self, key):
+        """
+        :returns: a read-only memmap over the dataset, if it is contiguous
+                  and uncompressed, otherwise the dataset (read lazily)
+        """
+        return hdf5.memmap(self.getitem(key))
+
     @property
     def metadata(self):
         """
@@ -41,7 +41,8 @@ from openquake.hazardlib import shakemap, retperiods
 from openquake.hazardlib import stats, calc
 from openquake.hazardlib.correlation_models.base import (
     CrossIMTCorrelationModel, ResidualComponent,
-    SpatialCrossIMTCorrelationModel, TruncatedCrossIMTCorrelationModel)
+    SpatialCorrelationModel, SpatialCrossIMTCorrelationModel,
+    TruncatedCrossIMTCorrelationModel)
 from openquake.hazardlib.correlation_models.registry import (
     get_model, get_model_class)
 from openquake.hazardlib import valid, InvalidFile, site
@@ -170,6 +171,24 @@ collect_rlzs:
   Example: *collect_rlzs=true*.
   Default: None
 
+correlation_block_size:
+  Maximum number of sites per block when factorizing the spatial
+  correlation matrices in event based calculations. The sites are
+  grouped by geohash and the correlation between different blocks is
+  neglected, so that correlated GMFs can be computed for more than
+  *max_sites_correl* sites.
+  Example: *correlation_block_size = 1000*.
+  Default: 0, meaning a dense factorization for all sites
+
+correlation_neighbors:
+  Number of nearest neighbours used by the Vecchia approximation of the
+  spatial correlation models (like JayaramBaker2009) in event based
+  calculations. It replaces the dense Cholesky factor with a sparse one,
+  requiring memory and time proportional to the number of sites, so that
+  correlated GMFs can be computed for more than *max_sites_correl* sites.
+  Example: *correlation_neighbors = 30*.
+  Default: 0, meaning the exact Cholesky factor
+
 correlation_cutoff:
   Used in conditioned GMF calculation to avoid small negative eigenvalues
   wreaking havoc with the numerics
@@ -187,6 +206,15 @@ complex_fault_mesh_spacing:
   Example: *complex_fault_mesh_spacing = 15*.
   Default: 5
 
+cost_model_calcs:
+  Used in classical calculations to calibrate the weights of the sources
+  with a cost model fitted on the source_info and source_data of previous
+  calculations, broken down by source typology, number of GSIMs and
+  estimated number of contexts. Useful to get balanced tasks when the
+  default weights are off, as it happens with multifault sources.
+  Example: *cost_model_calcs = 42 43*.
+  Default: empty list
+
 concurrent_tasks:
   A hint to the engine for the number of tasks to generate. Do not set
   it unless you know what you are doing.
@@ -217,11 +245,30 @@ coordinate_bin_width:
   Example: *coordinate_bin_width = 1.0*.
   Default: 100 degrees, meaning don't disaggregate by lon, lat
 
+counter_based_rng:
+  Used in event based calculations to draw the epsilons of the GMFs from
+  counter-based streams (Philox) keyed by the rupture seed, the event ID,
+  the site ID and the IMT index, instead of a sequential generator per
+  rupture. The GMFs of an event then do not depend on the other events
+  and sites, so the events of a rupture can be split across tasks with
+  bit-identical results. The epsilons of the site amplification are
+  still drawn sequentially.
+  Example: *counter_based_rng = true*.
+  Default: False
+
 countries:
   Used to restrict the exposure to a single country in IMPACT mode.
   Example: *countries = ITA*.
   Default: ()
 
+ctx_cache_dir:
+  Directory where the contexts generated by the sources are cached and
+  reused by subsequent calculations with the same sources, sites and
+  distance parameters, for instance when changing only the GSIMs or the
+  IMTs. Relative paths are interpreted with respect to the job.ini.
+  Example: *ctx_cache_dir = /tmp/ctxs*.
+  Default: empty string, meaning no cache
+
 between_event_correlation_model:
   Name of a registered model for correlation between event terms at
   different IMTs.
@@ -391,6 +438,15 @@ hazard_maps:
   Example: *hazard_maps = true*.
   Default: False
 
+hazard_maps_only:
+  Used in classical calculations. If set, the hazard maps and uniform hazard
+  spectra are computed directly from the rates, without storing the hazard
+  curves; it requires the `poes` and it is incompatible with disaggregation
+  and disagg_by_src. The views and extractors needing the curves raise
+  an error.
+  Example: *hazard_maps_only = true*.
+  Default: False
+
 horiz_comp_to_geom_mean:
   Apply the correction to the geometric mean when possible,
   depending on the GMPE and the Intensity Measure Component
@@ -420,6 +476,14 @@ imt_ref:
   Example: *imt_ref = SA(0.15)*.
   Default: empty string
 
+incremental_calculation_id:
+  Used in classical calculations to specify a previous calculation with
+  the same parameters and sites but a different logic tree or different
+  source models: the rates of the (source group, gsim) pairs which did not
+  change are copied from it and only the other ones are computed.
+  Example: *incremental_calculation_id = 42*.
+  Default: None
+
 individual_rlzs:
   When set, store the individual hazard curves and/or individual risk curves
   for each realization.
@@ -668,12 +732,30 @@ postrisk_args:
 prefer_global_site_params:
   INTERNAL. Automatically set by the engine.
 
+precision:
+  Number of bits of the floats used for the contexts and for the means and
+  standard deviations in classical calculations. With 32 bits the memory
+  occupation is halved and the hazard curves differ from the 64 bit ones
+  by less than 1E-5 in relative terms on the QA tests (see classical/case_01).
+  Example: *precision = 32*.
+  Default: 64
+
 ps_grid_spacing:
   Used in classical calculations to grid the point sources. Requires the
   *pointsource_distance* to be set too.
   Example: *ps_grid_spacing = 50*.
   Default: 0, meaning no grid
 
+quantile_accuracy:
+  If nonzero, compute the quantiles of the hazard curves with mergeable
+  sketches, streaming over the realizations in bounded memory; for large
+  logic trees the relative error on the quantiles is below twice the
+  given accuracy (it can be larger when the values of the realizations
+  are few and spread over many orders of magnitude).
+  Useful for logic trees with millions of realizations.
+  Example: *quantile_accuracy = .01*.
+  Default: 0, meaning exact quantiles
+
 quantiles:
   List of probabilities used to compute the quantiles across realizations.
   Example: quantiles = 0.15 0.50 0.85
@@ -734,6 +816,13 @@ reqv_ignore_sources:
   Example: *reqv_ignore_sources = src1 src2 src3*
   Default: empty list
 
+resume:
+  Used in classical calculations with a parent calculation which was
+  killed: the rates stored by the completed tasks of the parent are reused
+  and only the missing tasks are run. Set by `oq engine --run --resume`.
+  Example: *resume = true*.
+  Default: False
+
 risk_imtls:
   INTERNAL. Automatically set by the engine.
 
@@ -1131,16 +1220,21 @@ class OqParam(valid.ParamSet):
     coordinate_bin_width = valid.Param(valid.positivefloat, 100.)
     compare_with_classical = valid.Param(valid.boolean, False)
     concurrent_tasks = valid.Param(valid.positiveint, Starmap.CT)
+    cost_model_calcs = valid.Param(valid.positiveints, [])
     conditional_loss_poes = valid.Param(valid.probabilities, [])
     continuous_fragility_discretization = valid.Param(valid.positiveint, 20)
+    counter_based_rng = valid.Param(valid.boolean, False)
     countries = valid.Param(valid.namelist, ())
     between_event_correlation_model = valid.Param(
         valid.NoneOr(valid.utf8_not_empty), None)
     between_event_correlation_params = valid.Param(valid.dictionary, {})
     cholesky_limit = valid.Param(valid.positiveint, 10_000)
+    correlation_block_size = valid.Param(valid.positiveint, 0)
     correlation_cutoff = valid.Param(valid.positivefloat, 2E-4)
+    correlation_neighbors = valid.Param(valid.positiveint, 0)
     siteid = valid.Param(valid.base64names, ())
     cache = valid.Param(valid.boolean, False)
+    ctx_cache_dir = valid.Param(valid.utf8, '')
     description = valid.Param(valid.utf8_not_empty, "no description")
     disagg_by_src = valid.Param(valid.boolean, False)
     disagg_outputs = valid.Param(valid.disagg_outputs, list(valid.pmf_map))
@@ -1170,11 +1264,14 @@ class OqParam(valid.ParamSet):
     hazard_calculation_id = valid.Param(valid.NoneOr(valid.calculation), None)
     hazard_curves_from_gmfs = valid.Param(valid.boolean, False)
     hazard_maps = valid.Param(valid.boolean, False)
+    hazard_maps_only = valid.Param(valid.boolean, False)
     horiz_comp_to_geom_mean = valid.Param(valid.boolean, False)
     ignore_missing_costs = valid.Param(valid.namelist, [])
     ignore_covs = valid.Param(valid.boolean, False)
     iml_disagg = valid.Param(valid.floatdict, {})  # IMT -> IML
     imt_ref = valid.Param(valid.intensity_measure_type, '')
+    incremental_calculation_id = valid.Param(
+        valid.NoneOr(valid.calculation), None)
     individual_rlzs = valid.Param(valid.boolean, None)
     inputs = valid.Param(dict, {})
     ash_wet_amplification_factor = valid.Param(valid.positivefloat, 1.0)
@@ -1224,7 +1321,10 @@ class OqParam(valid.ParamSet):
     postrisk_func = valid.Param(valid.mod_func, '')
     postrisk_args = valid.Param(valid.dictionary, {})
     prefer_global_site_params = valid.Param(valid.boolean, None)
+    precision = valid.Param(valid.compose(int, valid.Choice('32', '64')), 64)
     ps_grid_spacing = valid.Param(valid.positivefloat, 0)
+    quantile_accuracy = valid.Param(
+        valid.FloatRange(0, .5, 'quantile_accuracy'), 0.)
     quantile_hazard_curves = quantiles = valid.Param(valid.probabilities, [])
     random_seed = valid.Param(valid.positiveint, 42)
     reference_depth_to_1pt0km_per_sec = valid.Param(
@@ -1243,6 +1343,7 @@ class OqParam(valid.ParamSet):
     region = valid.Param(valid.wkt_polygon, None)
     region_grid_spacing = valid.Param(valid.positivefloat, None)
     reqv_ignore_sources = valid.Param(valid.namelist, [])
+    resume = valid.Param(valid.boolean, False)
     risk_imtls = valid.Param(valid.intensity_measure_types_and_levels, {})
     risk_investigation_time = valid.Param(valid.positivefloat, None)
     rlz_index = valid.Param(valid.positiveints, None)
@@ -1586,6 +1687,39 @@ class OqParam(valid.ParamSet):
             self.raise_invalid('You cannot specify both sites and site_model '
                                'in the presence of a parent calculation')
 
+        # check for resume
+        if self.resume and (self.calculation_mode != 'classical' or
+                            self.hazard_calculation_id is None):
+            self.raise_invalid('resume=true requires a classical calculation'
+                               ' with a parent calculation')
+
+        # check for incremental_calculation_id
+        if self.incremental_calculation_id is not None:
+            if self.calculation_mode != 'classical':
+                self.raise_invalid('incremental_calculation_id requires a '
+                                   'classical calculation')
+            elif self.hazard_calculation_id or self.resume:
+                self.raise_invalid('incremental_calculation_id cannot be '
+                                   'combined with a parent calculation')
+            elif self.disagg_by_src or self.site_labels:
+                self.raise_invalid('incremental_calculation_id is not '
+                                   'supported with disagg_by_src or '
+                                   'site_labels')
+
+        # check for hazard_maps_only
+        if self.hazard_maps_only:
+            if self.calculation_mode == 'disaggregation':
+                self.raise_invalid('hazard_maps_only is incompatible with '
+                                   'disaggregation, which needs the curves')
+            elif self.calculation_mode != 'classical':
+                self.raise_invalid('hazard_maps_only requires a classical '
+                                   'calculation')
+            elif not self.poes:
+                self.raise_invalid('hazard_maps_only requires the poes')
+            elif self.disagg_by_src:
+                self.raise_invalid('hazard_maps_only is incompatible with '
+                                   'disagg_by_src')
+
         # check for GMFs from file
         if (self.inputs.get('gmfs', [''])[0].endswith('.csv')
                 and 'site_model' not in self.inputs and not self.sites):
@@ -2170,7 +2304,14 @@ class OqParam(valid.ParamSet):
                 truncation_level = (
                     getattr(self, 'truncation_level', None) or 99.)
             params.setdefault('truncation_level', truncation_level)
-        return get_model(name, **params)
+        model = get_model(name, **params)
+        if (self.correlation_block_size and
+                isinstance(model, SpatialCrossIMTCorrelationModel)):
+            model.block_size = self.correlation_block_size
+        if (self.correlation_neighbors and
+                isinstance(model, SpatialCorrelationModel)):
+            model.num_neighbors = self.correlation_neighbors
+        return model
 
     def get_within_event_correlation_model(self):
         """Return the configured within-event model, if any."""
@@ -2526,6 +2667,22 @@ class OqParam(valid.ParamSet):
         return os.path.isdir(self.export_dir) and os.access(
             self.export_dir, os.W_OK)
 
+    def is_valid_ctx_cache_dir(self):
+        """
+        ctx_cache_dir={ctx_cache_dir} must refer to a directory,
+        and the user must have the permission to write on it.
+        """
+        if not self.ctx_cache_dir:
+            return True
+        if not os.path.isabs(self.ctx_cache_dir):
+            self.ctx_cache_dir = os.path.normpath(
+                os.path.join(self.input_dir, self.ctx_cache_dir))
+        try:
+            os.makedirs(self.ctx_cache_dir, exist_ok=True)
+        except OSError:
+            return False
+        return os.access(self.ctx_cache_dir, os.W_OK)
+
     def is_valid_complex_fault_mesh_spacing(self):
         """
         The `complex_fault_mesh_spacing` parameter must be greater
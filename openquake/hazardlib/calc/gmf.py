@@ -26,6 +26,7 @@ import pandas
 from openquake.baselib.general import AccumDict
 from openquake.baselib.performance import Monitor, compile
 from openquake.hazardlib.const import StdDev
+from openquake.hazardlib.calc.rng import CounterRNG
 from openquake.hazardlib.source.rupture import EBRupture, get_eid_rlz
 from openquake.hazardlib.correlation_models.cross_imt.no_cross_correlation \
     import NoCrossCorrelation
@@ -166,6 +167,34 @@ def calc_gmf_simplified(ebrupture, sitecol, cmaker):
     return np.concatenate(gmfs)  # shape (M, N, E)
 
 
+def set_mean_stds(computers):
+    """
+    Compute the means and stddevs of a batch of GmfComputers sharing the
+    same ContextMaker and store them in the attribute `.mean_stds`.
+    The contexts of the ruptures with the same magnitude are concatenated,
+    so that each GSIM is called once per magnitude and not once per
+    rupture; this is important for millions of small ruptures.
+
+    :param computers: a list of GmfComputers with the same cmaker
+    """
+    if not computers:
+        return
+    cmaker = computers[0].cmaker
+    bymag = AccumDict(accum=[])
+    for computer in computers:
+        computer.mean_stds = []
+        bymag[np.round(computer.ctx.mag[0] * 100)].append(computer)
+    for comps in bymag.values():
+        ctxs = [comp.ctx for comp in comps]
+        ctx = np.concatenate(ctxs, dtype=ctxs[0].dtype).view(np.recarray)
+        stops = np.cumsum([len(c) for c in ctxs])[:-1]
+        for gs in cmaker.gsims:
+            with cmaker.gmf_mon:
+                mean_stds = cmaker.get_4MN([ctx], gs).astype(F32)
+            for comp, ms in zip(comps, np.split(mean_stds, stops, axis=2)):
+                comp.mean_stds.append(ms)  # shape (4, M, N)
+
+
 class GmfComputer(object):
     """
     Given an earthquake rupture, the GmfComputer computes
@@ -246,6 +275,10 @@ class GmfComputer(object):
             raise FarAwayRupture
         [self.ctx] = ctxs
         self.N = len(self.ctx)
+        self.mean_stds = None  # can be set by set_mean_stds
+        # events to generate; with counter_based_rng the GMFs of a slice
+        # are identical to the corresponding GMFs of the full rupture
+        self.eslice = slice(None)
         if within_event_model:  # store the filtered sitecol
             self.sites = sitecol.complete.filtered(self.ctx.sids)
             within_event_model.validate_imts(self.imts)
@@ -288,9 +321,12 @@ class GmfComputer(object):
         Initialize the attributes eid, rlz, sig, eps with shapes E, E, EM, EM
         """
         self.rng = np.random.default_rng(self.seed)
+        self.streams = (CounterRNG(self.seed)
+                        if self.cmaker.oq.counter_based_rng else None)
         self.rlzs = np.concatenate(list(self.cmaker.gsims.values()))
-        self.eid, self.rlz = get_eid_rlz(
+        eid, rlz = get_eid_rlz(
             vars(self.ebrupture), self.rlzs, self.cmaker.scenario)
+        self.eid, self.rlz = eid[self.eslice], rlz[self.eslice]
         self.E = E = len(self.eid)
         self.M = M = len(self.gmv_fields)
         self.sig = np.zeros((E, M), F32)  # same for all events
@@ -400,7 +436,9 @@ class GmfComputer(object):
         data = AccumDict(accum=[])
         conditioned = MNE is not None
         for g, (gs, rlzs) in enumerate(self.cmaker.gsims.items()):
-            if not conditioned:
+            if self.mean_stds is not None:  # computed by set_mean_stds
+                mean_stds = self.mean_stds[g]
+            elif not conditioned:
                 with self.cmaker.gmf_mon:
                     mean_stds = self.cmaker.get_4MN([self.ctx], gs).astype(F32)
             gs.gid = self.cmaker.gid[g]
@@ -413,10 +451,14 @@ class GmfComputer(object):
                 result = np.zeros((len(self.imts), len(self.ctx.sids), E), F32)
                 # arrays of random numbers of shape (M, N, E) and (M, E)
                 within_eps = self._draw_within_eps(
-                    E, correlate=not conditioned)
+                    E, correlate=not conditioned, eids=self.eid[idxs])
                 # between_eps are used in _compute
                 if self.tlb <= TRUNCATION_THRESHOLD:
                     self.between_eps[idxs] = 0.
+                elif self.streams is not None:
+                    self.between_eps[idxs] = \
+                        self.between_event_model.get_inter_eps_streams(
+                            self.imts, self.eid[idxs], self.streams).T
                 else:
                     self.between_eps[idxs] = \
                         self.between_event_model.get_inter_eps(
@@ -440,18 +482,24 @@ class GmfComputer(object):
         with umon:
             return self.strip_zeros(data)
 
-    def _draw_within_eps(self, num_events, correlate=True):
+    def _draw_within_eps(self, num_events, correlate=True, eids=None):
         if self.tlw <= TRUNCATION_THRESHOLD:
             return np.zeros((self.M, self.N, num_events), F32)
-        samples = np.asarray([
-            self.within_dist.rvs((self.N, num_events), self.rng).astype(F32)
-            for _ in range(self.M)])
+        if self.streams is not None:  # one number per (eid, sid, imt)
+            samples = np.asarray([
+                self.streams.normal(eids, self.ctx.sids, m, self.within_dist)
+                for m in range(self.M)], F32)
+        else:
+            samples = np.asarray([
+                self.within_dist.rvs(
+                    (self.N, num_events), self.rng).astype(F32)
+                for _ in range(self.M)])
         model = self.within_event_model
         if (not correlate or model is None or
                 isinstance(model, SpatialCorrelationModel)):
             return samples
         if self._within_event_factor is None:
-            self._within_event_factor = model.factor(
+            self._within_event_factor = model.cached_factor(
                 self.sites, self.imts, ResidualComponent.WITHIN_EVENT,
                 self.correlation_context)
         flattened = samples.reshape(-1, num_events)
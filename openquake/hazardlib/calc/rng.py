@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2026 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+:mod:`openquake.hazardlib.calc.rng` contains the counter-based random
+number generator :class:`CounterRNG` used for the GMFs.
+"""
+import numpy
+from scipy import special
+from openquake.baselib.performance import compile
+
+# NB: uint64 constants, to avoid float64 promotions in numba
+PHILOX_M0 = numpy.uint64(0xD2511F53)
+PHILOX_M1 = numpy.uint64(0xCD9E8D57)
+PHILOX_W0 = numpy.uint64(0x9E3779B9)
+PHILOX_W1 = numpy.uint64(0xBB67AE85)
+MASK32 = numpy.uint64(0xFFFFFFFF)
+SHIFT32 = numpy.uint64(32)
+
+
+@compile("UniTuple(uint64, 4)(uint64, uint64, uint64, uint64, "
+         "uint64, uint64)")
+def _philox(c0, c1, c2, c3, k0, k1):
+    for rnd in range(10):
+        if rnd:
+            k0 = (k0 + PHILOX_W0) & MASK32
+            k1 = (k1 + PHILOX_W1) & MASK32
+        p0 = PHILOX_M0 * c0
+        p1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = (((p1 >> SHIFT32) ^ c1 ^ k0) & MASK32,
+                          p1 & MASK32,
+                          ((p0 >> SHIFT32) ^ c3 ^ k1) & MASK32,
+                          p0 & MASK32)
+    return c0, c1, c2, c3
+
+
+def philox4x32(counter, key):
+    """
+    The Philox4x32-10 bijection of Salmon et al. (2011), mapping a
+    counter of 4 uint32 and a key of 2 uint32 into 4 random uint32
+
+    >>> philox4x32([0, 0, 0, 0], [0, 0])
+    array([1713891541, 3781805453, 3159862348, 2600524760], dtype=uint32)
+    """
+    args = [numpy.uint64(x) for x in list(counter) + list(key)]
+    return numpy.array(_philox(*args), numpy.uint32)
+
+
+@compile("float64[:, :](uint32[:], uint32[:], uint32[:], uint32)")
+def _counter_uniforms(key, eids, sids, idx):
+    out = numpy.empty((len(sids), len(eids)))
+    k0, k1 = numpy.uint64(key[0]), numpy.uint64(key[1])
+    for s in range(len(sids)):
+        for e in range(len(eids)):
+            r0, r1, _, _ = _philox(numpy.uint64(eids[e]), numpy.uint64(sids[s]),
+                                   numpy.uint64(idx), numpy.uint64(0), k0, k1)
+            # 53 bit uniforms strictly inside (0, 1)
+            out[s, e] = ((r0 >> 5) * 67108864. + (r1 >> 6) + .5
+                         ) / 9007199254740992.
+    return out
+
+
+class CounterRNG(object):
+    """
+    Counter-based random numbers: the number associated to a given seed,
+    event ID, site ID and index is a pure function of them, computed with
+    the Philox4x32-10 bijection. Therefore the numbers do not depend on
+    how the events and the sites are split across tasks and threads.
+
+    >>> rng = CounterRNG(42)
+    >>> eids = numpy.array([0, 1, 2], numpy.uint32)
+    >>> sids = numpy.array([10, 11], numpy.uint32)
+    >>> u = rng.uniform(eids, sids, idx=0)
+    >>> u.shape
+    (2, 3)
+    >>> bool((rng.uniform(eids[1:], sids[1:], 0) == u[1:, 1:]).all())
+    True
+    """
+    def __init__(self, seed):
+        self.seed = int(seed)
+        self.key = numpy.array(
+            [self.seed & 0xFFFFFFFF, (self.seed >> 32) & 0xFFFFFFFF],
+            numpy.uint32)
+
+    def uniform(self, eids, sids, idx=0):
+        """
+        :param eids: E event IDs
+        :param sids: N site IDs
+        :param idx: an index distinguishing different numbers for the
+                    same event and site, for instance the IMT index
+        :returns: an array of shape (N, E) of uniform numbers in (0, 1)
+        """
+        return _counter_uniforms(
+            self.key, numpy.asarray(eids, numpy.uint32),
+            numpy.asarray(sids, numpy.uint32), numpy.uint32(idx))
+
+    def normal(self, eids, sids, idx=0, dist=None):
+        """
+        :param dist: a frozen scipy distribution (default standard normal)
+        :returns: an array of shape (N, E) of numbers obtained by
+                  inverting the CDF of the distribution
+        """
+        uniform = self.uniform(eids, sids, idx)
+        if dist is None:
+            return special.ndtri(uniform)
+        return dist.ppf(uniform)
+
+    def generator(self, eid):
+        """
+        :returns: a numpy Generator for the given event, useful for draws
+                  which cannot be expressed as inverse CDFs; the generators
+                  of different events use disjoint blocks of 2^64 counters
+        """
+        return numpy.random.Generator(numpy.random.Philox(
+            counter=[0, int(eid), 0, 0], key=self.seed))
@@ -16,9 +16,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import abc
 import copy
 import time
+import pickle
+import hashlib
+import tempfile
 import logging
 import warnings
 import itertools
@@ -196,6 +200,7 @@ class Oq(object):
     A mock for OqParam
     """
     af = None
+    counter_based_rng = False
     impact = False
     total_residual_correlation_model = None
     mea_tau_phi = False
@@ -479,7 +484,8 @@ def genctxs_Pp(src, sitecol, cmaker):
 # the only way to speedup is to reduce the maximum_distance, then the array
 # will become shorter in the N dimension (number of affected sites), or to
 # collapse the ruptures, then truncnorm_sf will be called less times
-@compile("(float64[:,:,:], float64[:,:], float64, float32[:,:])")
+@compile(["(float64[:,:,:], float64[:,:], float64, float32[:,:])",
+          "(float32[:,:,:], float64[:,:], float64, float32[:,:])"])
 def _set_poes(mean_std, loglevels, phi_b, out):
     L1 = loglevels.size // len(loglevels)
     for m, levels in enumerate(loglevels):
@@ -488,6 +494,42 @@ def _set_poes(mean_std, loglevels, phi_b, out):
         for lvl, iml in enumerate(levels):
             out[mL1 + lvl] = truncnorm_sf(phi_b, (iml - mea) / std)
 
+
+# fused version of _set_poes + MapArray.update_indep for parametric ruptures,
+# going directly from mean/stddev to the map without intermediate arrays;
+# the PoEs are rounded to 32 bit to give the same numbers as the unfused path
+@compile(["(float32[:,:,:], float64[:,:,:,:], float64[:,:], float64, "
+          "boolean[:,:], float64[:], uint32[:], float64, boolean)",
+          "(float32[:,:,:], float32[:,:,:,:], float64[:,:], float64, "
+          "boolean[:,:], float64[:], uint32[:], float64, boolean)"])
+def _update_pmap(arr, mean_std, loglevels, phi_b, active, rates, sidxs,
+                 itime, add_rates):
+    _, G, M, N = mean_std.shape
+    L1 = loglevels.size // M
+    z = phi_b * 2. - 1.
+    for n in range(N):
+        sidx = sidxs[n]
+        rate = rates[n]
+        for m in range(M):
+            mL1 = m * L1
+            for g in range(G):
+                if not active[g, m]:
+                    continue
+                mea = mean_std[0, g, m, n]
+                std = mean_std[1, g, m, n]
+                for lvl in range(L1):
+                    poe = (phi_b - ndtr((loglevels[m, lvl] - mea) / std)) / z
+                    if poe < 0.:
+                        poe = 0.
+                    elif poe > 1.:
+                        poe = 1.
+                    poe = F64(F32(poe))
+                    if add_rates:
+                        arr[sidx, mL1 + lvl, g] += rate * poe * itime
+                    else:
+                        arr[sidx, mL1 + lvl, g] *= numpy.exp(
+                            -rate * poe * itime)
+
 # ############################ ContextMaker ############################### #
 
 
@@ -528,6 +570,7 @@ class ContextMaker(object):
     cluster = None  # set in RmapMaker
     source_mb = 0  # set in build_dparam
     dt = 0
+    cacheable = True  # reused across tasks, see parallel.WorkerCache
 
     @property
     def cross_correl(self):
@@ -630,6 +673,10 @@ class ContextMaker(object):
         self.disagg_bin_edges = param.get('disagg_bin_edges', {})
         self.ps_grid_spacing = param.get('ps_grid_spacing')
         self.split_sources = self.oq.split_sources
+        # dtype of the context parameters and of the mean/stddevs
+        self.F = F32 if int(param.get('precision', 64)) == 32 else F64
+        ctx_cache_dir = param.get('ctx_cache_dir')
+        self.ctx_cache = CtxCache(ctx_cache_dir) if ctx_cache_dir else None
 
     def _init2(self, param, extraparams):
         for req in self.REQUIRES:
@@ -666,14 +713,16 @@ class ContextMaker(object):
                 dt = site_param_dt[req]
                 if isinstance(dt, tuple):  # (string_, size)
                     dic[req] = b'X' * dt[1]
+                elif dt is F64 and req not in ('lon', 'lat'):
+                    dic[req] = self.F(0)
                 else:
                     dic[req] = dt(0)
             else:
-                dic[req] = 0.
+                dic[req] = self.F(0)
         dic['src_id'] = I32(0)
         dic['rup_id'] = U32(0)
         dic['sids'] = U32(0)
-        dic['rrup'] = F64(0)
+        dic['rrup'] = self.F(0)
         dic['occurrence_rate'] = F64(0)
         self.defaultdict = dic
         self.shift_hypo = param.get('shift_hypo')
@@ -689,6 +738,14 @@ class ContextMaker(object):
         self.out_no = getattr(monitor, 'out_no', self.task_no)
         self.cfactor = numpy.zeros(2)
 
+    def reset_cache(self):
+        """
+        Clear the multifault cache, since it depends on the sites;
+        called when the ContextMaker is reused in a worker
+        """
+        self.dparam = {}
+        self.source_mb = 0
+
     def copy(self, **kw):
         """
         :returns: a copy of the ContextMaker with modified attributes
@@ -1065,7 +1122,19 @@ class ContextMaker(object):
         if self.fewsites or 'clon' in self.REQUIRES_DISTANCES:
             self.defaultdict['clon'] = F64(0.)
             self.defaultdict['clat'] = F64(0.)
-
+        if (self.ctx_cache is None or step > 1 or
+                not getattr(src, 'checksum', 0)):
+            return self._get_ctxs(src, sitecol, src_id, step)
+        fname = self.ctx_cache.get_fname(self, src, sitecol)
+        ctxs = self.ctx_cache.read(fname, self, src)
+        if ctxs is None:  # not cached yet
+            ctxs = [ctx if isinstance(ctx, numpy.recarray)
+                    else self.recarray([ctx])
+                    for ctx in self._get_ctxs(src, sitecol, src_id, step)]
+            self.ctx_cache.write(fname, ctxs, src)
+        return iter(ctxs)
+
+    def _get_ctxs(self, src, sitecol, src_id, step):
         if getattr(src, 'location', None):
             return genctxs_Pp(src, sitecol, self)
         elif hasattr(src, 'source_id'):  # other source
@@ -1235,6 +1304,9 @@ class ContextMaker(object):
         :param ctx: a context array
         :param rup_mutex: dictionary (src_id, rup_id) -> weight
         """
+        if not rup_mutex and not self.cluster and self.fused(ctx):
+            self._update_fused(pmap, ctx)
+            return
         for poes, mea, sig, tau, ctxt in self.gen_poes(ctx):
             # ctxt contains an unique magnitude
             if rup_mutex:
@@ -1246,6 +1318,41 @@ class ContextMaker(object):
             else:
                 pmap.update_indep(poes, ctxt, self.tom.time_span)
 
+    def fused(self, ctx):
+        """
+        :returns: True if the fused PoEs kernel can be used
+        """
+        if self.oq.af or len(ctx.probs_occur.shape) > 1 and (
+                ctx.probs_occur.shape[1]):  # nonparametric ruptures
+            return False
+        for gsim in self.gsims:  # GSIMs with special PoEs
+            if (hasattr(gsim, 'weights_signs') or
+                    hasattr(gsim, 'mixture_model') or
+                    hasattr(gsim, 'weights')):
+                return False
+        return True
+
+    def _update_fused(self, pmap, ctx):
+        # like update, but calling the fused kernel _update_pmap
+        G, M = len(self.gsims), len(self.imtls)
+        active = numpy.ones((G, M), bool)
+        for g, gsim in enumerate(self.gsims):
+            imtweight = getattr(gsim, 'weight', None)  # ImtWeight or None
+            if imtweight:
+                for m, imt in enumerate(self.imtls):
+                    active[g, m] = imtweight.dic.get(imt) != 0
+        ctx.mag = numpy.round(ctx.mag, 3)
+        for mag in numpy.unique(ctx.mag):
+            ctxt = ctx[ctx.mag == mag]
+            self.cfactor += [len(ctxt), 1]
+            with self.gmf_mon:
+                mean_stdt = self.get_mean_stds([ctxt], split_by_mag=False)
+            with self.poe_mon:
+                _update_pmap(pmap.array, mean_stdt[:2],
+                             self.loglevels.array, self.phi_b, active,
+                             ctxt.occurrence_rate, pmap.sidx[ctxt.sids],
+                             self.tom.time_span, bool(pmap.rates))
+
     # called by gen_poes and by the GmfComputer
     def get_mean_stds(self, ctxs, split_by_mag=True):
         """
@@ -1267,33 +1374,56 @@ class ContextMaker(object):
             recarr = numpy.concatenate(
                 recarrays, dtype=recarrays[0].dtype).view(numpy.recarray)
             recarrays = split_array(recarr, U32(numpy.round(recarr.mag*100)))
-        out = numpy.empty((4, G, M, N))
-        for g, gsim in enumerate(self.gsims):
+        out = numpy.zeros((4, G, M, N), self.F)
+        for gsim in self.gsims:
             if gsim.conditional and not gsim.from_mgmpe:
                 url = ('https://docs.openquake.org/oq-engine/master/manual/'
                        'contributing/implementing-new-gsim.html')
                 raise NotImplementedError(
                     f'{gsim} was not instantiated with a '
                     f'ModifiableGMPE, please read {url}')
-            out[:, g] = self.get_4MN(recarrays, gsim)
+        gsims = list(self.gsims)
+        bases = _shared_bases(gsims)
+        shared = {} if bases else None
+        # the plain GSIMs go first, so that the ModifiableGMPEs with the
+        # same underlying GMPE can reuse their predictions
+        for g in sorted(range(G), key=lambda g: hasattr(gsims[g], 'shared')):
+            self.get_4MN(recarrays, gsims[g], out[:, g],
+                         shared if _base(gsims[g]) in bases else None)
         return out
 
-    def get_4MN(self, ctxs, gsim):
+    def get_4MN(self, ctxs, gsim, out=None, shared=None):
         """
         Called by the GmfComputer
+
+        :param ctxs: a list of recarrays
+        :param gsim: a GSIM instance
+        :param out: an array of zeros of shape (4, M, N) or None
+        :param shared: a dictionary of predictions shared by the GSIMs
+        :returns: the array `out`, filled with mean and stddevs
         """
-        N = sum(len(ctx) for ctx in ctxs)
-        M = len(self.imts)
-        out = numpy.zeros((4, M, N))
+        if out is None:
+            N = sum(len(ctx) for ctx in ctxs)
+            out = numpy.zeros((4, len(self.imts), N), self.F)
         gsim.adj = []  # NSHM2014P adjustments
         compute = gsim.__class__.compute
+        mgmpe = hasattr(gsim, 'shared')
+        if mgmpe:
+            gsim.shared = shared
         start = 0
-        for ctx in ctxs:
-            slc = slice(start, start + len(ctx))
-            adj = compute(gsim, ctx, self.imts, *out[:, :, slc])
-            if adj is not None:
-                gsim.adj.append(adj)
-            start = slc.stop
+        try:
+            for ctx in ctxs:
+                slc = slice(start, start + len(ctx))
+                adj = compute(gsim, ctx, self.imts, *out[:, :, slc])
+                if adj is not None:
+                    gsim.adj.append(adj)
+                elif shared is not None and not mgmpe:
+                    shared[str(gsim).strip(), id(ctx), None] = (
+                        out[:, :, slc].copy())
+                start = slc.stop
+        finally:
+            if mgmpe:
+                gsim.shared = None
         if self.truncation_level not in (0, 1E-9, 99.) and (out[1] == 0.).any():
             raise ValueError('Total StdDev is zero for %s' % gsim)
         if gsim.adj:
@@ -1475,6 +1605,95 @@ def set_poes(gsim, mean_std, cmaker, ctx, out, slc):
             out[:, mL1:mL1 + L1] = 0
 
 
+class CtxCache(object):
+    """
+    A cache of the contexts generated by the sources, stored as .npz
+    files in a directory which can be shared by several calculations.
+    The key contains the source checksum, the site collection and the
+    parameters affecting the geometry (maximum_distance,
+    pointsource_distance, ...) but not the GSIMs, so that the cache
+    can be reused when changing the GSIM logic tree or the IMTs.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.sitecol = None  # the last site collection seen
+        self.sites_digest = None  # and its digest
+
+    def __getstate__(self):
+        # the digest is not sent to the workers together with the sitecol
+        return dict(dirname=self.dirname, sitecol=None, sites_digest=None)
+
+    def get_sites_digest(self, sitecol):
+        """
+        :returns: the md5 digest of the site collection, computed only
+                  when the site collection changes, since it can be large
+        """
+        if sitecol is not self.sitecol:
+            self.sites_digest = hashlib.md5(
+                numpy.ascontiguousarray(sitecol.array).data).hexdigest()
+            self.sitecol = sitecol
+        return self.sites_digest
+
+    def get_fname(self, cmaker, src, sitecol):
+        """
+        :returns: the path of the file associated to the source
+        """
+        md = cmaker.maximum_distance
+        key = (src.checksum, src.source_id, src.num_ruptures,
+               self.get_sites_digest(sitecol), md.x.tobytes(), md.y.tobytes(),
+               cmaker.pointsource_distance, cmaker.minimum_distance,
+               cmaker.ps_grid_spacing, cmaker.shift_hypo, cmaker.fewsites,
+               cmaker.reqv is not None)
+        digest = hashlib.md5(pickle.dumps(key, protocol=4)).hexdigest()
+        return os.path.join(self.dirname, digest + '.npz')
+
+    def read(self, fname, cmaker, src):
+        """
+        :returns: the cached contexts or None if they are missing or
+                  if they do not contain all the required parameters
+        """
+        try:
+            npz = numpy.load(fname)
+        except (OSError, ValueError):  # missing or corrupted file
+            return None
+        dd = cmaker.defaultdict.copy()
+        ctxs = []
+        with npz:
+            for i in range(len(npz.files)):
+                arr = npz['arr_%d' % i]
+                if not set(dd) <= set(arr.dtype.names):
+                    return None  # cached with less parameters
+                # use the dtypes of the current ContextMaker
+                dd['probs_occur'] = numpy.zeros(
+                    arr.dtype['probs_occur'].shape or 0)
+                ctx = RecordBuilder(**dd).zeros(len(arr))
+                for name in dd:
+                    ctx[name] = arr[name]
+                ctx['src_id'] = src.id
+                ctx['rup_id'] += src.offset
+                ctxs.append(ctx)
+        return ctxs
+
+    def write(self, fname, ctxs, src):
+        """
+        Save the contexts of the given source, with the rupture IDs
+        relative to the source offset
+        """
+        arrays = []
+        for ctx in ctxs:
+            arr = ctx.copy()
+            arr['rup_id'] -= src.offset
+            arrays.append(arr)
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    dir=self.dirname, suffix='.tmp', delete=False) as f:
+                numpy.savez(f, *arrays)
+            os.replace(f.name, fname)  # atomic, safe for concurrent tasks
+        except OSError as exc:
+            logging.warning('Could not cache the contexts: %s', exc)
+
+
 class RmapMaker(object):
     """
     A class to compute the PoEs from a given source
@@ -1720,6 +1939,21 @@ def mean_stds(rctx, gsim, imt, idx=[0, 1, 2, 3]):
     return out[idx, 0, 0]
 
 
+def _base(gsim):
+    # string representation of the GMPE computing the base predictions
+    if hasattr(gsim, 'shared'):  # ModifiableGMPE
+        if 'conditional_gmpe' in gsim.params:
+            return None
+        return str(gsim.gmpe).strip()
+    return str(gsim).strip()
+
+
+def _shared_bases(gsims):
+    # the base GMPEs used by more than one GSIM
+    counts = collections.Counter(_base(gsim) for gsim in gsims)
+    return {base for base, n in counts.items() if n > 1 and base}
+
+
 def get_mean_stds(gsim, ctx, imts, return_dicts=False, **kw):
     """
     :param gsim: a single GSIM or a a list of GSIMs
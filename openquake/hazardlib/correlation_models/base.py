@@ -15,6 +15,9 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 """Base interfaces shared by ground-motion correlation models."""
 
+import collections
+import hashlib
+import threading
 from dataclasses import dataclass
 from enum import Enum
 from typing import Protocol, runtime_checkable
@@ -24,10 +27,16 @@ from scipy import stats
 
 from openquake.hazardlib import const
 from openquake.hazardlib.correlation_utils import corr_clipped, cov_nearest
+from openquake.hazardlib.geo.utils import geohash
+from openquake.hazardlib.correlation_models.sampling import vecchia_factor
 from openquake.hazardlib.imt import IMT
 from openquake.hazardlib.truncated_mvn import TruncatedMVN
 
 
+# pseudo site ID used for the event terms in the counter-based streams
+EVENT_SID = 2 ** 32 - 1
+
+
 class ResidualComponent(str, Enum):
     """Residual components for which a model can be calibrated."""
 
@@ -60,10 +69,153 @@ class CholeskyFactor:
 
     lower_triangle: numpy.ndarray
 
+    @property
+    def nbytes(self):
+        return self.lower_triangle.nbytes
+
     def apply(self, samples):
         return self.lower_triangle @ samples
 
 
+@dataclass(frozen=True)
+class BlockCholeskyFactor:
+    """Block-diagonal Cholesky factorization over groups of sites.
+
+    ``indices`` contains, for each block, the positions in the IMT-major
+    vector of the block's sites and ``lower_triangles`` the corresponding
+    dense factors. Correlation between different blocks is neglected.
+    """
+
+    indices: tuple
+    lower_triangles: tuple
+
+    @property
+    def nbytes(self):
+        return sum(lt.nbytes + idx.nbytes for idx, lt in zip(
+            self.indices, self.lower_triangles))
+
+    def apply(self, samples):
+        out = numpy.empty_like(samples)
+        for idx, lower_triangle in zip(self.indices, self.lower_triangles):
+            out[idx] = lower_triangle @ samples[idx]
+        return out
+
+
+class FactorCache:
+    """
+    LRU cache of correlation factors, shared by all the model instances
+    of a process, so that the ruptures affecting the same sites do not
+    repeat the factorization. The cache is bounded by the total number
+    of bytes of the stored factors.
+
+    :param maxbytes: maximum memory occupation of the cached factors
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.dic = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func, *args):
+        """
+        :returns: the factor associated to the key, computing it if missing
+        """
+        if key is None:  # not cacheable
+            return func(*args)
+        with self.lock:
+            try:
+                self.dic.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                return self.dic[key]
+        factor = func(*args)
+        nbytes = factor.nbytes
+        if nbytes > self.maxbytes:  # too big to be cached
+            return factor
+        with self.lock:
+            if key not in self.dic:
+                self.dic[key] = factor
+                self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:  # remove the least recent
+                _, old = self.dic.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return factor
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters
+        """
+        with self.lock:
+            self.dic.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+
+factor_cache = FactorCache(maxbytes=256 * 1024 ** 2)
+
+
+def _sites_key(sites):
+    # digest of the site parameters, None for objects that are not
+    # SiteCollections (i.e. plain distance matrices)
+    array = getattr(sites, 'array', None)
+    if array is None:
+        return None
+    return hashlib.md5(numpy.ascontiguousarray(array).data).hexdigest()
+
+
+def geohash_blocks(lons, lats, block_size, maxlen=8):
+    """
+    Split a set of sites in blocks of at most `block_size` sites, by
+    recursively splitting the geohash cells with too many sites and then
+    packing the adjacent cells in the geohash (Z-curve) order.
+
+    :param lons: longitudes of the sites
+    :param lats: latitudes of the sites
+    :param block_size: maximum number of sites per block
+    :param maxlen: maximum geohash length, cells are chunked beyond it
+    :returns: a list of arrays of site indices
+
+    >>> lons = numpy.array([10., 10.01, 12., 12.01, 10.02])
+    >>> lats = numpy.array([45., 45.01, 46., 46.01, 45.02])
+    >>> geohash_blocks(lons, lats, 3)
+    [array([0, 1, 4]), array([2, 3])]
+    """
+    lons = numpy.asarray(lons, numpy.float64)
+    lats = numpy.asarray(lats, numpy.float64)
+    cells = []
+
+    def split(idxs, length):
+        if len(idxs) <= block_size:
+            cells.append(idxs)
+            return
+        if length > maxlen:
+            for start in range(0, len(idxs), block_size):
+                cells.append(idxs[start:start + block_size])
+            return
+        codes = geohash(lons[idxs], lats[idxs], numpy.uint8(length))
+        _, inv = numpy.unique(codes[:, -1], return_inverse=True)
+        for code in range(inv.max() + 1):
+            split(idxs[inv == code], length + 1)
+
+    split(numpy.arange(len(lons)), 1)
+    blocks = []
+    current = []
+    size = 0
+    for cell in cells:
+        if size + len(cell) > block_size:
+            blocks.append(numpy.concatenate(current))
+            current = []
+            size = 0
+        current.append(cell)
+        size += len(cell)
+    if current:
+        blocks.append(numpy.concatenate(current))
+    return blocks
+
+
 class CorrelationModel:
     """Common metadata and validation for all correlation models."""
 
@@ -75,6 +227,9 @@ class CorrelationModel:
     DEFINED_FOR_SA_DAMPING = None
     DEFINED_FOR_SA_PERIOD_RANGE = None
     DEFINED_FOR_REGION = None
+    # True if the correlation depends on the CorrelationContext, i.e.
+    # factors cannot be shared by ruptures with different contexts
+    DEPENDS_ON_CONTEXT = False
 
     def validate(self):
         """Validate model parameters after construction."""
@@ -194,6 +349,8 @@ class CorrelationModel:
 class SpatialCrossIMTCorrelationModel(CorrelationModel):
     """Correlation over a joint, IMT-major vector of sites and IMTs."""
 
+    block_size = 0  # maximum number of sites per factor block, 0=dense
+
     def correlation_block(self, distances, imts1, imts2=None,
                           component=None, context=None):
         """Return correlation between two IMT-major site vectors.
@@ -225,16 +382,43 @@ class SpatialCrossIMTCorrelationModel(CorrelationModel):
             distances, imts, component=component, context=context)
 
     def factor(self, sites, imts, component=None, context=None,
-               ensure_psd=True):
+               ensure_psd=True, block_size=None):
         """Return the default dense factorization of :meth:`covariance`.
 
         The fast path attempts Cholesky decomposition directly. A covariance
         repair is performed only when decomposition fails and ``ensure_psd``
         is true. Models with efficient structured factorizations should
         override this method.
+
+        When ``block_size`` (by default the attribute ``.block_size``) is
+        positive and smaller than the number of sites, the sites are
+        grouped by geohash in blocks of at most ``block_size`` sites and a
+        :class:`BlockCholeskyFactor` is returned, neglecting the
+        correlation between different blocks.
         """
-        covariance = numpy.asarray(
-            self.covariance(sites, imts, component, context))
+        if block_size is None:
+            block_size = self.block_size
+        if (block_size and hasattr(sites, 'array') and
+                len(sites) > block_size):
+            num_sites = len(sites)
+            offsets = numpy.arange(len(imts))[:, None] * num_sites
+            indices, lower_triangles = [], []
+            for idxs in geohash_blocks(
+                    sites['lon'], sites['lat'], block_size):
+                mask = numpy.zeros(num_sites, bool)
+                mask[idxs] = True
+                idxs = numpy.where(mask)[0]  # sites.filter sorts them
+                covariance = self.covariance(
+                    sites.filter(mask), imts, component, context)
+                indices.append((offsets + idxs).ravel())
+                lower_triangles.append(
+                    self._dense_factor(covariance, ensure_psd))
+            return BlockCholeskyFactor(tuple(indices), tuple(lower_triangles))
+        covariance = self.covariance(sites, imts, component, context)
+        return CholeskyFactor(self._dense_factor(covariance, ensure_psd))
+
+    def _dense_factor(self, covariance, ensure_psd):
+        covariance = numpy.asarray(covariance)
         if covariance.ndim != 2 or covariance.shape[0] != covariance.shape[1]:
             raise ValueError('A correlation matrix must be square')
         self._validate_block(
@@ -244,13 +428,33 @@ class SpatialCrossIMTCorrelationModel(CorrelationModel):
         if not numpy.allclose(numpy.diag(covariance), 1):
             raise ValueError('A correlation matrix must have a unit diagonal')
         try:
-            lower_triangle = numpy.linalg.cholesky(covariance)
+            return numpy.linalg.cholesky(covariance)
         except numpy.linalg.LinAlgError:
             if not ensure_psd:
                 raise
             covariance = cov_nearest(covariance, threshold=1E-12)
-            lower_triangle = numpy.linalg.cholesky(covariance)
-        return CholeskyFactor(lower_triangle)
+            return numpy.linalg.cholesky(covariance)
+
+    def _factor_key(self, sites, imts, component=None, context=None):
+        # key of the factor in the factor_cache or None if not cacheable
+        sites_key = _sites_key(sites)
+        if sites_key is None:
+            return None
+        params = tuple(sorted((name, repr(value))
+                              for name, value in vars(self).items()
+                              if name != 'cache'))
+        return (self.__class__.__qualname__, params, sites_key,
+                tuple(str(imt) for imt in imts),
+                component and ResidualComponent(component).value,
+                context if self.DEPENDS_ON_CONTEXT else None,
+                self.block_size)
+
+    def cached_factor(self, sites, imts, component=None, context=None):
+        """Return :meth:`factor`, reusing the factors of previous calls
+        with the same sites, IMTs and model parameters."""
+        return factor_cache.get(
+            self._factor_key(sites, imts, component, context),
+            self.factor, sites, imts, component, context)
 
     def correlate(self, sites, imts, samples, component=None, context=None):
         """Correlate standard-normal samples across IMTs and sites.
@@ -272,6 +476,9 @@ class SpatialCrossIMTCorrelationModel(CorrelationModel):
 class SpatialCorrelationModel(SpatialCrossIMTCorrelationModel):
     """Same-IMT spatial correlation over a collection of sites."""
 
+    # number of neighbours of the Vecchia approximation, 0=exact factor
+    num_neighbors = 0
+
     def __init__(self):
         self.cache = {}
 
@@ -316,20 +523,29 @@ class SpatialCorrelationModel(SpatialCrossIMTCorrelationModel):
         return numpy.linalg.cholesky(
             self.correlation_matrix(sites, imt))
 
+    def _imt_factor(self, sites, imt):
+        if self.num_neighbors and len(sites) > self.num_neighbors + 1:
+            return vecchia_factor(self, sites, imt, self.num_neighbors)
+        if self.block_size and len(sites) > self.block_size:
+            return self.factor(sites, [imt], ensure_psd=False)
+        return CholeskyFactor(
+            self.get_lower_triangle_correlation_matrix(sites, imt))
+
     def apply_correlation(self, sites, imt, residuals, stddev_intra=0):
         """Apply spatial correlation to sampled within-event residuals."""
         try:
-            lower_triangle = self.cache[imt]
+            factor = self.cache[imt]
         except KeyError:
-            lower_triangle = self.get_lower_triangle_correlation_matrix(
-                sites.complete, imt)
-            self.cache[imt] = lower_triangle
+            factor = factor_cache.get(
+                self._factor_key(sites.complete, [imt]),
+                self._imt_factor, sites.complete, imt)
+            self.cache[imt] = factor
         num_complete = len(sites.complete)
         if len(sites) < num_complete:
             complete = numpy.zeros((num_complete, residuals.shape[1]))
             complete[sites.sids] = residuals
-            return (lower_triangle @ complete)[sites.sids, :]
-        return lower_triangle @ residuals
+            return factor.apply(complete)[sites.sids, :]
+        return factor.apply(residuals)
 
     def covariance(self, sites, imts, component=None, context=None):
         """Embed same-IMT matrices in IMT-major diagonal blocks."""
@@ -456,6 +672,17 @@ class TruncatedCrossIMTCorrelationModel(CrossIMTCorrelationModel):
         matrix = self._get_correlation_matrix(imts)
         return self._get_inter_eps_trunc_mvn(matrix, num_events, rng)
 
+    def get_inter_eps_streams(self, imts, eids, streams):
+        """Return an ``M x E`` matrix of event terms drawn from the
+        counter-based streams of the given events, so that the terms of an
+        event do not depend on the other events.
+
+        :param streams: a :class:`openquake.hazardlib.calc.rng.CounterRNG`
+        """
+        eps = [self.get_inter_eps(imts, 1, streams.generator(eid))[:, 0]
+               for eid in eids]
+        return numpy.array(eps).reshape(len(eids), len(imts)).T
+
     def _get_inter_eps_trunc_mvn(self, matrix, num_events, rng):
         num_imts = len(matrix)
         mean = numpy.zeros(num_imts)
@@ -18,7 +18,7 @@
 import numpy
 
 from openquake.hazardlib.correlation_models.base import (
-    ResidualComponent, TruncatedCrossIMTCorrelationModel)
+    EVENT_SID, ResidualComponent, TruncatedCrossIMTCorrelationModel)
 from openquake.hazardlib.correlation_models.registry import register_model
 
 
@@ -34,3 +34,7 @@ class FullCrossCorrelation(TruncatedCrossIMTCorrelationModel):
     def get_inter_eps(self, imts, num_events, rng):
         residuals = self.distribution.rvs(num_events, rng)
         return numpy.array([residuals for imt in imts])
+
+    def get_inter_eps_streams(self, imts, eids, streams):
+        residuals = streams.normal(eids, [EVENT_SID], 0, self.distribution)[0]
+        return numpy.array([residuals for imt in imts])
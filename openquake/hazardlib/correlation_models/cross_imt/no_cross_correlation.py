@@ -18,7 +18,7 @@
 import numpy
 
 from openquake.hazardlib.correlation_models.base import (
-    ResidualComponent, TruncatedCrossIMTCorrelationModel)
+    EVENT_SID, ResidualComponent, TruncatedCrossIMTCorrelationModel)
 from openquake.hazardlib.correlation_models.registry import register_model
 
 
@@ -34,3 +34,8 @@ class NoCrossCorrelation(TruncatedCrossIMTCorrelationModel):
     def get_inter_eps(self, imts, num_events, rng):
         return numpy.array([
             self.distribution.rvs(num_events, rng) for imt in imts])
+
+    def get_inter_eps_streams(self, imts, eids, streams):
+        return numpy.array([
+            streams.normal(eids, [EVENT_SID], m, self.distribution)[0]
+            for m in range(len(imts))])
@@ -0,0 +1,257 @@
+# The Hazard Library
+# Copyright (C) 2026 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Scalable samplers for the isotropic spatial correlation models, i.e. the
+subclasses of
+:class:`openquake.hazardlib.correlation_models.base.SpatialCorrelationModel`
+whose correlation is a function of the distance only.
+
+The dense Cholesky factor requires O(N^2) memory and O(N^3) operations,
+so it cannot be used for more than a few thousand sites. Here there are
+two alternatives:
+
+- :func:`vecchia_factor`, approximating the joint distribution with the
+  product of the distributions of each site conditioned on its nearest
+  previous neighbours; the result is a sparse factor of the precision
+  matrix requiring O(N k) memory and O(N k^3) operations, where k is
+  the number of neighbours;
+- :class:`CirculantEmbeddingSampler`, exact (up to the planar
+  approximation of the distances) for sites on a regular lon-lat grid and
+  based on the Fast Fourier Transform of the correlation function over a
+  periodic grid of double size; it requires O(N log N) operations per
+  event.
+"""
+from dataclasses import dataclass
+
+import numpy
+from scipy.spatial import KDTree
+
+from openquake.baselib.performance import compile
+from openquake.hazardlib.geo.geodetic import EARTH_RADIUS, geodetic_distance
+
+F64 = numpy.float64
+I64 = numpy.int64
+KM_PER_DEGREE = numpy.pi * EARTH_RADIUS / 180.
+NUGGET = 1E-8  # regularization for coincident sites
+
+
+@compile("(i8[:, :], f8[:, :], f8[:], f8[:, :])")
+def _vecchia_solve(neighbors, coeffs, scale, samples):
+    # x[i] = sum_j coeffs[i, j] * x[neighbors[i, j]] + scale[i] * z[i]
+    # in the Vecchia ordering, where the neighbors of i precede i
+    out = numpy.empty_like(samples)
+    for i in range(len(samples)):
+        out[i] = scale[i] * samples[i]
+        for j in range(neighbors.shape[1]):
+            n = neighbors[i, j]
+            if n >= 0:
+                out[i] += coeffs[i, j] * out[n]
+    return out
+
+
+@dataclass(frozen=True)
+class VecchiaFactor:
+    """Sparse factor built by :func:`vecchia_factor`.
+
+    ``order`` is the permutation of the sites in the Vecchia ordering,
+    ``neighbors`` the (N, k) positions in the ordering of the conditioning
+    sites (-1 for missing neighbours), ``coeffs`` the corresponding kriging
+    weights and ``scale`` the conditional standard deviations.
+    """
+
+    order: numpy.ndarray
+    neighbors: numpy.ndarray
+    coeffs: numpy.ndarray
+    scale: numpy.ndarray
+
+    @property
+    def nbytes(self):
+        return (self.order.nbytes + self.neighbors.nbytes +
+                self.coeffs.nbytes + self.scale.nbytes)
+
+    def apply(self, samples):
+        samples = numpy.asarray(samples)
+        ordered = _vecchia_solve(
+            self.neighbors, self.coeffs, self.scale,
+            numpy.ascontiguousarray(samples[self.order], F64))
+        out = numpy.empty(samples.shape, samples.dtype)
+        out[self.order] = ordered
+        return out
+
+
+def _prior_neighbors(xyz, num_neighbors):
+    # returns the (N, k) nearest previous neighbors of each point, with -1
+    # for the missing ones; the points are processed in batches [a, b)
+    # with b ~ 1.25 a, so that at least 80% of the candidates returned by
+    # a KDTree of the first b points precede the point
+    N = len(xyz)
+    k = num_neighbors
+    neighbors = numpy.full((N, k), -1, I64)
+    start = 1
+    while start < N:
+        stop = min(start + start // 4 + 1, N)
+        num = min(3 * k, stop)
+        _, idxs = KDTree(xyz[:stop]).query(xyz[start:stop], num)
+        idxs = idxs.reshape(stop - start, num)
+        for i, cands in enumerate(idxs, start):
+            prior = cands[cands < i][:k]
+            if len(prior) < min(k, i):  # rare, use brute force
+                dists = numpy.linalg.norm(xyz[:i] - xyz[i], axis=1)
+                prior = numpy.argsort(dists)[:k]
+            neighbors[i, :len(prior)] = prior
+        start = stop
+    return neighbors
+
+
+def vecchia_factor(model, sites, imt, num_neighbors=30, chunk_size=10_000,
+                   seed=42):
+    """
+    Build a Vecchia approximation of the correlation matrix of the given
+    spatial model. The sites are put in a random (but reproducible)
+    order and each one is conditioned on its `num_neighbors` nearest
+    previous sites.
+
+    :param model: a SpatialCorrelationModel instance
+    :param sites: a SiteCollection with N sites
+    :param imt: an IMT instance
+    :param num_neighbors: size of the conditioning sets
+    :param chunk_size: number of sites processed at once, to save memory
+    :param seed: seed used to build the ordering of the sites
+    :returns: a :class:`VecchiaFactor`
+    """
+    N = len(sites)
+    k = max(min(num_neighbors, N - 1), 1)
+    order = numpy.random.default_rng(seed).permutation(N)
+    lons = F64(sites['lon'][order])
+    lats = F64(sites['lat'][order])
+    neighbors = _prior_neighbors(sites.xyz[order], k)
+    coeffs = numpy.zeros((N, k))
+    scale = numpy.ones(N)
+    diag = numpy.arange(k)
+    for start in range(0, N, chunk_size):
+        slc = slice(start, start + chunk_size)
+        nbs = neighbors[slc]
+        missing = nbs < 0
+        nlons, nlats = lons[nbs], lats[nbs]
+        dist_cc = geodetic_distance(
+            nlons[:, :, None], nlats[:, :, None],
+            nlons[:, None, :], nlats[:, None, :])
+        dist_ic = geodetic_distance(
+            lons[slc, None], lats[slc, None], nlons, nlats)
+        n = len(nbs)
+        corr_cc = model.correlation_matrix(
+            F64(dist_cc).reshape(n * k, k), imt).reshape(n, k, k)
+        corr_ic = model.correlation_matrix(F64(dist_ic), imt)
+        # the missing neighbors are replaced by independent dummy points
+        corr_ic[missing] = 0
+        corr_cc[missing] = 0
+        corr_cc.transpose(0, 2, 1)[missing] = 0
+        corr_cc[:, diag, diag] = numpy.where(missing, 1., 1 + NUGGET)
+        weights = numpy.linalg.solve(corr_cc, corr_ic[:, :, None])[:, :, 0]
+        coeffs[slc] = weights
+        variance = 1 - (weights * corr_ic).sum(axis=1)
+        scale[slc] = numpy.sqrt(numpy.clip(variance, NUGGET, 1))
+    return VecchiaFactor(order, neighbors, coeffs, scale)
+
+
+def grid_shape(sites, rtol=1E-3):
+    """
+    :param sites: a SiteCollection
+    :param rtol: relative tolerance on the spacing of the grid
+    :returns: (lons, lats) of a regular grid containing the sites or None
+    """
+    lons = numpy.unique(numpy.round(F64(sites['lon']), 6))
+    lats = numpy.unique(numpy.round(F64(sites['lat']), 6))
+    if len(lons) * len(lats) != len(sites) or min(len(lons), len(lats)) < 2:
+        return None
+    for coords in (lons, lats):
+        steps = numpy.diff(coords)
+        if not numpy.allclose(steps, steps[0], rtol=rtol):
+            return None
+    return lons, lats
+
+
+class CirculantEmbeddingSampler:
+    """
+    Sampler of correlated standard normal fields for sites on a regular
+    lon-lat grid. The distances are computed on a plane tangent to the
+    center of the grid, which is accurate for grids much smaller than the
+    Earth. The correlation function is evaluated on a periodic grid of
+    size (2 nx, 2 ny) and the fields are obtained with an FFT; negative
+    eigenvalues (if any) are set to zero and their relative weight is
+    stored in the attribute ``.negative``.
+
+    :param model: a SpatialCorrelationModel instance
+    :param sites: a SiteCollection on a regular lon-lat grid
+    :param imt: an IMT instance
+    """
+    def __init__(self, model, sites, imt):
+        grid = grid_shape(sites)
+        if grid is None:
+            raise ValueError('The sites are not on a regular lon-lat grid')
+        lons, lats = grid
+        nx, ny = len(lons), len(lats)
+        dx = (lons[-1] - lons[0]) / (nx - 1) * KM_PER_DEGREE * numpy.cos(
+            numpy.radians(lats.mean()))
+        dy = (lats[-1] - lats[0]) / (ny - 1) * KM_PER_DEGREE
+        ix = numpy.arange(2 * nx)
+        iy = numpy.arange(2 * ny)
+        ix = numpy.minimum(ix, 2 * nx - ix) * dx
+        iy = numpy.minimum(iy, 2 * ny - iy) * dy
+        dists = numpy.sqrt(ix[:, None] ** 2 + iy[None, :] ** 2)
+        corr = model.correlation_matrix(dists, imt)
+        eigvals = numpy.fft.fft2(corr).real
+        self.negative = numpy.clip(-eigvals, 0, None).sum() / numpy.abs(
+            eigvals).sum()
+        self.sqrt_eigvals = numpy.sqrt(
+            numpy.clip(eigvals, 0, None) / eigvals.size)
+        self.xidx = numpy.searchsorted(
+            lons, numpy.round(F64(sites['lon']), 6))
+        self.yidx = numpy.searchsorted(
+            lats, numpy.round(F64(sites['lat']), 6))
+
+    def covariance(self):
+        """
+        :returns: the (N, N) covariance matrix of the generated fields
+        """
+        eigvals = self.sqrt_eigvals ** 2
+        circ = numpy.fft.ifft2(eigvals).real * eigvals.size
+        nx, ny = circ.shape
+        dx = (self.xidx[:, None] - self.xidx[None, :]) % nx
+        dy = (self.yidx[:, None] - self.yidx[None, :]) % ny
+        return circ[dx, dy]
+
+    def sample(self, num_events, rng, chunk_size=100):
+        """
+        :param num_events: number of fields to generate
+        :param rng: a numpy Generator
+        :param chunk_size: number of FFTs performed at once
+        :returns: an array of shape (N, E) of correlated standard normals
+        """
+        # each complex FFT gives two independent fields
+        num_ffts = (num_events + 1) // 2
+        fields = []
+        for start in range(0, num_ffts, chunk_size):
+            shape = (min(chunk_size, num_ffts - start),
+                     ) + self.sqrt_eigvals.shape
+            noise = (rng.standard_normal(shape) +
+                     1j * rng.standard_normal(shape))
+            field = numpy.fft.fft2(self.sqrt_eigvals * noise)
+            field = field[:, self.xidx, self.yidx].T  # shape (N, n)
+            fields.append(field.real)
+            fields.append(field.imag)
+        # NB: the real and imaginary parts of each chunk are adjacent
+        return numpy.concatenate(fields, axis=1)[:, :num_events]
@@ -678,6 +678,7 @@ class ModifiableGMPE(GMPE):
     DEFINED_FOR_STANDARD_DEVIATION_TYPES = {StdDev.TOTAL}
     DEFINED_FOR_TECTONIC_REGION_TYPE = ''
     DEFINED_FOR_REFERENCE_VELOCITY = None
+    shared = None  # dictionary of base predictions set by the ContextMaker
 
     def __init__(self, **kwargs):
         # Create the original GMPE
@@ -750,9 +751,19 @@ class ModifiableGMPE(GMPE):
                 self.imts_req = init_underlying_gmpes(
                     self.params["conditional_gmpe"])
             conditional_gmpe_compute(self, imts, ctx_copy, mean, sig, tau, phi)
-        else:
+        elif self.shared is None:
             # otherwise, compute the original mean and std devs for all IMTs
             self.gmpe.compute(ctx_copy, imts, mean, sig, tau, phi)
+        else:
+            # reuse the predictions of the underlying GMPE, if already
+            # computed by another GSIM on the same context
+            vs30 = None if ctx_copy is ctx else ctx_copy.vs30[0]
+            key = (str(self.gmpe).strip(), id(ctx), vs30)
+            try:
+                mean[:], sig[:], tau[:], phi[:] = self.shared[key]
+            except KeyError:
+                self.gmpe.compute(ctx_copy, imts, mean, sig, tau, phi)
+                self.shared[key] = np.array([mean, sig, tau, phi])
 
         # Compute reference PGA for the CEUS2020 site term
         if 'ceus2020_site_term' in self.params:
@@ -123,21 +123,31 @@ def compute_hazard_maps(curves, imls, poes):
         warnings.simplefilter("ignore")
         # avoid RuntimeWarning: divide by zero for zero levels
         imls = numpy.log(numpy.array(imls[::-1]))
-    for n, curve in enumerate(curves):
-        # the hazard curve, having replaced the too small poes with EPSILON
-        log_curve = numpy.log([max(poe, EPSILON) for poe in curve[::-1]])
-        for p, log_poe in enumerate(log_poes):
-            if log_poe > log_curve[-1]:
-                # special case when the interpolation poe is bigger than the
-                # maximum, i.e the iml must be smaller than the minimum;
-                # extrapolate the iml to zero as per
-                # https://bugs.launchpad.net/oq-engine/+bug/1292093;
-                # then the hmap goes automatically to zero
-                pass
-            else:
-                # exp-log interpolation, to reduce numerical errors
-                # see https://bugs.launchpad.net/oq-engine/+bug/1252770
-                hmap[n, p] = numpy.exp(numpy.interp(log_poe, log_curve, imls))
+    # the hazard curves, having replaced the too small poes with EPSILON
+    log_curves = numpy.log(numpy.maximum(curves[:, ::-1], EPSILON)).astype(F64)
+    for p, log_poe in enumerate(log_poes):
+        # when the interpolation poe is bigger than the maximum, i.e the
+        # iml must be smaller than the minimum, extrapolate the iml to
+        # zero as per https://bugs.launchpad.net/oq-engine/+bug/1292093;
+        # then the hmap goes automatically to zero
+        ok, = numpy.where(log_poe <= log_curves[:, -1])
+        # exp-log interpolation, to reduce numerical errors
+        # see https://bugs.launchpad.net/oq-engine/+bug/1252770;
+        # this is numpy.interp(log_poe, log_curve, imls) vectorized
+        # over the curves, being j the last index with log_curve <= log_poe
+        lcs = log_curves[ok]
+        j = (lcs <= log_poe).sum(axis=1) - 1
+        vals = numpy.where(j < 0, imls[0], imls[-1])  # extrema
+        mid, = numpy.where((j >= 0) & (j < L - 1))
+        j0 = j[mid]
+        x0 = lcs[mid, j0]
+        x1 = lcs[mid, j0 + 1]
+        y0 = imls[j0]
+        y1 = imls[j0 + 1]
+        with numpy.errstate(invalid='ignore'):
+            vals[mid] = numpy.where(log_poe == x0, y0, y0 + (
+                y1 - y0) / (x1 - x0) * (log_poe - x0))
+        hmap[ok, p] = numpy.exp(vals)
     return hmap
 
 
@@ -542,32 +552,108 @@ def to_rates(ratesNLG, sids, g, i, level0):
 
 class RateMap:
     """
-    A kind of MapArray specifically for rates
+    A map of rates of shape (N, L, G) storing a dense block of shape (L, G)
+    only for the sites which received some rates. The rows are allocated
+    in order of arrival and the capacity is doubled when needed, up to N,
+    so that the memory never exceeds the one of a dense map.
     """
-    sidx = MapArray.sidx
-    size_mb = MapArray.size_mb
-    __repr__ = MapArray.__repr__
     level0 = 0
 
     def __init__(self, sids, L, gids):
         self.sids = sids
         self.shape = len(sids), L, len(gids)
-        self.array = numpy.zeros(self.shape, F32)
         self.gdic = {g: j for j, g in enumerate(gids)}
+        self.array = numpy.zeros((0, L, len(gids)), F32)
+        self.rsids = numpy.zeros(0, U32)  # site ID for each row
+        self.nrows = 0
+
+    @cached_property
+    def sidx(self):
+        """
+        :returns: an array site_id -> row, with -1 for the missing sites
+        """
+        sidx = numpy.full(self.sids.max() + 1, -1, numpy.int32)
+        sidx[self.rsids[:self.nrows]] = numpy.arange(self.nrows)
+        return sidx
+
+    @property
+    def size_mb(self):
+        return (self.array.nbytes + self.rsids.nbytes) / TWO20
+
+    def __repr__(self):
+        tup = self.shape + (humansize(self.size_mb * TWO20),)
+        return f'<{self.__class__.__name__}(%d, %d, %d)[%s]>' % tup
+
+    def __getstate__(self):
+        # send only the used rows
+        dic = self.__dict__.copy()
+        dic.pop('sidx', None)
+        dic['array'] = self.array[:self.nrows]
+        dic['rsids'] = self.rsids[:self.nrows]
+        return dic
+
+    def _get_rows(self, sids):
+        # returns the rows associated to the given site IDs,
+        # allocating the missing ones
+        rows = self.sidx[sids]
+        new = rows < 0
+        if new.any():
+            newsids = sids[new]
+            n0, n1 = self.nrows, self.nrows + len(newsids)
+            capacity = len(self.array)
+            if n1 > capacity:
+                capacity = max(n1, min(2 * capacity, self.shape[0]))
+                if not self.array.flags.owndata:  # i.e. unpickled
+                    self.array = self.array.copy()
+                    self.rsids = self.rsids.copy()
+                # NB: resizing reuses the memory when possible
+                # and fills the new rows with zeros
+                self.array.resize((capacity,) + self.shape[1:], refcheck=False)
+                self.rsids.resize(capacity, refcheck=False)
+            rows[new] = numpy.arange(n0, n1)
+            self.sidx[newsids] = rows[new]
+            self.rsids[n0:n1] = newsids
+            self.nrows = n1
+        return rows
 
     def __iadd__(self, other):
-        sidx = self.sidx[other.sids]
+        if isinstance(other, RateMap):
+            n = other.nrows
+            rows = self._get_rows(other.rsids[:n])
+            for g, i in other.gdic.items():
+                self.array[rows, :, self.gdic[g]] += other.array[:n, :, i]
+            return self
+        # MapArray with a .gid attribute; discard the sites without rates
+        ok = other.array.any(axis=(1, 2))
+        if ok.all():
+            sids, array = other.sids, other.array
+        else:
+            sids, array = other.sids[ok], other.array[ok]
+        rows = self._get_rows(sids)
         for i, g in enumerate(other.gid):
-            oarray = other.array[:, :, i]
-            self.array[sidx, :, self.gdic[g]] += oarray
+            self.array[rows, :, self.gdic[g]] += array[:, :, i]
         return self
 
-    def to_array(self, g):
+    def to_array(self, g=None):
         """
-        Assuming self contains an array of rates,
-        returns a composite array with fields sid, lid, gid, rate
+        Returns a composite array with fields sid, lid, gid, rate
+        for the given gid (or for all gids if g is None), ordered by
+        site ID and discarding the zero rates
         """
-        return to_rates(self.array, self.sids, g, self.gdic[g], self.level0)
+        gids = list(self.gdic) if g is None else [g]
+        order = numpy.argsort(self.rsids[:self.nrows])
+        sids = self.rsids[order]
+        out = []
+        for g in gids:
+            rates = self.array[order, :, self.gdic[g]]
+            s, lid = numpy.nonzero(rates)
+            recs = numpy.zeros(len(s), rates_dt)
+            recs['sid'] = sids[s]
+            recs['lid'] = lid + self.level0
+            recs['gid'] = g
+            recs['rate'] = rates[s, lid]
+            out.append(recs)
+        return numpy.concatenate(out)
 
     def split(self, L1):
         """
@@ -579,8 +665,10 @@ class RateMap:
             new = object.__new__(self.__class__)
             new.sids = self.sids
             new.shape = len(self.sids), L1, len(self.gdic)
-            new.array = self.array[:, lvl:lvl+L1, :]
             new.gdic = self.gdic
+            new.array = self.array[:self.nrows, lvl:lvl+L1, :]
+            new.rsids = self.rsids[:self.nrows]
+            new.nrows = self.nrows
             new.level0 = lvl
             out.append(new)
         return out
@@ -631,7 +631,9 @@ def _strip_colons(sources):
 
 def get_allargs(csm, cmdict, sitecol, max_weight, num_chunks, tiling):
     """
-    Generates task arguments from atomic and non-atomic groups
+    Generates task arguments from atomic and non-atomic groups, i.e.
+    tuples (cmaker, tilegetters, grp_keys, weights, atomic) where
+    `weights` is a list with the weight associated to each grp_key
     """
     out = []
     atomic = []
@@ -644,21 +646,25 @@ def get_allargs(csm, cmdict, sitecol, max_weight, num_chunks, tiling):
         else:
             if n > 1:
                 grp_keys = [f'{grp_id}-{b}' for b in range(len(blocks))]
+                weights = [sum(src.weight for src in blk) for blk in blocks]
             else:
                 grp_keys = [str(grp_id)]
-            out.append((cmaker, tilegetters, grp_keys, False))
+                weights = [extra['weight']]
+            out.append((cmaker, tilegetters, grp_keys, weights, False))
     # collect the atomic groups
     blocks_ = AccumDict(accum=[])
+    weights_ = AccumDict(accum=[])
     tilegetters_ = {}
     cmaker_ = {}
     for cmaker, tilegetters, blocks, extra in atomic:
         gid = tuple(cmaker.gid)
         tilegetters_[gid] = tilegetters
         blocks_[gid].extend(blocks)
+        weights_[gid].extend([extra['weight'] / len(blocks)] * len(blocks))
         cmaker_[gid] = cmaker
     for gid, tgetters in tilegetters_.items():
         grp_keys = [str(grp_id) for grp_id in blocks_[gid]]
-        out.append((cmaker_[gid], tgetters, grp_keys, True))
+        out.append((cmaker_[gid], tgetters, grp_keys, weights_[gid], True))
     if atomic:
         logging.info('Collapsed %d atomic tasks into %d',
                      len(atomic), len(cmaker_))
@@ -368,7 +368,7 @@ def build_csm(oq, full_lt, smdict, dstore):
     return csm
 
 
-# called by reduce_sources
+# called by reduce_sources and _build_csm
 def add_checksums(srcs):
     """
     Build and attach a checksum to each source
@@ -595,6 +595,8 @@ def _build_csm(oq, full_lt, groups, event_based):
                 src.sampling = numpy.concatenate(
                     src.sampling, dtype=sampling_dt)
         splitMF(grp.sources, oq.disagg_by_src)
+        if oq.ctx_cache_dir:  # the checksums are the keys of the cache
+            add_checksums(src for src in grp if not src.checksum)
         if grp and grp.atomic:
             atomic.append(grp)
         elif grp:
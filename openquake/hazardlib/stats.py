@@ -203,15 +203,117 @@ def quantile_curve(quantile, curves, weights=None):
     else:
         weights = numpy.array(weights)
         assert len(weights) == R, (len(weights), R)
-    result = numpy.zeros(curves.shape[1:])
-    for idx, _ in numpy.ndenumerate(result):
-        cw = numpy.zeros(R, cw_dt)  # (curve, weight)
-        cw['c'] = curves[(slice(None), ) + idx]
-        cw['w'] = weights
-        cw.sort(order='c')
-        # get the quantile from the interpolated CDF
-        result[idx] = numpy.interp(quantile, cw['w'].cumsum(), cw['c'])
-    return result
+    shp = curves.shape[1:]
+    curves = curves.reshape(R, -1)  # shape (R, K)
+    # sort the curves (ties broken by weight) and build the cumulative
+    # weights for each column
+    ws = numpy.broadcast_to(weights[:, None], curves.shape)
+    idx = numpy.lexsort((ws, curves), axis=0)
+    cs = numpy.take_along_axis(curves, idx, 0)
+    cw = weights[idx].cumsum(axis=0)
+    # get the quantile from the interpolated CDF, as numpy.interp does
+    j = numpy.clip((cw <= quantile).sum(axis=0) - 1, 0, R - 1)
+    j1 = numpy.minimum(j + 1, R - 1)
+    cols = numpy.arange(cs.shape[1])
+    x0, x1 = cw[j, cols], cw[j1, cols]
+    y0, y1 = cs[j, cols], cs[j1, cols]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        result = (y1 - y0) / (x1 - x0) * (quantile - x0) + y0
+    result = numpy.where(
+        (quantile <= x0) | (j == j1) | numpy.isnan(result), y0, result)
+    result = numpy.where(quantile >= cw[-1], cs[-1], result)
+    return result.reshape(shp)
+
+
+class QuantileSketch(object):
+    """
+    Mergeable sketch of weighted distributions, one per element of an
+    array of the given shape (a vectorized DDSketch). The values are
+    accumulated in logarithmic buckets (gamma^(k-1), gamma^k] with
+    gamma = (1 + accuracy) / (1 - accuracy), independently from the number
+    of values; values below `minval` end up in a zero bucket.
+
+    The relative error on the quantiles with respect to
+    :func:`quantile_curve` is below gamma - 1, i.e. about 2 * accuracy,
+    when the values are sparse (at most one per bucket) or dense (the
+    gaps between consecutive values are smaller than a bucket, as it
+    happens with large logic trees). In between, the error is bounded by
+    the relative gap between consecutive values and can be larger.
+
+    >>> sk = QuantileSketch((2,), accuracy=.01)
+    >>> sk.add(numpy.array([[.1, .2], [.3, .4], [.5, .6]]))
+    >>> numpy.round(sk.quantile(.5), 2)
+    array([0.2, 0.3])
+    >>> quantile_curve(.5, numpy.array([[.1, .2], [.3, .4], [.5, .6]]))
+    array([0.2, 0.3])
+    """
+    def __init__(self, shape, accuracy=.01, minval=1E-12, maxval=1.):
+        self.shape = shape
+        self.accuracy = accuracy
+        self.minval = minval
+        self.gamma = (1. + accuracy) / (1. - accuracy)
+        self.kmin = math.ceil(math.log(minval) / math.log(self.gamma))
+        kmax = math.ceil(math.log(maxval) / math.log(self.gamma))
+        self.B = kmax - self.kmin + 2  # the bucket 0 is for the zeros
+        self.weights = numpy.zeros(shape + (self.B,))
+
+    def add(self, values, weights=None):
+        """
+        :param values: an array of shape (R,) + shape
+        :param weights: an array of shape (R,) or (R,) + shape or None
+        """
+        R = len(values)
+        if weights is None:
+            weights = numpy.ones(R)
+        weights = numpy.broadcast_to(
+            weights.reshape(weights.shape + (1,) * (
+                values.ndim - weights.ndim)), values.shape)
+        idxs = numpy.zeros(values.shape, int)
+        ok = values >= self.minval
+        idxs[ok] = numpy.ceil(
+            numpy.log(values[ok]) / math.log(self.gamma)) - self.kmin + 1
+        idxs = numpy.clip(idxs, 0, self.B - 1).reshape(R, -1)
+        offsets = numpy.arange(idxs.shape[1]) * self.B
+        self.weights += numpy.bincount(
+            (idxs + offsets).flatten(), weights.reshape(R, -1).flatten(),
+            self.weights.size).reshape(self.weights.shape)
+
+    def __iadd__(self, other):
+        assert other.weights.shape == self.weights.shape, (
+            other.weights.shape, self.weights.shape)
+        assert other.gamma == self.gamma, (other.gamma, self.gamma)
+        self.weights += other.weights
+        return self
+
+    def quantile(self, q):
+        """
+        :param q: a probability in the range [0, 1]
+        :returns: an array of the given shape with the quantiles
+
+        The quantiles are interpolated on the weighted CDF of the
+        buckets, consistently with :func:`quantile_curve`.
+        """
+        # value of the buckets, i.e. the upper edge of (gamma^(k-1), gamma^k];
+        # then the interpolated quantile of sparse values is overestimated
+        # at most by a factor gamma
+        vals = self.gamma ** (numpy.arange(self.B) - 1. + self.kmin)
+        vals[0] = 0.
+        cum = self.weights.cumsum(axis=-1)
+        qt = q * cum[..., -1:]
+        first = (cum <= 0).sum(axis=-1, keepdims=True)  # first nonempty
+        last = (cum < cum[..., -1:]).sum(axis=-1, keepdims=True)
+        j1 = (cum <= qt).sum(axis=-1, keepdims=True)  # first bucket above
+        j1c = numpy.minimum(j1, self.B - 1)
+        x0 = numpy.take_along_axis(cum, numpy.maximum(j1 - 1, 0), -1)
+        x1 = numpy.take_along_axis(cum, j1c, -1)
+        y0 = vals[(cum < x0).sum(axis=-1, keepdims=True)]
+        y1 = vals[j1c]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            res = y0 + (y1 - y0) * (qt - x0) / (x1 - x0)
+        res = numpy.where(j1 <= first, vals[numpy.minimum(
+            first, self.B - 1)], res)
+        res = numpy.where(j1 >= self.B, vals[last], res)
+        return res[..., 0]
 
 
 def weighted_quantiles(qs, values, weights):
@@ -0,0 +1,118 @@
+# The Hazard Library
+# Copyright (C) 2026 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import pandas
+import pytest
+
+from openquake.hazardlib.calc.gmf import GmfComputer
+from openquake.hazardlib.contexts import ContextMaker
+from openquake.hazardlib.correlation_models.base import (
+    BlockCholeskyFactor, geohash_blocks)
+from openquake.hazardlib.correlation_models.cross_imt.\
+    full_cross_correlation import FullCrossCorrelation
+from openquake.hazardlib.correlation_models.cross_imt.\
+    goda_atkinson_2009 import GodaAtkinson2009
+from openquake.hazardlib.correlation_models.cross_imt.\
+    no_cross_correlation import NoCrossCorrelation
+from openquake.hazardlib.correlation_models.sampling import vecchia_factor
+from openquake.hazardlib.correlation_models.spatial.\
+    jayaram_baker_2009 import JayaramBaker2009
+from openquake.hazardlib.geo import Point
+from openquake.hazardlib.gsim.boore_atkinson_2008 import BooreAtkinson2008
+from openquake.hazardlib.site import SiteCollection
+from openquake.hazardlib.source.rupture import EBRupture, build_planar
+
+E = 10  # number of events
+
+
+class DirectFactor(JayaramBaker2009):
+    # applies the factor returned by the given function of (sites, imt)
+    def __init__(self, get_factor):
+        super().__init__(False)
+        self.get_factor = get_factor
+
+    def _imt_factor(self, sites, imt):
+        return self.get_factor(sites, imt)
+
+
+def _block_factor(sites, imt, block_size=5):
+    model = JayaramBaker2009(False)
+    indices, lower_triangles = [], []
+    for idxs in geohash_blocks(sites['lon'], sites['lat'], block_size):
+        idxs = numpy.sort(idxs)
+        indices.append(idxs)
+        lower_triangles.append(numpy.linalg.cholesky(
+            model.correlation_matrix(sites.filtered(idxs), imt)))
+    return BlockCholeskyFactor(tuple(indices), tuple(lower_triangles))
+
+
+def _vecchia_factor(sites, imt, num_neighbors=5):
+    return vecchia_factor(JayaramBaker2009(False), sites, imt, num_neighbors)
+
+
+def _gmfs(between_model, eslice=slice(None), counter_based_rng=True,
+          within_model=None):
+    rupture = build_planar(Point(10, 45, 10), mag=6.5, rake=0,
+                           trt='Active Shallow Crust')
+    rng = numpy.random.default_rng(1)
+    sites = SiteCollection.from_points(
+        rng.uniform(9.9, 10.1, 20), rng.uniform(44.9, 45.1, 20),
+        req_site_params=['vs30'])
+    sites.array['vs30'] = 760.
+    cmaker = ContextMaker(
+        rupture.tectonic_region_type,
+        {BooreAtkinson2008(): numpy.uint32([0])},
+        dict(truncation_level=3,
+             imtls={'PGA': [0.], 'SA(0.3)': [0.], 'SA(1.0)': [0.]}))
+    cmaker.oq.calculation_mode = 'scenario'
+    cmaker.oq.counter_based_rng = counter_based_rng
+    ebr = EBRupture(rupture, source_id=0, trt_smr=0, n_occ=E, id=0, e0=0)
+    ebr.seed = 42
+    if within_model is None:
+        within_model = JayaramBaker2009(False)
+    gc = GmfComputer(ebr, sites, cmaker, within_model, between_model(3.))
+    gc.eslice = eslice
+    return gc.compute_all().sort_values(['eid', 'sid'], ignore_index=True)
+
+
+@pytest.mark.parametrize('between_model', [
+    NoCrossCorrelation, FullCrossCorrelation, GodaAtkinson2009])
+def test_counter_based_rng_chunks(between_model):
+    # the events can be split in chunks with bit-identical GMFs
+    full = _gmfs(between_model)
+    assert sorted(full.eid.unique()) == list(range(E))
+    chunks = pandas.concat([_gmfs(between_model, slice(0, 3)),
+                            _gmfs(between_model, slice(3, None))],
+                           ignore_index=True)
+    pandas.testing.assert_frame_equal(chunks, full)
+
+    # with the sequential generator the chunks are different
+    seq = [_gmfs(between_model, slice(0, 3), False),
+           _gmfs(between_model, slice(3, None), False)]
+    assert not numpy.allclose(seq[1]['PGA'], full['PGA'][len(seq[0]):])
+
+
+@pytest.mark.parametrize('attr, get_factor', [
+    ('block_size', _block_factor), ('num_neighbors', _vecchia_factor)])
+def test_approximate_factors(attr, get_factor):
+    # the GMFs are the same as applying the factor built directly
+    model = JayaramBaker2009(False)
+    setattr(model, attr, 5)
+    gmfs = _gmfs(NoCrossCorrelation, within_model=model)
+    expected = _gmfs(NoCrossCorrelation, within_model=DirectFactor(get_factor))
+    pandas.testing.assert_frame_equal(gmfs, expected)
+    assert not numpy.allclose(gmfs['PGA'], _gmfs(NoCrossCorrelation)['PGA'])
@@ -0,0 +1,58 @@
+# The Hazard Library
+# Copyright (C) 2026 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy
+from openquake.hazardlib.calc.rng import CounterRNG, philox4x32
+
+
+class CounterRNGTestCase(unittest.TestCase):
+    def test_philox_known_answers(self):
+        # test vectors of the Random123 library
+        numpy.testing.assert_equal(
+            philox4x32([0, 0, 0, 0], [0, 0]),
+            [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8])
+        numpy.testing.assert_equal(
+            philox4x32([0xffffffff] * 4, [0xffffffff] * 2),
+            [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd])
+        numpy.testing.assert_equal(
+            philox4x32([0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344],
+                       [0xa4093822, 0x299f31d0]),
+            [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1])
+
+    def test_split_invariance(self):
+        rng = CounterRNG(42)
+        eids = numpy.arange(1000, dtype=numpy.uint32)
+        sids = numpy.arange(50, dtype=numpy.uint32)
+        eps = rng.normal(eids, sids, idx=2)
+        self.assertEqual(eps.shape, (50, 1000))
+        numpy.testing.assert_equal(
+            numpy.concatenate([rng.normal(eids[:300], sids, 2),
+                               rng.normal(eids[300:], sids, 2)], axis=1), eps)
+        numpy.testing.assert_equal(rng.normal(eids, sids[7:9], 2), eps[7:9])
+        # different indices and seeds give different numbers
+        self.assertFalse((rng.normal(eids, sids, 3) == eps).any())
+        self.assertFalse((CounterRNG(43).normal(eids, sids, 2) == eps).any())
+        self.assertAlmostEqual(eps.mean(), 0, delta=.01)
+        self.assertAlmostEqual(eps.std(), 1, delta=.01)
+
+    def test_generator(self):
+        rng = CounterRNG(42)
+        numpy.testing.assert_equal(rng.generator(3).random(5),
+                                   rng.generator(3).random(5))
+        # no overlaps between consecutive seeds and events
+        self.assertNotEqual(rng.generator(3).random(),
+                            CounterRNG(43).generator(2).random())
@@ -17,13 +17,16 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
 import unittest
+from unittest import mock
 import numpy
 
 from openquake.baselib.general import DictArray, gettemp
 from openquake.baselib.performance import Monitor
 from openquake.hazardlib import site
 from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.map_array import MapArray
 from openquake.hazardlib.const import TRT
 from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.contexts import Effect, ContextMaker, get_distances
@@ -367,6 +370,77 @@ class PlanarDistancesTestCase(unittest.TestCase):
             dist = get_distances_planar(planar, sites, par)[0]
             aac(dist, ctx[par], err_msg=par)
 
+    def test_ctx_cache(self):
+        trt = TRT.ACTIVE_SHALLOW_CRUST
+        mfd = ArbitraryMFD([6.0, 7.0], [.1, .01])
+        npd = PMF([(1.0, NodalPlane(90., 90., 90.))])
+        hdd = PMF([(1.0, 10.)])
+        src = PointSource(
+            "ps", "pointsource", trt, mfd, 2.5, WC1994(), 1., PoissonTOM(1.),
+            0., 20., Point(0.0, 0.0), npd, hdd)
+        src.checksum = 42
+        src.offset = 100
+        sites = SiteCollection([Site(Point(0.25, 0.0, 0.0)),
+                                Site(Point(0.35, 0.0, 0.0))])
+        cachedir = os.path.dirname(gettemp(suffix='.npz'))
+        gsims = [valid.gsim('GulerceEtAl2017'), valid.gsim('Atkinson2015')]
+        param = dict(imtls={'PGA': [.01]}, ctx_cache_dir=cachedir)
+        cmaker = ContextMaker(trt, gsims, param)
+        ctxs = list(cmaker.get_ctxs(src, sites))  # store the cache
+        fname = cmaker.ctx_cache.get_fname(cmaker, src, sites)
+        self.assertTrue(os.path.exists(fname))
+        self.assertEqual(len(ctxs), 2)  # one per magnitude
+
+        # the site collection is hashed only once
+        with mock.patch('hashlib.md5', wraps=hashlib.md5) as md5:
+            self.assertEqual(cmaker.ctx_cache.get_fname(cmaker, src, sites),
+                             fname)
+        self.assertEqual(md5.call_count, 1)  # only the source key
+        other = SiteCollection([Site(Point(0.25, 0.0, 0.0))])
+        self.assertNotEqual(cmaker.ctx_cache.get_fname(cmaker, src, other),
+                            fname)
+
+        # read from the cache with a different offset
+        src.offset = 200
+        cached = list(cmaker.get_ctxs(src, sites))
+        for ctx, ca in zip(ctxs, cached):
+            self.assertEqual(ctx.dtype, ca.dtype)
+            aac(ca.rup_id, ctx.rup_id + 100)
+            aac(ca.rrup, ctx.rrup)
+
+        # a different GSIM needing less parameters reuses the cache
+        cmaker2 = ContextMaker(trt, gsims[1:], param)
+        cached2 = list(cmaker2.get_ctxs(src, sites))
+        self.assertLess(len(cached2[0].dtype.names), len(ctxs[0].dtype.names))
+        for ctx, ca in zip(ctxs, cached2):
+            aac(ca.rhypo, ctx.rhypo)
+            aac(ca.mag, ctx.mag)
+
+    def test_fused_kernel(self):
+        trt = TRT.ACTIVE_SHALLOW_CRUST
+        mfd = ArbitraryMFD([6.0, 7.0], [.1, .01])
+        npd = PMF([(1.0, NodalPlane(90., 90., 90.))])
+        hdd = PMF([(1.0, 10.)])
+        src = PointSource(
+            "ps", "pointsource", trt, mfd, 2.5, WC1994(), 1., PoissonTOM(1.),
+            0., 20., Point(0.0, 0.0), npd, hdd)
+        sites = SiteCollection([Site(Point(0.25, 0.0, 0.0)),
+                                Site(Point(0.35, 0.0, 0.0))])
+        gsims = [valid.gsim('BooreEtAl2014'), valid.gsim('Atkinson2015')]
+        imtls = {'PGA': [.01, .1, .2], 'SA(1.0)': [.01, .1, .2]}
+        cmaker = ContextMaker(trt, gsims, dict(imtls=imtls,
+                                               truncation_level=3.))
+        cmaker.tom = PoissonTOM(50.)
+        ctx = cmaker.from_srcs([src], sites)
+        self.assertTrue(cmaker.fused(ctx))
+        for rates in (False, True):
+            pmap1 = MapArray(sites.sids, 6, 2, rates).fill(not rates)
+            pmap2 = MapArray(sites.sids, 6, 2, rates).fill(not rates)
+            cmaker.update(pmap1, ctx)  # fused
+            for poes, _mea, _sig, _tau, ctxt in cmaker.gen_poes(ctx):
+                pmap2.update_indep(poes, ctxt, 50.)
+            numpy.testing.assert_array_equal(pmap1.array, pmap2.array)
+
     def test_from_planar(self):
         s = site.Site(Point(0, 0), vs30=760,
                       vs30measured=False, z1pt0=20, z2pt5=30)
@@ -0,0 +1,129 @@
+# The Hazard Library
+# Copyright (C) 2026 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+
+from openquake.hazardlib.correlation_models.sampling import (
+    NUGGET, CirculantEmbeddingSampler, grid_shape, vecchia_factor)
+from openquake.hazardlib.correlation_models.spatial.\
+    jayaram_baker_2009 import JayaramBaker2009
+from openquake.hazardlib.imt import PGA, SA
+from openquake.hazardlib.site import SiteCollection
+
+
+def _random_sites(num_sites):
+    rng = numpy.random.default_rng(1)
+    return SiteCollection.from_points(
+        rng.uniform(10, 10.5, num_sites), rng.uniform(45, 45.5, num_sites))
+
+
+def _grid_sites(nx, ny):
+    lons, lats = numpy.meshgrid(numpy.linspace(10, 10.5, nx),
+                                numpy.linspace(45, 45.4, ny))
+    return SiteCollection.from_points(lons.ravel(), lats.ravel())
+
+
+def _vecchia_covariance(factor, num_sites):
+    lower = factor.apply(numpy.eye(num_sites))
+    return lower @ lower.T
+
+
+@pytest.mark.parametrize('imt', [PGA(), SA(1.0)])
+def test_vecchia_converges_to_cholesky(imt):
+    # accuracy benchmark on 400 random sites against the exact matrix
+    sites = _random_sites(400)
+    model = JayaramBaker2009(vs30_clustering=False)
+    exact = model.correlation_matrix(sites, imt)
+    errors = []
+    for num_neighbors in (5, 10, 30):
+        factor = vecchia_factor(model, sites, imt, num_neighbors)
+        covariance = _vecchia_covariance(factor, len(sites))
+        errors.append(numpy.abs(covariance - exact).max())
+    assert errors[0] > errors[1] > errors[2]
+    assert errors[2] < .015
+
+
+def test_vecchia_is_exact_with_all_neighbors():
+    sites = _random_sites(20)
+    model = JayaramBaker2009(vs30_clustering=True)
+    exact = model.correlation_matrix(sites, SA(0.5))
+    factor = vecchia_factor(model, sites, SA(0.5), num_neighbors=30)
+    numpy.testing.assert_allclose(
+        _vecchia_covariance(factor, 20), exact, atol=1E-6)
+    # the factor is applied to samples of shape (N, E)
+    samples = numpy.random.default_rng(42).standard_normal((20, 5))
+    assert factor.apply(samples).shape == (20, 5)
+
+
+def test_vecchia_conditional_structure():
+    # in the Vecchia ordering each site depends only on its neighbours,
+    # with the kriging weights and variance of the exact correlations
+    sites = _random_sites(50)
+    model = JayaramBaker2009(vs30_clustering=False)
+    factor = vecchia_factor(model, sites, PGA(), num_neighbors=5)
+    order = factor.order
+    exact = model.correlation_matrix(sites, PGA())[numpy.ix_(order, order)]
+    lower = factor.apply(numpy.eye(50))[numpy.ix_(order, order)]
+    inverse = numpy.linalg.inv(lower)
+    for i, nbs in enumerate(factor.neighbors):
+        nbs = nbs[nbs >= 0]
+        weights = numpy.linalg.solve(
+            exact[numpy.ix_(nbs, nbs)] + NUGGET * numpy.eye(len(nbs)),
+            exact[nbs, i])
+        expected = numpy.zeros(50)
+        expected[i] = 1
+        expected[nbs] = -weights
+        numpy.testing.assert_allclose(
+            inverse[i] * factor.scale[i], expected, atol=1E-6)
+        numpy.testing.assert_allclose(
+            factor.scale[i] ** 2, 1 - weights @ exact[nbs, i], atol=1E-6)
+
+
+def test_vecchia_in_apply_correlation():
+    sites = _random_sites(100)
+    model = JayaramBaker2009(vs30_clustering=False)
+    model.num_neighbors = 10
+    residuals = numpy.random.default_rng(42).standard_normal((100, 3))
+    expected = vecchia_factor(model, sites, PGA(), 10).apply(residuals)
+    numpy.testing.assert_allclose(
+        model.apply_correlation(sites, PGA(), residuals), expected)
+
+
+def test_grid_shape():
+    assert grid_shape(_random_sites(20)) is None
+    lons, lats = grid_shape(_grid_sites(4, 5))
+    assert (len(lons), len(lats)) == (4, 5)
+    with pytest.raises(ValueError, match='not on a regular lon-lat grid'):
+        CirculantEmbeddingSampler(
+            JayaramBaker2009(False), _random_sites(20), PGA())
+
+
+def test_circulant_embedding_against_cholesky():
+    # accuracy benchmark on a 15x20 grid against the exact matrix; the
+    # difference is due to the planar approximation of the distances
+    sites = _grid_sites(15, 20)
+    model = JayaramBaker2009(vs30_clustering=False)
+    exact = model.correlation_matrix(sites, SA(1.0))
+    sampler = CirculantEmbeddingSampler(model, sites, SA(1.0))
+    assert sampler.negative < 1E-6
+    numpy.testing.assert_allclose(sampler.covariance(), exact, atol=2E-3)
+
+    # the sampled fields have the expected correlation
+    fields = sampler.sample(5001, numpy.random.default_rng(42))
+    assert fields.shape == (300, 5001)
+    numpy.testing.assert_allclose(fields.std(axis=1), 1, atol=.05)
+    numpy.testing.assert_allclose(numpy.corrcoef(fields), exact, atol=.08)
@@ -20,7 +20,8 @@ import pytest
 from openquake.hazardlib import const, correlation, cross_correlation
 from openquake.hazardlib import correlation_models
 from openquake.hazardlib.correlation_models.base import (
-    ResidualComponent, SpatialCrossIMTCorrelationModel)
+    BlockCholeskyFactor, CholeskyFactor, ResidualComponent,
+    SpatialCrossIMTCorrelationModel, factor_cache, geohash_blocks)
 from openquake.hazardlib.correlation_models.cross_imt.baker_cornell_2006 import (
     BakerCornell2006)
 from openquake.hazardlib.correlation_models.cross_imt.baker_jayaram_2008 import (
@@ -43,6 +44,7 @@ from openquake.hazardlib.correlation_models.spatial_cross_imt.\
     wang_du_2013 import (
         WangDu2013PGAIAPGV, WangDu2013SpectralAcceleration)
 from openquake.hazardlib.imt import IA, PGA, PGV, SA
+from openquake.hazardlib.site import SiteCollection
 
 
 def test_registry_aliases_and_metadata():
@@ -187,6 +189,68 @@ def test_default_factor_repairs_indefinite_covariance():
     assert numpy.linalg.eigvalsh(repaired).min() > 0
 
 
+def _random_sitecol(num_sites, seed=42):
+    rng = numpy.random.default_rng(seed)
+    return SiteCollection.from_points(
+        rng.uniform(10, 11, num_sites), rng.uniform(45, 46, num_sites))
+
+
+def test_geohash_blocks_partition_the_sites():
+    sitecol = _random_sitecol(500)
+    blocks = geohash_blocks(sitecol['lon'], sitecol['lat'], 60)
+    assert max(map(len, blocks)) <= 60
+    numpy.testing.assert_array_equal(
+        numpy.sort(numpy.concatenate(blocks)), numpy.arange(500))
+    # blocks are spatially compact
+    sizes = [numpy.ptp(sitecol['lon'][block]) for block in blocks]
+    assert numpy.median(sizes) < .5
+
+
+def test_block_factor_is_exact_within_blocks():
+    sitecol = _random_sitecol(100)
+    imts = [PGA(), SA(1.0)]
+    model = JayaramBaker2009(vs30_clustering=False)
+    dense = model.factor(sitecol, imts)
+    assert isinstance(dense, CholeskyFactor)
+    covariance = model.covariance(sitecol, imts)
+    blocked = model.factor(sitecol, imts, block_size=30)
+    assert isinstance(blocked, BlockCholeskyFactor)
+    assert blocked.nbytes < dense.nbytes
+    # the covariance is exact within the blocks and zero between them
+    lower = blocked.apply(numpy.eye(len(covariance)))
+    same = numpy.zeros(covariance.shape, bool)
+    for idx in blocked.indices:
+        same[numpy.ix_(idx, idx)] = True
+    numpy.testing.assert_allclose(
+        lower @ lower.T, numpy.where(same, covariance, 0), atol=1E-12)
+    # a block size larger than the number of sites gives the dense factor
+    numpy.testing.assert_array_equal(
+        model.factor(sitecol, imts, block_size=100).lower_triangle,
+        dense.lower_triangle)
+
+
+def test_factors_are_shared_by_equivalent_models():
+    factor_cache.clear()
+    sitecol = _random_sitecol(50)
+    imts = [SA(0.5), SA(1.0)]
+    factor = LothBaker2013().cached_factor(sitecol, imts)
+    assert LothBaker2013().cached_factor(sitecol, imts) is factor
+    assert (factor_cache.hits, factor_cache.misses) == (1, 1)
+    # different sites or IMTs require a new factorization
+    LothBaker2013().cached_factor(sitecol.filtered(range(40)), imts)
+    LothBaker2013().cached_factor(sitecol, imts[:1])
+    assert factor_cache.misses == 3
+    # the memory limit is honored
+    maxbytes = factor_cache.maxbytes
+    factor_cache.maxbytes = factor.nbytes
+    try:
+        LothBaker2013().cached_factor(sitecol.filtered(range(30)), imts)
+        assert factor_cache.nbytes <= factor.nbytes
+    finally:
+        factor_cache.maxbytes = maxbytes
+        factor_cache.clear()
+
+
 def test_legacy_modules_export_canonical_classes():
     assert correlation.JB2009CorrelationModel is JayaramBaker2009
     assert correlation.HM2018CorrelationModel is HeresiMiranda2019
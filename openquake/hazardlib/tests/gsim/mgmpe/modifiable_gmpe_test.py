@@ -168,6 +168,29 @@ class ModifiableGMPETest(unittest.TestCase):
         aae(phi[ORIG, 0], 0.6201)
         aae(sig[MODI, 0], 0.5701491121)
 
+    def test_shared_base(self):
+        # the GSIMs with the same underlying GMPE share its predictions
+        gmm = valid.gsim('BooreEtAl2014')
+        gsims = [valid.modified_gsim(gmm, set_scale_median_scalar={
+                     'scaling_factor': 1.2}),
+                 gmm,
+                 valid.modified_gsim(gmm, add_delta_to_total_std_scalar={
+                     'delta': 0.1}),
+                 valid.modified_gsim(gmm, ba08_site_term={})]
+        imts = ['PGA', 'SA(0.2)']
+        cmaker = simple_cmaker(gsims, imts)
+        ctx = cmaker.new_ctx(4)
+        ctx.mag = 6.
+        ctx.rake = 0.
+        ctx.vs30 = 400.
+        ctx.rjb = np.array([1., 10., 30., 70.])
+        mean_stds = cmaker.get_mean_stds([ctx])  # (4, G, M, N)
+        for g, gsim in enumerate(gsims):
+            ms = simple_cmaker([gsim], imts).get_mean_stds([ctx])[:, 0]
+            aae(mean_stds[:, g], ms)
+        aae(np.exp(mean_stds[0, 0] - mean_stds[0, 1]), 1.2)
+        self.assertIsNone(gsims[0].shared)
+
     def test_gmm_sigma_deltas(self):
         """
         Test capabilities for applying a delta to a component
@@ -0,0 +1,148 @@
+# The Hazard Library
+# Copyright (C) 2026 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import pickle
+import operator
+import unittest
+import tracemalloc
+
+import numpy
+
+from openquake.baselib import parallel
+from openquake.hazardlib.map_array import MapArray, RateMap
+
+aac = numpy.testing.assert_allclose
+
+
+def to_dense(rmap, gids, L=None):
+    # convert a RateMap into a dense array of shape (N, L, G)
+    N, L1, G = rmap.shape
+    dense = numpy.zeros((N, L or L1, G), numpy.float32)
+    for g in gids:
+        arr = rmap.to_array(g)
+        dense[arr['sid'], arr['lid'], gids.index(g)] += arr['rate']
+    return dense
+
+
+def random_rates(sids, seed, monitor):
+    # a MapArray with random rates, as returned by the classical tasks
+    mapa = MapArray(sids, 12, 3, True).fill(0)
+    mapa.array[:] = numpy.random.default_rng(seed).random(mapa.array.shape)
+    mapa.gid = [4, 5, 7]
+    return mapa
+
+
+class DenseRateMap:
+    # the dense RateMap used as a baseline for the performance
+    def __init__(self, sids, L, gids):
+        self.sidx = numpy.zeros(sids.max() + 1, numpy.uint32)
+        self.sidx[sids] = numpy.arange(len(sids))
+        self.array = numpy.zeros((len(sids), L, len(gids)), numpy.float32)
+        self.gdic = {g: j for j, g in enumerate(gids)}
+
+    def __iadd__(self, other):
+        sidx = self.sidx[other.sids]
+        for i, g in enumerate(other.gid):
+            self.array[sidx, :, self.gdic[g]] += other.array[:, :, i]
+        return self
+
+
+def time_and_memory(cls, sids, L, gids, mapas):
+    # returns the time and the peak memory to aggregate the given MapArrays
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    rmap = cls(sids, L, gids)
+    for mapa in mapas:
+        rmap += mapa
+    dt = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dt, peak
+
+
+class RateMapTestCase(unittest.TestCase):
+    def test_sparse(self):
+        rng = numpy.random.default_rng(42)
+        N, L, G = 50, 12, 3
+        gids = [4, 5, 7]
+        rmap = RateMap(numpy.arange(N, dtype=numpy.uint32), L, gids)
+        expected = numpy.zeros((N, L, G), numpy.float32)
+        for _ in range(20):
+            sids = numpy.sort(rng.choice(N, 10, replace=False))
+            mapa = MapArray(numpy.uint32(sids), L, G, True).fill(0)
+            mapa.array[:] = rng.random((10, L, G))
+            mapa.array[:, 8:] = 0  # zero rates for the high levels
+            mapa.gid = gids
+            rmap += mapa
+            expected[sids] += mapa.array
+        # only the sites with rates are stored and the zeros are discarded
+        touched = expected.any(axis=(1, 2))
+        self.assertEqual(rmap.nrows, touched.sum())
+        self.assertEqual(len(rmap.to_array()), (expected > 0).sum())
+
+        # the RateMap can be pickled and updated
+        rmap = pickle.loads(pickle.dumps(rmap))
+        rmap += mapa
+        expected[sids] += mapa.array
+        aac(to_dense(rmap, gids), expected, rtol=1E-6)
+
+        # adding a RateMap
+        rmap2 = RateMap(rmap.sids, L, gids)
+        rmap2 += rmap
+        aac(to_dense(rmap2, gids), expected, rtol=1E-6)
+
+        # splitting by IMT
+        dense = sum(to_dense(rm, gids, L) for rm in rmap.split(4))
+        aac(dense, expected, rtol=1E-6)
+
+    def test_aggregator_threads(self):
+        # RateMap.__iadd__ is associative and can be used by the threads
+        N, L, gids = 50, 12, [4, 5, 7]
+        rng = numpy.random.default_rng(42)
+        allargs = [(numpy.uint32(numpy.sort(rng.choice(N, 10, replace=False))),
+                    seed) for seed in range(20)]
+        expected = numpy.zeros((N, L, len(gids)), numpy.float32)
+        for sids, seed in allargs:
+            expected[sids] += random_rates(sids, seed, None).array
+        sids = numpy.arange(N, dtype=numpy.uint32)
+        smap = parallel.Starmap(random_rates, allargs, distribute='no')
+        rmap = smap.reduce(operator.iadd, RateMap(sids, L, gids), threads=3,
+                           acc_factory=lambda: RateMap(sids, L, gids))
+        aac(to_dense(rmap, gids), expected, rtol=1E-6)
+
+    def test_performance(self):
+        # aggregating the rates from the tasks, as for disagg_by_src and
+        # atomic groups, is not slower and not bigger than with a dense map
+        rng = numpy.random.default_rng(42)
+        N, L, gids = 4000, 100, [1, 2, 3, 4]
+        sids = numpy.arange(N, dtype=numpy.uint32)
+        mapas = []
+        for _ in range(30):
+            mapa = MapArray(numpy.uint32(numpy.sort(rng.choice(
+                N, 400, replace=False))), L, len(gids), True).fill(0)
+            mapa.array[:] = rng.random(mapa.array.shape)
+            mapa.gid = gids
+            mapas.append(mapa)
+        t_dense, m_dense = time_and_memory(DenseRateMap, sids, L, gids, mapas)
+        t_rmap, m_rmap = time_and_memory(RateMap, sids, L, gids, mapas)
+        self.assertLessEqual(m_rmap, m_dense * 1.05)
+        self.assertLess(t_rmap, t_dense * 3 + .1)  # generous for noisy CI
+
+        # with few affected sites the memory is much smaller
+        t_dense, m_dense = time_and_memory(
+            DenseRateMap, sids, L, gids, mapas[:1])
+        t_rmap, m_rmap = time_and_memory(RateMap, sids, L, gids, mapas[:1])
+        self.assertLess(m_rmap, m_dense / 4)
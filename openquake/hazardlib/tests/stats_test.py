@@ -1,7 +1,7 @@
 import unittest
 import numpy
 from openquake.hazardlib.stats import (
-    mean_curve, quantile_curve, std_curve, weighted_quantiles)
+    mean_curve, quantile_curve, std_curve, weighted_quantiles, QuantileSketch)
 
 aaae = numpy.testing.assert_array_almost_equal
 
@@ -117,6 +117,57 @@ class QuantileCurveTestCase(unittest.TestCase):
 
         numpy.testing.assert_allclose(expected_curve, actual_curve)
 
+    def test_vectorized_quantile_curve(self):
+        # compare with numpy.interp on each (site, level) pair,
+        # including ties and repeated weights
+        rng = numpy.random.default_rng(42)
+        curves = rng.random((7, 5, 4))  # shape (R, N, L)
+        curves[:, 0] = .3
+        curves[:, 1] = numpy.round(curves[:, 1], 1)
+        weights = rng.random(7)
+        weights /= weights.sum()
+        for q in (0, .05, .5, .84, 1):
+            actual = quantile_curve(q, curves, weights)
+            self.assertEqual(actual.shape, (5, 4))
+            for n in range(5):
+                for li in range(4):
+                    cw = sorted(zip(curves[:, n, li], weights))
+                    c, w = numpy.array(cw).T
+                    expected = numpy.interp(q, w.cumsum(), c)
+                    self.assertAlmostEqual(actual[n, li], expected)
+
+    def test_quantile_sketch(self):
+        # the sketches can be built incrementally and merged
+        rng = numpy.random.default_rng(42)
+        curves = 10 ** rng.uniform(-8, 0, (1000, 5, 4))  # shape (R, N, L)
+        curves[:, 0] = 0
+        weights = rng.random(1000)
+        weights /= weights.sum()
+        sketch = QuantileSketch((5, 4), accuracy=.01)
+        for start in range(0, 1000, 300):
+            sk = QuantileSketch((5, 4), accuracy=.01)
+            sk.add(curves[start:start + 300], weights[start:start + 300])
+            sketch += sk
+        for q in (0, .05, .5, .95, 1):
+            actual = sketch.quantile(q)
+            expected = quantile_curve(q, curves, weights)
+            # intermediate density, the error can exceed 2 * accuracy
+            numpy.testing.assert_allclose(actual, expected, rtol=.03)
+
+    def test_quantile_sketch_bound(self):
+        # for sparse and dense values the error is below gamma - 1
+        for R, decades in [(10, 8), (20_000, 2)]:
+            rng = numpy.random.default_rng(42)
+            curves = 10 ** rng.uniform(-decades, 0, (R, 5, 4))
+            weights = rng.random(R)
+            weights /= weights.sum()
+            sketch = QuantileSketch((5, 4), accuracy=.01)
+            sketch.add(curves, weights)
+            for q in (0, .05, .16, .5, .84, .95, 1):
+                numpy.testing.assert_allclose(
+                    sketch.quantile(q), quantile_curve(q, curves, weights),
+                    rtol=sketch.gamma - 1)
+
     def test_weighted_quantiles(self):
         data1 = [10, 20, 30, 40, 50, 60, 70, 80, 90]
         weig1 = [.01] * 9
@@ -0,0 +1,74 @@
+# this is useful to compare the accuracy and the speed of the scalable
+# samplers in openquake.hazardlib.correlation_models.sampling with the
+# exact Cholesky factor; examples:
+# python bench_correlation_samplers.py  # up to 2,500 sites
+# python bench_correlation_samplers.py 10000  # up to 10,000 sites
+
+import sys
+import time
+import numpy
+from openquake.hazardlib.site import SiteCollection
+from openquake.hazardlib.imt import SA
+from openquake.hazardlib.correlation_models.base import CholeskyFactor
+from openquake.hazardlib.correlation_models.spatial.jayaram_baker_2009 \
+    import JayaramBaker2009
+from openquake.hazardlib.correlation_models.sampling import (
+    vecchia_factor, CirculantEmbeddingSampler)
+from openquake.calculators.views import text_table
+
+MODEL = JayaramBaker2009(vs30_clustering=False)
+IMT = SA(1.0)
+E = 1000  # number of events
+
+
+def grid(num_sites):
+    # square grid with a spacing of ~1 km
+    n = int(numpy.sqrt(num_sites))
+    lons, lats = numpy.meshgrid(10 + numpy.arange(n) * .0127,
+                                45 + numpy.arange(n) * .009)
+    return SiteCollection.from_points(lons.ravel(), lats.ravel())
+
+
+def bench(sites, exact):
+    rng = numpy.random.default_rng(42)
+    N = len(sites)
+    rows = []
+    if exact:
+        t0 = time.time()
+        corr = MODEL.correlation_matrix(sites, IMT)
+        factor = CholeskyFactor(numpy.linalg.cholesky(corr))
+        factor.apply(rng.standard_normal((N, E)))
+        rows.append((N, 'cholesky', round(time.time() - t0, 2), 0.))
+    for k in (10, 30):
+        t0 = time.time()
+        factor = vecchia_factor(MODEL, sites, IMT, k)
+        factor.apply(rng.standard_normal((N, E)))
+        dt = time.time() - t0
+        if exact:
+            lower = factor.apply(numpy.eye(N))
+            err = numpy.abs(lower @ lower.T - corr).max()
+        else:
+            err = numpy.nan
+        rows.append((N, f'vecchia_{k}', round(dt, 2), round(err, 4)))
+    t0 = time.time()
+    sampler = CirculantEmbeddingSampler(MODEL, sites, IMT)
+    sampler.sample(E, rng)
+    dt = time.time() - t0
+    err = numpy.abs(sampler.covariance() - corr).max() if exact else numpy.nan
+    rows.append((N, 'circulant', round(dt, 2), round(err, 4)))
+    return rows
+
+
+def main(max_sites):
+    rows = []
+    num_sites = 100
+    while num_sites <= max_sites:
+        rows.extend(bench(grid(num_sites), exact=num_sites <= 2500))
+        num_sites *= 4
+    header = ['num_sites', 'sampler', f'time_{E}_events', 'max_cov_error']
+    print(text_table(rows, header, ext='org'))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 2500)
@@ -0,0 +1,84 @@
+# this is useful to compare the chunk/compression profiles in
+# openquake.baselib.hdf5.PROFILES with the h5py defaults; examples:
+# python bench_hdf5_profiles.py  # 10 million rows per dataset
+# python bench_hdf5_profiles.py 100  # 100 million rows per dataset
+# install hdf5plugin to measure the lz4 and zstd profiles too
+
+import os
+import sys
+import time
+import tempfile
+import numpy
+from openquake.baselib import hdf5
+from openquake.calculators.views import text_table
+
+BLOCK = 100_000  # rows saved by each call to extend, as in agg_dicts
+
+
+def read_gmf_data(dset, rng):
+    # read the GMFs of 1000 events, i.e. 1000 small slices
+    for start in rng.integers(0, len(dset) - 100, 1000):
+        dset[start:start + 100]
+
+
+def read_rates(dset, rng):
+    # read 100 site chunks of 10_000 rows each
+    for start in rng.integers(0, len(dset) - 10_000, 100):
+        dset[start:start + 10_000]
+
+
+def read_risk_by_event(dset, rng):
+    # read the full column, as done when filtering by agg_id
+    dset[:]
+
+
+READ = {'gmf_data': read_gmf_data, '_rates': read_rates,
+        'risk_by_event': read_risk_by_event}
+
+
+def bench(fname, kind, data, chunks, compression):
+    rng = numpy.random.default_rng(42)
+    mb = data.nbytes / 1024**2
+    with hdf5.File(fname, 'w') as h5:
+        dset = h5.create_dataset(
+            f'{kind}/col', (0,), data.dtype, chunks=chunks,
+            maxshape=(None,), **hdf5.get_filter(compression))
+        t0 = time.time()
+        for start in range(0, len(data), BLOCK):
+            hdf5.extend(dset, data[start:start + BLOCK])
+        h5.flush()
+        dt_write = time.time() - t0
+    size = os.path.getsize(fname) / 1024**2
+    with hdf5.File(fname, 'r') as h5:
+        t0 = time.time()
+        READ[kind](h5[f'{kind}/col'], rng)
+        dt_read = time.time() - t0
+    return (kind, str(chunks), compression or '', int(mb / dt_write),
+            round(dt_read, 3), round(size / mb, 2))
+
+
+def main(num_rows):
+    rng = numpy.random.default_rng(42)
+    # lognormal values are similar to GMVs and losses
+    data = rng.lognormal(-3, 1, num_rows).astype(numpy.float32)
+    fname = tempfile.mktemp(suffix='.hdf5')
+    rows = []
+    try:
+        for kind in hdf5.PROFILES:
+            chunks, comp = hdf5.get_profile(kind, data.dtype)
+            comps = [None, 'gzip']
+            if hdf5.hdf5plugin:
+                comps.extend(['lz4', 'zstd'])
+            rows.append(bench(fname, kind, data, True, None))
+            for compression in comps:
+                rows.append(bench(fname, kind, data, chunks, compression))
+    finally:
+        os.remove(fname)
+    header = ['kind', 'chunks', 'compression', 'write_MB/s', 'read_time',
+              'size_ratio']
+    print(text_table(rows, header, ext='org'))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) * 1_000_000 if args else 10_000_000)